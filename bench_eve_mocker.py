@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+""" bench_eve_mocker.py - Benchmark the eve_mocker request throughput.
+
+Run every scenario for each collection size, either by calling the
+handlers directly, through HTTPretty or through the requests adapter
+(both require requests), and output
+the results as JSON so runs can be compared over time:
+
+    $ python -m bench_eve_mocker --sizes 1000 10000 --output bench.json
+
+Each scenario runs in a forked process (where available), so its
+peak memory is the maximum resident set size of that process alone
+(resource.getrusage), seeding included.
+
+"""
+import os
+import sys
+import json
+import traceback
+import time
+import argparse
+import resource
+from urllib import urlencode
+from collections import OrderedDict
+
+from eve_mocker import EveMocker, ServerRequest, DictStorage, SQLiteStorage, \
+    join_body
+
+BASE_URL = "http://bench.eve-mocker/api/"
+
+SCENARIOS = OrderedDict()
+
+
+def scenario(name):
+    """ Register a scenario, a function taking the mocker and the
+    collection size, returning a function building the i-th request
+    as (method, path, headers, body). """
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def seed(mocker, size):
+    """ Seed the items resource with size items. """
+    mocker.load_resource("items", ({"_id": "item{0}".format(i),
+                                    "val": i,
+                                    "group": i % 10,
+                                    "content": "content {0}".format(i)}
+                                   for i in xrange(size)))
+
+
+@scenario("list_get")
+def list_get(mocker, size):
+    return lambda i: ("GET", "/api/items/", {}, "")
+
+
+@scenario("list_get_stream")
+def list_get_stream(mocker, size):
+    mocker.stream = True
+    return lambda i: ("GET", "/api/items/", {}, "")
+
+
+@scenario("list_get_gzip")
+def list_get_gzip(mocker, size):
+    mocker.compress = True
+    return lambda i: ("GET", "/api/items/", {"Accept-Encoding": "gzip"}, "")
+
+
+def where_scenario(query):
+    """ Build a ?where scenario, query takes the size
+    and returns the MongoDB query. """
+    def build(mocker, size):
+        path = "/api/items/?" + urlencode({"where": json.dumps(query(size))})
+        return lambda i: ("GET", path, {}, "")
+    return build
+
+
+for name, query in (
+        ("eq", lambda size: {"group": 1}),
+        ("gt", lambda size: {"val": {"$gt": size // 2}}),
+        ("gte", lambda size: {"val": {"$gte": size // 2}}),
+        ("lt", lambda size: {"val": {"$lt": size // 2}}),
+        ("lte", lambda size: {"val": {"$lte": size // 2}}),
+        ("ne", lambda size: {"group": {"$ne": 1}}),
+        ("in", lambda size: {"val": {"$in": range(0, size, 100)}}),
+        ("nin", lambda size: {"val": {"$nin": range(0, size, 100)}}),
+        ("or", lambda size: {"$or": [{"content": {"$regex": "5$"}},
+                                     {"group": 1}]}),
+        ("regex", lambda size: {"content": {"$regex": "^content 1"}}),
+        ("exists", lambda size: {"val": {"$exists": True}, "group": 1})):
+    scenario("where_" + name)(where_scenario(query))
+
+
+@scenario("sort")
+def sort(mocker, size):
+    path = "/api/items/?" + urlencode({"sort": '[("group", 1), ("val", -1)]'})
+    return lambda i: ("GET", path, {}, "")
+
+
+@scenario("projection")
+def projection(mocker, size):
+    path = "/api/items/?" + urlencode({"projection": '{"val": 1}'})
+    return lambda i: ("GET", path, {}, "")
+
+
+@scenario("item_get")
+def item_get(mocker, size):
+    return lambda i: ("GET", "/api/items/item{0}".format(i % size), {}, "")
+
+
+@scenario("item_patch")
+def item_patch(mocker, size):
+    def request(i):
+        pk = "item{0}".format(i % size)
+        etag = mocker.get_etag("items", mocker.items["items"][pk])
+        body = urlencode({"data": json.dumps({"val": -i})})
+        return ("PATCH", "/api/items/" + pk, {"If-Match": etag}, body)
+    return request
+
+
+@scenario("item_delete")
+def item_delete(mocker, size):
+    def request(i):
+        pk = "item{0}".format(i % size)
+        item = mocker.items["items"].get(pk)
+        etag = mocker.get_etag("items", item) if item else ""
+        return ("DELETE", "/api/items/" + pk, {"If-Match": etag}, "")
+    return request
+
+
+@scenario("bulk_post")
+def bulk_post(mocker, size):
+    def request(i):
+        body = urlencode(dict(("new{0}".format(j),
+                               json.dumps({"_id": "new{0}-{1}".format(i, j),
+                                           "val": j}))
+                              for j in xrange(100)))
+        return ("POST", "/api/items/", {}, body)
+    return request
+
+
+@scenario("bulk_post_json")
+def bulk_post_json(mocker, size):
+    def request(i):
+        body = json.dumps([{"_id": "new{0}-{1}".format(i, j), "val": j}
+                           for j in xrange(100)])
+        return ("POST", "/api/items/", {"Content-Type": "application/json"}, body)
+    return request
+
+
+def direct_transport(mocker):
+    def send(method, path, headers, body):
+        status, _, body = mocker.handle(ServerRequest(method, path, headers, body))
+        # Streamed bodies are only encoded when they're read
+        join_body(body)
+        return status
+    return send
+
+
+def httpretty_transport(mocker):
+    import requests
+
+    def send(method, path, headers, body):
+        return requests.request(method, BASE_URL + path[len("/api/"):],
+                                headers=headers, data=body).status_code
+    return send
+
+
+def adapter_transport(mocker):
+    import requests
+    from eve_mocker import EveMockerAdapter
+
+    session = requests.Session()
+    session.mount(BASE_URL, EveMockerAdapter(mocker))
+
+    def send(method, path, headers, body):
+        return session.request(method, BASE_URL + path[len("/api/"):],
+                               headers=headers, data=body).status_code
+    return send
+
+
+TRANSPORTS = OrderedDict([("direct", direct_transport),
+                          ("httpretty", httpretty_transport),
+                          ("adapter", adapter_transport)])
+
+STORAGES = OrderedDict([("dict", DictStorage),
+                        ("compact", lambda: DictStorage(compact=["items"])),
+                        ("sqlite", SQLiteStorage)])
+
+
+def percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def run(name, size, transport, max_requests=100, duration=2.0,
+        storage="dict"):
+    """ Run a scenario, return its results as a dict. """
+    mocker = EveMocker(BASE_URL, storage=STORAGES[storage]())
+    seed(mocker, size)
+    build = SCENARIOS[name](mocker, size)
+    send = TRANSPORTS[transport](mocker)
+    latencies = []
+    statuses = {}
+    started = time.time()
+    for i in xrange(max_requests):
+        request = build(i)
+        t = time.time()
+        status = send(*request)
+        latencies.append(time.time() - t)
+        statuses[status] = statuses.get(status, 0) + 1
+        if time.time() - started > duration:
+            break
+    total = sum(latencies)
+    latencies.sort()
+    return {"scenario": name,
+            "size": size,
+            "transport": transport,
+            "storage": storage,
+            "requests": len(latencies),
+            "statuses": statuses,
+            "requests_per_sec": len(latencies) / total if total else None,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_isolated(*args):
+    """ Run a scenario (see run) in a forked process, so its peak
+    memory isn't hidden by the previous scenarios. """
+    if not hasattr(os, "fork"):
+        return run(*args)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            out = json.dumps({"result": run(*args)})
+        except BaseException:
+            out = json.dumps({"error": traceback.format_exc()})
+        with os.fdopen(w, "w") as f:
+            f.write(out)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        out = json.loads(f.read() or '{"error": "Scenario process died"}')
+    os.waitpid(pid, 0)
+    if "error" in out:
+        raise RuntimeError("Scenario {0} failed:\n{1}".format(args[0], out["error"]))
+    result = out["result"]
+    result["statuses"] = dict((int(k), v) for k, v in result["statuses"].items())
+    return result
+
+
+def run_all(sizes=(1000, 10000, 100000), scenarios=None,
+            transports=("direct", "httpretty"), max_requests=100, duration=2.0,
+            storages=("dict",), isolate=True):
+    """ Run scenarios for every size, transport and storage engine,
+    each in its own process if isolate is True. """
+    results = []
+    for transport in transports:
+        if transport == "httpretty":
+            from httpretty import HTTPretty
+            HTTPretty.enable()
+        try:
+            for storage in storages:
+                for size in sizes:
+                    for name in scenarios or SCENARIOS:
+                        results.append((run_isolated if isolate else run)(
+                            name, size, transport, max_requests, duration,
+                            storage))
+        finally:
+            if transport == "httpretty":
+                HTTPretty.disable()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="bench_eve_mocker",
+                                     description="Benchmark eve_mocker.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="Collection sizes")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS.keys(),
+                        help="Scenarios to run, all by default")
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS.keys(),
+                        default=TRANSPORTS.keys())
+    parser.add_argument("--storages", nargs="+", choices=STORAGES.keys(),
+                        default=["dict"], help="Storage engines")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="Maximum number of requests per scenario")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="Maximum duration of a scenario (seconds)")
+    parser.add_argument("--no-fork", action="store_true",
+                        help="Run every scenario in this process, peak "
+                             "memory then only grows across scenarios")
+    parser.add_argument("--output", help="Output file, stdout by default")
+    args = parser.parse_args(args)
+
+    results = run_all(args.sizes, args.scenarios, args.transports,
+                      args.requests, args.duration, args.storages,
+                      isolate=not args.no_fork)
+    out = json.dumps({"time": time.time(),
+                      "python": sys.version.split()[0],
+                      "results": results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out)
+    else:
+        print out
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,717 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import sys
 import json
+import argparse
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from httpretty import HTTPretty
-from urlparse import parse_qs, urljoin
-from collections import defaultdict
-import time
+from urllib import urlencode, quote
+from urlparse import parse_qs, urljoin, urlsplit
+from collections import defaultdict, deque, OrderedDict, MutableMapping
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from wsgiref.headers import Headers
+from io import BytesIO
+import sqlite3
+import mmap
+import struct
+import cPickle
+import marshal
 import hashlib
-from itertools import ifilter
+import operator
+import heapq
+import ast
+import uuid
+import time
+import calendar
+import math
+import random
+import zlib
+import cProfile
+import threading
+import traceback
+from contextlib import contextmanager
+from itertools import count, izip, islice, ifilter, imap
+from bisect import bisect_left, bisect_right
+from array import array
 
 PK = "_id"
 
+PAGINATION_DEFAULT = 25
+
+SEQUENCES = (list, tuple, set, frozenset)
+
+HTTP_METHODS = ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS")
+
+# Latency histogram buckets upper bounds (ms)
+LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+# Route kinds
+RESOURCE = "resource"
+ITEM = "item"
+
+# Number of items written at once by load_resource
+LOAD_BATCH_SIZE = 1000
+
+# Number of items encoded in each chunk of a streamed response
+STREAM_BATCH_SIZE = 1000
+
+# Supported content codings (zlib wbits), by order of preference
+CONTENT_CODINGS = OrderedDict([("gzip", 16 + zlib.MAX_WBITS),
+                               ("deflate", zlib.MAX_WBITS)])
+
+# Bodies smaller than this (bytes) are not compressed
+COMPRESS_MIN_SIZE = 1024
+
+COMPRESS_LEVEL = 6
+
+# Journal marker for a dropped resource
+DROPPED = object()
+
+# Fields holding RFC 1123 dates, compared as dates in queries
+DATE_FIELDS = ("_created", "_updated")
+
+# Number of parsed dates to memoize
+DATE_CACHE_SIZE = 100000
+
+
+_etag_counter = count(1)
+
+
+def _advance_etag_counter(value):
+    """ Make sure the next counter etags are above value,
+    e.g. after loading items from a snapshot. """
+    global _etag_counter
+    _etag_counter = count(max(next(_etag_counter), value))
+
+
+def counter_etag(item=None):
+    """ Generate an etag from a monotonic counter,
+    unique within the process. """
+    return "{0:040x}".format(next(_etag_counter))
+
+
+def content_etag(item):
+    """ Generate an etag by hashing the item content (without its etag). """
+    content = dict((k, v) for k, v in item.items() if k != "etag")
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+ETAG_STRATEGIES = {"counter": counter_etag, "hash": content_etag}
+
 
 def generate_etag():
-    """ Helper function for generating random etag. """
-    return hashlib.sha1(str(time.time())).hexdigest()
+    """ Helper function for generating unique etag. """
+    return counter_etag()
+
+
+def etag_matches(header, etag):
+    """ Check if an etag matches an If-Match/If-None-Match header,
+    quotes, weak validators prefix and "*" are supported. """
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        value = value.strip('"')
+        if value == etag or value == "*":
+            return True
+    return False
+
+
+OPERATORS = {
+    "$eq": operator.eq,
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+    "$ne": operator.ne,
+    "$in": lambda x, val: _contains(x, val),
+    "$nin": lambda x, val: not _contains(x, val),
+}
+
+
+class RWLock(object):
+    """ Reentrant readers/writer lock, many readers or a single writer,
+    waiting writers have priority over new readers.
+
+    A thread holding the write lock can acquire the read lock,
+    but a reader can't upgrade to the write lock.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        # Per thread (depth, mode) for reentrancy
+        self._local = threading.local()
+
+    def acquire_read(self):
+        local = self._local
+        if getattr(local, "depth", 0):
+            local.depth += 1
+            return
+        with self._lock:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        local.depth, local.mode = 1, "read"
+
+    def acquire_write(self):
+        local = self._local
+        if getattr(local, "depth", 0):
+            if local.mode != "write":
+                raise RuntimeError("Can't upgrade a read lock to a write lock")
+            local.depth += 1
+            return
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        local.depth, local.mode = 1, "write"
+
+    def release(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth:
+            return
+        with self._lock:
+            if local.mode == "write":
+                self._writer = False
+                self._cond.notify_all()
+            else:
+                self._readers -= 1
+                # Only writers wait for the readers to leave
+                if not self._readers and self._waiting_writers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class LRUCache(object):
+    """ Bounded least recently used cache, keep track of hits and misses.
+
+    :type maxsize: int
+    :param maxsize: Maximum number of entries
+
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None, valid=None):
+        """ Return the value of a key, valid is an optional callable
+        checking the value, stale values are counted as misses. """
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            if valid is not None and not valid(value):
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self.data), "maxsize": self.maxsize}
+
+
+def format_date(t):
+    """ Format a timestamp as a RFC 1123 date, like Eve's
+    _created and _updated ("Tue, 17 Oct 2026 10:00:00 GMT"). """
+    return formatdate(t, usegmt=True)
+
+
+_MONTHS = dict((month, i) for i, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1))
+
+
+def parse_date(value):
+    """ Parse a RFC 1123 date into a timestamp (seconds),
+    raise ValueError if it's invalid.
+
+    :type value: str
+    :param value: RFC 1123 date
+
+    """
+    parsed = None
+    if isinstance(value, basestring):
+        parts = value.split()
+        if len(parts) == 6 and parts[5] == "GMT" and parts[2] in _MONTHS:
+            # Fast path for the dates formatted by format_date
+            try:
+                hour, minute, second = map(int, parts[4].split(":"))
+                return calendar.timegm((int(parts[3]), _MONTHS[parts[2]],
+                                        int(parts[1]), hour, minute, second))
+            except ValueError:
+                pass
+        try:
+            parsed = parsedate_tz(value)
+        except (TypeError, ValueError, IndexError):
+            pass
+    if parsed is None:
+        raise ValueError("Invalid date: {0!r}".format(value))
+    if parsed[9] is None:
+        # Dates without timezone are GMT
+        parsed = parsed[:9] + (0,)
+    return mktime_tz(parsed)
+
+
+_dates = {}
+
+
+def _date_value(value):
+    """ Return the timestamp of a date, None if it isn't a valid
+    RFC 1123 date, parsed dates are memoized. """
+    try:
+        return _dates[value]
+    except (KeyError, TypeError):
+        pass
+    try:
+        t = parse_date(value)
+    except ValueError:
+        t = None
+    if isinstance(value, basestring):
+        if len(_dates) >= DATE_CACHE_SIZE:
+            _dates.clear()
+        _dates[value] = t
+    return t
+
+
+def _dated(op):
+    """ Wrap an operator to compare a date field as a timestamp. """
+    def test(x, val):
+        t = _date_value(x)
+        return t is not None and op(t, val)
+    return test
+
+
+def _stamp(item, now):
+    """ Set the missing _created and _updated dates of an item. """
+    if "_created" not in item:
+        item["_created"] = now
+    if "_updated" not in item:
+        item["_updated"] = item["_created"]
+
+
+# Returned by field getters for missing fields
+ABSENT = object()
+
+
+def _path_getter(path):
+    """ Build a function looking up a path (list of keys) through
+    embedded documents (and lists, for integer keys). """
+    path = [(key, int(key) if key.isdigit() else None) for key in path]
+
+    def get(x):
+        for key, index in path:
+            if isinstance(x, dict):
+                x = x.get(key, ABSENT)
+                if x is ABSENT:
+                    return x
+            elif index is not None and isinstance(x, list) and index < len(x):
+                x = x[index]
+            else:
+                return ABSENT
+        return x
+    return get
+
+
+def field_getter(field):
+    """ Build a function returning the value of a field of an item,
+    dot notation ("owner.id") looks up embedded documents,
+    ABSENT is returned if the field is missing.
+
+    :type field: str
+    :param field: Field name
+
+    """
+    if "." not in field:
+        return lambda x: x.get(field, ABSENT)
+    return _path_getter(field.split("."))
+
+
+def _date_getter(field):
+    """ Build a function returning the timestamp of a date field. """
+    get = field_getter(field)
+
+    def get_date(x):
+        value = get(x)
+        return value if value is ABSENT else _date_value(value)
+    return get_date
+
+
+def _contains(x, val):
+    try:
+        return x in val
+    except TypeError:
+        # Unhashable value looked up in a set
+        return False
+
+
+def _regex_search(x, regex):
+    return isinstance(x, basestring) and regex.search(x) is not None
+
+
+def _in_test(k, val):
+    def test(x):
+        try:
+            return k in x and x[k] in val
+        except TypeError:
+            # Unhashable value looked up in a set
+            return False
+    return test
+
+
+def _nin_test(k, val):
+    def test(x):
+        try:
+            return k in x and x[k] not in val
+        except TypeError:
+            return True
+    return test
+
+
+# Inlined test of a top-level field for a single operator,
+# saves a function call per item
+KEY_TESTS = {
+    OPERATORS["$eq"]: lambda k, val: lambda x: k in x and x[k] == val,
+    OPERATORS["$gt"]: lambda k, val: lambda x: k in x and x[k] > val,
+    OPERATORS["$gte"]: lambda k, val: lambda x: k in x and x[k] >= val,
+    OPERATORS["$lt"]: lambda k, val: lambda x: k in x and x[k] < val,
+    OPERATORS["$lte"]: lambda k, val: lambda x: k in x and x[k] <= val,
+    OPERATORS["$ne"]: lambda k, val: lambda x: k in x and x[k] != val,
+    OPERATORS["$in"]: _in_test,
+    OPERATORS["$nin"]: _nin_test,
+}
+
+# Inlined test of a top-level field for a range (lower, upper operators)
+RANGE_TESTS = {
+    (OPERATORS["$gt"], OPERATORS["$lt"]):
+        lambda k, lo, hi: lambda x: k in x and lo < x[k] < hi,
+    (OPERATORS["$gt"], OPERATORS["$lte"]):
+        lambda k, lo, hi: lambda x: k in x and lo < x[k] <= hi,
+    (OPERATORS["$gte"], OPERATORS["$lt"]):
+        lambda k, lo, hi: lambda x: k in x and lo <= x[k] < hi,
+    (OPERATORS["$gte"], OPERATORS["$lte"]):
+        lambda k, lo, hi: lambda x: k in x and lo <= x[k] <= hi,
+}
+
+
+# Relative cost of each operator, cheap tests are run first
+OPERATOR_COSTS = {"$in": 2, "$nin": 2, "$regex": 8}
+
+REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE,
+               "s": re.DOTALL, "x": re.VERBOSE}
+
+
+def compile_regex(pattern, options=""):
+    """ Compile a $regex pattern with its $options (i, m, s, x),
+    raise ValueError if it's invalid. """
+    if not isinstance(pattern, basestring) or \
+            not isinstance(options, basestring):
+        raise ValueError("Invalid $regex: {0!r}".format(pattern))
+    flags = 0
+    for option in options:
+        if option not in REGEX_FLAGS:
+            raise ValueError("Invalid $options: {0}".format(options))
+        flags |= REGEX_FLAGS[option]
+    try:
+        return re.compile(pattern, flags)
+    except re.error as exc:
+        raise ValueError("Invalid $regex: {0} ({1})".format(pattern, exc))
+
+
+class FieldTest(object):
+    """ Test of a single (dotted) field, every operator must pass,
+    and the field must be present unless $exists is false.
+
+    :type field: str
+    :param field: Field name
+
+    :type ops: list
+    :param ops: List of (operator, value)
+
+    :type exists: bool
+    :param exists: $exists value, None if not given
+
+    :type cost: int
+    :param cost: Estimated cost of the operators
+
+    """
+    def __init__(self, field, ops, exists=None, cost=1):
+        self.field = field
+        self.path = field.split(".")
+        self.ops = ops
+        self.exists = exists
+        self.cost = cost + len(self.path) - 1
+        self.get = field_getter(field)
+        self.test_value = self._value_test()
+        self.test = self._test()
+
+    def _value_test(self):
+        """ Build the test of a value, ABSENT if the field is missing. """
+        ops = self.ops
+        if self.exists is False:
+            return lambda v: v is ABSENT
+        if len(ops) == 1:
+            (op, val), = ops
+            return lambda v: v is not ABSENT and op(v, val)
+
+        def test(v):
+            if v is ABSENT:
+                return False
+            for op, val in ops:
+                if not op(v, val):
+                    return False
+            return True
+        return test
+
+    def _test(self):
+        """ Build the test of an item, the field lookup is done only once,
+        common operators on a top-level field get a specialised closure. """
+        if len(self.path) == 1 and self.exists is None:
+            test = self._key_test(self.field, self.ops)
+            if test is not None:
+                return test
+        get, test_value = self.get, self.test_value
+        return lambda x: test_value(get(x))
+
+    @staticmethod
+    def _key_test(k, ops):
+        """ Return a specialised test of the k key, None if there's none
+        for these operators. """
+        if len(ops) == 1:
+            (op, val), = ops
+            if op in KEY_TESTS:
+                return KEY_TESTS[op](k, val)
+            return lambda x: k in x and op(x[k], val)
+        if len(ops) == 2:
+            (op1, val1), (op2, val2) = ops
+            if (op2, op1) in RANGE_TESTS:
+                (op1, val1), (op2, val2) = (op2, val2), (op1, val1)
+            if (op1, op2) in RANGE_TESTS:
+                return RANGE_TESTS[op1, op2](k, val1, val2)
+        return None
+
+
+def _fuse(tests):
+    """ Fuse a list of tests into a single predicate. """
+    if not tests:
+        return lambda x: True
+    if len(tests) == 1:
+        return tests[0]
+    if len(tests) == 2:
+        a, b = tests
+        return lambda x: a(x) and b(x)
+    if len(tests) == 3:
+        a, b, c = tests
+        return lambda x: a(x) and b(x) and c(x)
+
+    def predicate(x):
+        for test in tests:
+            if not test(x):
+                return False
+        return True
+    return predicate
+
+
+def _any(tests):
+    """ Fuse a list of tests, one of them must pass. """
+    def predicate(x):
+        for test in tests:
+            if test(x):
+                return True
+        return False
+    return predicate
+
+
+class QueryPlan(object):
+    """ A compiled MongoDB query, see query_data for the supported subset.
+
+    The query is turned into a list of tests, run from the cheapest
+    to the most expensive, each one filtering the items left by the
+    previous ones, and into a single predicate (stopping at the first
+    failure for $and, or success for $or) to test a single item.
+
+    Raise ValueError if the query is invalid.
+
+    :type q: dict
+    :param q: MongoDB Query
+
+    """
+    def __init__(self, q):
+        if not isinstance(q, dict):
+            raise ValueError("Query must be a dict: {0!r}".format(q))
+        self.query = q
+        # Operators for each field, used for index lookups
+        self.clauses = {}
+        # FieldTest of each field, all of them must pass
+        self.fields = []
+        # $or lists of QueryPlan, one plan of each list must pass
+        self.alternatives = []
+        # Operators of the date fields, with timestamps
+        self.dates = {}
+        for k, f in q.items():
+            if k == "$and":
+                for plan in self._subplans(k, f):
+                    for field, clauses in plan.clauses.items():
+                        self.clauses.setdefault(field, clauses)
+                    for field, dates in plan.dates.items():
+                        self.dates.setdefault(field, dates)
+                    self.fields.extend(plan.fields)
+                    self.alternatives.extend(plan.alternatives)
+            elif k == "$or":
+                plans = self._subplans(k, f)
+                self.alternatives.append(sorted(plans, key=lambda p: p.cost))
+            elif k.startswith("$"):
+                raise ValueError("Unknown operator: {0}".format(k))
+            else:
+                self.fields.append(self._field_test(k, f))
+
+        tests = [(test.cost, test.test) for test in self.fields]
+        for plans in self.alternatives:
+            tests.append((sum(plan.cost for plan in plans),
+                          _any([plan.predicate for plan in plans])))
+        tests.sort(key=lambda test: test[0])
+        self.cost = sum(cost for cost, _ in tests)
+        self.tests = [test for _, test in tests]
+        self.predicate = _fuse(self.tests)
+
+    def _subplans(self, op, queries):
+        if not isinstance(queries, list) or not queries:
+            raise ValueError("{0} needs a non-empty list".format(op))
+        return [QueryPlan(query) for query in queries]
+
+    def _field_test(self, k, f):
+        """ Build the FieldTest of a field, and its index clauses,
+        date fields are compared as timestamps. """
+        dated = k in DATE_FIELDS
+        if not isinstance(f, dict) or \
+                not any(key.startswith("$") for key in f):
+            if not dated:
+                # Plain value, or embedded document equality
+                self.clauses[k] = {"$eq": f}
+                return FieldTest(k, [(operator.eq, f)])
+            f = {"$eq": f}
+        ops = []
+        clauses = {}
+        dates = {}
+        exists = None
+        cost = 0
+        for _filter, val in f.items():
+            if _filter == "$exists":
+                exists = bool(val)
+            elif _filter == "$regex":
+                regex = compile_regex(val, f.get("$options", ""))
+                ops.append((_regex_search, regex))
+            elif _filter == "$options":
+                if "$regex" not in f:
+                    raise ValueError("$options without $regex")
+                continue
+            elif _filter in OPERATORS:
+                op = OPERATORS[_filter]
+                if _filter in ("$in", "$nin"):
+                    if not isinstance(val, SEQUENCES):
+                        raise ValueError("{0} needs a list".format(_filter))
+                    if dated:
+                        val = [parse_date(v) for v in val]
+                    try:
+                        val = frozenset(val)
+                    except TypeError:
+                        pass
+                elif dated:
+                    val = parse_date(val)
+                if dated:
+                    dates[_filter] = val
+                    op = _dated(op)
+                else:
+                    clauses[_filter] = f[_filter]
+                ops.append((op, val))
+            else:
+                raise ValueError("Unknown operator: {0}".format(_filter))
+            cost += OPERATOR_COSTS.get(_filter, 1)
+        if clauses and exists is not False:
+            self.clauses[k] = clauses
+        if dates and exists is not False:
+            self.dates[k] = dates
+        return FieldTest(k, ops, exists, cost)
+
+    def __call__(self, data):
+        # One filter pass per test, each pass only sees the items
+        # left by the cheaper tests
+        if not self.tests:
+            return list(data)
+        for test in self.tests:
+            data = filter(test, data)
+        return data
+
+
+_query_plans = LRUCache(256)
+
+
+def parse_where(where):
+    """ Parse and compile a raw ?where query string,
+    plans are kept in a bounded LRU cache keyed by the raw string.
+
+    Raise ValueError if the query is invalid.
+
+    :type where: str
+    :param where: JSON encoded MongoDB query
+
+    """
+    plan = _query_plans.get(where)
+    if plan is None:
+        plan = QueryPlan(json.loads(where))
+        _query_plans.set(where, plan)
+    return plan
 
 
 def query_data(data, q):
@@ -21,6 +719,7 @@ def query_data(data, q):
 
     Only a subset of MongoDB query language is supported:
 
+    - $eq
     - $gt
     - $gte
     - $lt
@@ -28,239 +727,3436 @@ def query_data(data, q):
     - $ne
     - $in
     - $nin
+    - $exists
+    - $regex (with $options)
+    - $and
+    - $or
 
-    You can combine multiple operator like {"val": {"$gt": 10, "$lt": 20}}
+    You can combine multiple operator like {"val": {"$gt": 10, "$lt": 20}},
+    fields of embedded documents are queried with the dot notation,
+    like {"owner.id": 5}.
 
     :type data: list
     :param data: List of dict
 
-    :type q: dict
+    :type q: dict or QueryPlan
     :param q: MongoDB Query
 
     """
-    for k, f in q.items():
-        if isinstance(f, dict):
-            for _filter, val in f.items():
-                _f = lambda x: True
-                if _filter.startswith("$"):
-                    if _filter == "$gt":
-                        _f = lambda x: k in x and x[k] > val
-                    elif _filter == "$gte":
-                        _f = lambda x: k in x and x[k] >= val
-                    elif _filter == "$lt":
-                        _f = lambda x: k in x and x[k] < val
-                    elif _filter == "$lte":
-                        _f = lambda x: k in x and x[k] <= val
-                    elif _filter == "$ne":
-                        _f = lambda x: k in x and x[k] != val
-                    elif _filter == "$in":
-                        _f = lambda x: k in x and x[k] in val
-                    elif _filter == "$nin":
-                        _f = lambda x: k in x and not x[k] in val
-                else:
-                    _f = lambda x: k in x and x[k] == f
-                data = list(ifilter(_f, data))
+    if not isinstance(q, QueryPlan):
+        q = QueryPlan(q)
+    return q(data)
+
+
+MISSING = (0, None)
+
+
+def parse_sort(sort):
+    """ Parse a raw ?sort query string into a list of (field, direction).
+
+    Support the JSON dict syntax ({"a": 1, "b": -1}), the list syntax,
+    either JSON ([["a", 1], ["b", -1]]) or Eve's Python syntax
+    ([("a", 1), ("b", -1)]), and the "a,-b" syntax.
+
+    Raise ValueError if the sort is invalid.
+
+    :type sort: str
+    :param sort: Raw sort query
+
+    """
+    sort = sort.strip()
+    if sort.startswith("{"):
+        spec = json.loads(sort, object_pairs_hook=OrderedDict).items()
+    elif sort.startswith("["):
+        try:
+            spec = json.loads(sort)
+        except ValueError:
+            try:
+                spec = ast.literal_eval(sort)
+            except SyntaxError:
+                raise ValueError("Invalid sort: {0}".format(sort))
+    else:
+        spec = [(k[1:], -1) if k.startswith("-") else (k, 1)
+                for k in sort.split(",") if k]
+    out = []
+    for s in spec:
+        if not isinstance(s, SEQUENCES) or len(s) != 2:
+            raise ValueError("Invalid sort: {0}".format(sort))
+        field, direction = s
+        if not isinstance(field, basestring):
+            raise ValueError("Invalid sort: {0}".format(sort))
+        out.append((field, 1 if direction == 1 else -1))
+    return out
+
+
+class SortKey(object):
+    """ Composite sort key for mixed directions,
+    values are compared field by field with their own direction. """
+    __slots__ = ("values", "directions")
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, direction in izip(self.values, other.values,
+                                    self.directions):
+            if a == b:
+                continue
+            return a < b if direction == 1 else b < a
+        return False
+
+
+def sort_key(spec):
+    """ Build a key function and the reverse flag for a sort spec
+    (list of (field, direction)), items lacking a field are sorted
+    first, like null in MongoDB. """
+    fields = [field for field, _ in spec]
+    directions = tuple(direction for _, direction in spec)
+    if len(fields) == 1 and "." not in fields[0] and \
+            fields[0] not in DATE_FIELDS:
+        field = fields[0]
+        key = lambda x: (1, x[field]) if field in x else MISSING
+    else:
+        getters = [_date_getter(f) if f in DATE_FIELDS else field_getter(f)
+                   for f in fields]
+
+        def value(v):
+            return MISSING if v is ABSENT else (1, v)
+        if len(getters) == 1:
+            get = getters[0]
+            key = lambda x: value(get(x))
         else:
-            _f = lambda x: k in x and x[k] == f
-            data = list(ifilter(_f, data))
-    return data
+            key = lambda x: tuple(value(get(x)) for get in getters)
+    if len(set(directions)) == 1:
+        return key, directions[0] == -1
+    return lambda x: SortKey(key(x), directions), False
 
 
-class EveMocker(object):
-    """ Eve API mocker
+def sort_items(items, spec, limit=None):
+    """ Sort items in a single stable sort, with a precomputed composite
+    key, if limit is given, only the top-k items are selected.
 
-    Everything is stored in self.items.
+    :type items: list
+    :param items: List of dict
 
-    Support:
-        - All methods except HEAD
-        - Handle etags
-        - Return good status_code
+    :type spec: list
+    :param spec: List of (field, direction), direction is 1 or -1
 
-    Not (yet?) supported:
-        - HATEOAS links
-        - schema validation
+    :type limit: int
+    :param limit: Only return the first limit items
 
-    :type base_url: str
-    :param base_url: API base url
+    """
+    key, reverse = sort_key(spec)
+    if limit is not None and limit < len(items):
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(limit, items, key=key)
+    return sorted(items, key=key, reverse=reverse)
 
-    :type pk_maps: dict
-    :param pk_maps: Primary key mapping {resource: pk}
 
-    :type default_pk: str
-    :param default_pk: Default primary key, _id by default.
+def parse_projection(projection):
+    """ Parse a raw ?projection query string ({"a": 1, "b": 1} to only
+    include fields, or {"c": 0} to exclude them) into a tuple
+    (inclusive, fields), None if the projection is empty.
+
+    Raise ValueError if the projection is invalid, or mixes
+    inclusion and exclusion.
+
+    :type projection: str
+    :param projection: Raw projection query
 
     """
-    def __init__(self, base_url, pk_maps={}, default_pk="_id"):
-        self.items = defaultdict(dict)
-        self.base_url = base_url
-        self.default_pk = default_pk
-        self.pk_maps = pk_maps
-        self.etag = {}
+    spec = json.loads(projection)
+    if not isinstance(spec, dict):
+        raise ValueError("Invalid projection: {0}".format(projection))
+    if not spec:
+        return None
+    values = set(bool(v) for v in spec.values())
+    if len(values) != 1:
+        raise ValueError("Projection can't mix inclusion "
+                         "and exclusion: {0}".format(projection))
+    return (values.pop(), tuple(sorted(spec)))
 
-        # Register all URIs for resources
-        resource_url = urljoin(self.base_url, "([^/]+/?$)")
-        resource_regex = re.compile(resource_url)
 
-        HTTPretty.register_uri(HTTPretty.GET,
-                               resource_regex,
-                               body=self.generate_resource_response)
-        HTTPretty.register_uri(HTTPretty.POST,
-                               resource_regex,
-                               body=self.generate_resource_response)
+def fields_encoder(pk, projection):
+    """ Build a function JSON encoding only the projected fields of
+    an item (see parse_projection), each selected field is encoded
+    in place, no dict is built, and keys are only encoded once. """
+    inclusive, fields = projection
+    dumps = json.dumps
+    if inclusive:
+        keys = []
+        for k in (pk, "etag") + fields:
+            if k not in keys:
+                keys.append(k)
+        keys = [(k, dumps(k) + ": ") for k in keys]
 
-        HTTPretty.register_uri(HTTPretty.DELETE,
-                               resource_regex,
-                               body=self.generate_resource_response)
+        def encode(item):
+            return "{" + ", ".join([prefix + dumps(item[k])
+                                    for k, prefix in keys if k in item]) + "}"
+        return encode
 
-        # Register URIs for items
-        item_regex = re.compile(urljoin(self.base_url, "([a-zA-Z0-9-_]+)/([a-zA-Z0-9-_]+)"))
+    prefixes = {}
 
-        HTTPretty.register_uri(HTTPretty.GET,
-                               item_regex,
-                               body=self.generate_item_response)
+    def prefix(k):
+        p = prefixes.get(k)
+        if p is None:
+            p = prefixes[k] = dumps(k) + ": "
+        return p
 
-        HTTPretty.register_uri(HTTPretty.PATCH,
-                               item_regex,
-                               body=self.generate_item_response)
+    def encode(item):
+        return "{" + ", ".join([prefix(k) + dumps(v)
+                                for k, v in item.iteritems()
+                                if k not in fields or k == pk or k == "etag"]) + "}"
+    return encode
 
-        HTTPretty.register_uri(HTTPretty.DELETE,
-                               item_regex,
-                               body=self.generate_item_response)
 
-    def __enter__(self):
-        HTTPretty.enable()
-        return self
+class _FieldIndex(object):
+    """ Base of the indexes, the field getter is rebuilt when unpickled. """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["get"]
+        return state
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        HTTPretty.disable()
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.get = field_getter(self.field)
 
-    def get_pk(self, resource):
-        return self.pk_maps.get(resource, self.default_pk)
 
-    def get_resource(self, resource):
-        """ Retrieve all items for a resource.
+class HashIndex(_FieldIndex):
+    """ Hash index on a single field, map a value to the pks holding it.
 
-        Resources are stored in a dict of list (self.items).
+    Answer equality and $in queries, $ne and $nin match most items,
+    they are left to the scan, unhashable values (list, dict)
+    are tracked separately.
 
-        :type resource: str
-        :param resource: Resource name
+    :type field: str
+    :param field: Indexed field
 
-        """
-        return [item for key, item in self.items[resource].items()]
+    """
+    kind = "hash"
 
-    def set_resource(self, resource, items=[]):
-        """ Set items for a given resource.
+    def __init__(self, field):
+        self.field = field
+        self.get = field_getter(field)
+        self.values = defaultdict(set)
+        self.unhashable = set()
 
-        :type resource: str
-        :param resource: Resource name
+    def add(self, pk, item):
+        value = self.get(item)
+        if value is ABSENT:
+            return
+        try:
+            self.values[value].add(pk)
+        except TypeError:
+            self.unhashable.add(pk)
 
-        :type items: list
-        :param items: List of items (dict),
-            also don't forget the pk for each items.
+    def add_many(self, items):
+        """ Index a list of (pk, item). """
+        for pk, item in items:
+            self.add(pk, item)
 
-        """
-        pk = self.get_pk(resource)
-        for item in items:
-            if pk in item:
-                self.items[resource][item[pk]] = item
-            else:
-                exc = "No primary key: {0} found for item: {1}".format(pk, item)
-                raise Exception(exc)
+    def remove(self, pk, item):
+        value = self.get(item)
+        if value is ABSENT:
+            return
+        try:
+            pks = self.values.get(value)
+        except TypeError:
+            self.unhashable.discard(pk)
+            return
+        if pks is not None:
+            pks.discard(pk)
+            if not pks:
+                del self.values[value]
 
-    def generate_resource_response(self, request, uri, headers):
-        """ Generate a response for a resource,
-            support all methods, except HEAD. """
-        headers["content-type"] = "application/json"
-        path = filter(lambda x: x not in ["api", ""], request.path.split('/'))
-        resource = path[0]
-        if request.method == "GET":
-            _items = self.get_resource(resource)
+    def clear(self):
+        self.values = defaultdict(set)
+        self.unhashable = set()
 
-            # Check if a querystring is provided
-            if request.querystring and "where" in request.querystring:
-                try:
-                    # Load the mongo query and filter the result
-                    q = json.loads(request.querystring["where"][0])
-                    _items = query_data(_items, q)
-                except:
-                    pass
-            if request.querystring and "sort" in request.querystring:
-                try:
-                    s = json.loads(request.querystring["sort"][0])
-                    for k, v in s.items():
-                        reverse = True
-                        if v == 1:
-                            reverse = False
-                        elif v == -1:
-                            reverse = True
-                        _items = sorted(_items, key=lambda x: x[k], reverse=reverse)
-                except:
-                    pass
+    def _equal(self, val):
+        return set(self.values.get(val, ()))
 
-            return [200,
-                    headers,
-                    json.dumps({"_items": _items})]
-
-        elif request.method == "POST":
-            qs = parse_qs(request.body)
-            out = {}
-            for key, data in qs.items():
-                item = json.loads(data[0])
-                pk = item[self.get_pk(resource)]
-                if pk in self.items[resource]:
-                    out[key] = {"status": "ERR", "issues": ["pk not unique"]}
+    def lookup(self, ops):
+        """ Return the set of candidate pks for the given operators
+            ({"$op": val}), or None if the index can't answer them. """
+        candidates = None
+        for op, val in ops.items():
+            try:
+                if op == "$eq":
+                    pks = self._equal(val)
+                elif op == "$in" and isinstance(val, SEQUENCES):
+                    pks = set()
+                    for v in val:
+                        pks |= self._equal(v)
                 else:
-                    item_etag = generate_etag()
-                    item["etag"] = item_etag
-                    self.items[resource][pk] = item
-                    out[key] = {"status": "OK", "etag": item_etag}
-            return [200, headers, json.dumps(out)]
+                    continue
+            except TypeError:
+                continue
+            candidates = pks if candidates is None else candidates & pks
+        return candidates
 
-        elif request.method == "DELETE":
-            del self.items[resource]
-            return [200, headers, "{}"]
 
-    def generate_item_response(self, request, uri, headers):
-        """ Generate a response for an item,
-            support all methods, except HEAD. """
-        headers["content-type"] = "application/json"
-        resource, item_id = filter(lambda x: x not in ["api", ""],
-                                   request.path.split('/'))
-        if item_id not in self.items[resource]:
-            status_code = 405
-            if request.method == "GET":
-                status_code = 404
-            return [status_code, headers, "{}"]
+class SortedIndex(_FieldIndex):
+    """ Sorted index on a single field, keep values and pks in two
+    parallel sorted lists.
+
+    Answer $gt, $gte, $lt, $lte ranges, as well as equality and $in.
 
-        if request.method in ["PATCH", "DELETE"]:
-            if not "If-Match" in request.headers:
-                return [403, headers, "{}"]
+    :type field: str
+    :param field: Indexed field
 
-            old_etag = self.items[resource][item_id]["etag"]
+    """
+    kind = "sorted"
 
-            if request.headers["If-Match"] != old_etag:
-                return [412, headers, "{}"]
+    def __init__(self, field):
+        self.field = field
+        self.get = field_getter(field)
+        self.values = []
+        self.pks = []
 
-        if request.method == "GET":
-            r = self.items[resource]
-            if item_id in r:
-                return [200, headers, json.dumps(r[item_id])]
+    def add(self, pk, item):
+        value = self.get(item)
+        if value is ABSENT:
+            return
+        i = bisect_right(self.values, value)
+        self.values.insert(i, value)
+        self.pks.insert(i, pk)
 
-        elif request.method == "DELETE":
-            r = self.items[resource]
-            if item_id in r:
-                del self.items[resource][item_id]
-                return [200, headers, "{}"]
-
-        elif request.method == "PATCH":
-            qs = parse_qs(request.body)
-            out = {}
-            for k, patch_data in qs.items():
-                patch_data = json.loads(patch_data[0])
-                new_etag = generate_etag()
-                patch_data.update({"etag": new_etag})
-                self.items[resource][item_id].update(patch_data)
-                out[k] = {"status": "OK", "etag": new_etag}
-            return [200, headers, json.dumps(out)]
-
-        return [405, headers, "{}"]
+    def add_many(self, items):
+        """ Index a list of (pk, item), the batch is sorted once and
+        merged with the indexed values, instead of inserting each
+        value in the middle of the lists. """
+        get = self.get
+        pairs = [(value, pk) for value, pk in ((get(item), pk)
+                                               for pk, item in items)
+                 if value is not ABSENT]
+        # Stable sort on the value only, like add
+        pairs.sort(key=operator.itemgetter(0))
+        values, pks = self.values, self.pks
+        self.values, self.pks = new_values, new_pks = [], []
+        start = 0
+        for value, pk in pairs:
+            # Indexed values are copied by slices, between the new ones
+            i = bisect_right(values, value, start)
+            new_values += values[start:i]
+            new_pks += pks[start:i]
+            new_values.append(value)
+            new_pks.append(pk)
+            start = i
+        new_values += values[start:]
+        new_pks += pks[start:]
+
+    def remove(self, pk, item):
+        value = self.get(item)
+        if value is ABSENT:
+            return
+        lo = bisect_left(self.values, value)
+        hi = bisect_right(self.values, value)
+        for i in xrange(lo, hi):
+            if self.pks[i] == pk:
+                del self.values[i]
+                del self.pks[i]
+                return
+
+    def clear(self):
+        self.values = []
+        self.pks = []
+
+    def _range(self, lo, hi):
+        return set(self.pks[lo:hi])
+
+    def lookup(self, ops):
+        """ Return the set of candidate pks for the given operators
+            ({"$op": val}), or None if the index can't answer them. """
+        lo, hi = 0, len(self.values)
+        ranged = False
+        candidates = None
+        for op, val in ops.items():
+            if op == "$gt":
+                lo = max(lo, bisect_right(self.values, val))
+            elif op == "$gte":
+                lo = max(lo, bisect_left(self.values, val))
+            elif op == "$lt":
+                hi = min(hi, bisect_left(self.values, val))
+            elif op == "$lte":
+                hi = min(hi, bisect_right(self.values, val))
+            elif op == "$eq":
+                lo = max(lo, bisect_left(self.values, val))
+                hi = min(hi, bisect_right(self.values, val))
+            elif op == "$in" and isinstance(val, SEQUENCES):
+                pks = set()
+                for v in val:
+                    pks |= self._range(bisect_left(self.values, v),
+                                       bisect_right(self.values, v))
+                candidates = pks if candidates is None else candidates & pks
+                continue
+            else:
+                continue
+            ranged = True
+        if ranged:
+            pks = self._range(lo, hi) if lo < hi else set()
+            candidates = pks if candidates is None else candidates & pks
+        return candidates
+
+
+INDEXES = {"hash": HashIndex, "sorted": SortedIndex}
+
+
+class ChangeLog(object):
+    """ Changes of a resource ordered by modification time, deleted
+    items are kept as tombstones, so the changes since a date are
+    found in time proportional to their number.
+
+    Entries (time, pk) are appended to two parallel lists, sorted
+    on the next read if a change is older than the previous one
+    (dates set by the client), an entry is stale once its item has
+    been modified again, stale entries are dropped when they
+    outnumber the others.
+
+    """
+    def __init__(self):
+        self.times = array("l")
+        self.pks = []
+        # pk => time of the last change
+        self.latest = {}
+        self.deleted = set()
+        # Time of the last change, None if there's none
+        self.last = None
+        self.ordered = True
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.latest)
+
+    def add(self, pk, t, deleted=False):
+        """ Record a change of an item at t (seconds). """
+        if self.last is None or t >= self.last:
+            if self.times and t < self.times[-1]:
+                self.ordered = False
+            self.last = t
+        else:
+            self.ordered = False
+        self.times.append(t)
+        self.pks.append(pk)
+        self.latest[pk] = t
+        if deleted:
+            self.deleted.add(pk)
+        else:
+            self.deleted.discard(pk)
+        if len(self.times) > 2 * len(self.latest) + 1000:
+            self.compact()
+
+    def __getstate__(self):
+        self.compact()
+        return self.times, self.pks, self.deleted
+
+    def __setstate__(self, state):
+        self.times, self.pks, self.deleted = state
+        self.latest = dict(izip(self.pks, self.times))
+        self.last = max(self.times) if self.times else None
+        self.ordered = True
+        self._lock = threading.Lock()
+
+    def _sort(self):
+        """ Sort the entries by time, changes made at the same
+        time stay in modification order. """
+        with self._lock:
+            if self.ordered:
+                return
+            times = self.times
+            order = sorted(xrange(len(times)), key=times.__getitem__)
+            self.pks = [self.pks[i] for i in order]
+            self.times = array("l", [times[i] for i in order])
+            self.ordered = True
+
+    def compact(self):
+        """ Drop the stale entries. """
+        entries = list(self.since())
+        self.times = array("l", [self.latest[pk] for pk, _ in entries])
+        self.pks = [pk for pk, _ in entries]
+
+    def since(self, t=None, strict=True):
+        """ Yield (pk, deleted) for the items changed after t
+        (or at t if not strict), all of them if t is None. """
+        self._sort()
+        times, pks = self.times, self.pks
+        if t is None:
+            i = 0
+        else:
+            i = (bisect_right if strict else bisect_left)(times, t)
+        latest = self.latest
+        seen = set()
+        for j in xrange(i, len(times)):
+            pk = pks[j]
+            if latest[pk] == times[j] and pk not in seen:
+                seen.add(pk)
+                yield pk, pk in self.deleted
+
+    def lookup(self, ops):
+        """ Return the set of pks of the items changed after the
+        $gt or $gte timestamp of ops, or None if there's none. """
+        if "$gt" in ops:
+            changes = self.since(ops["$gt"])
+        elif "$gte" in ops:
+            changes = self.since(ops["$gte"], strict=False)
+        else:
+            return None
+        return set(pk for pk, deleted in changes if not deleted)
+
+
+# Column types stored in arrays (bool is not an int column)
+_ARRAY_TYPECODES = {int: "l", float: "d"}
+
+
+class Shape(object):
+    """ Items of a CompactCollection sharing the same fields, stored
+    in columns, int and float columns are arrays as long as they
+    only hold values of this type.
+
+    :type fields: tuple
+    :param fields: Sorted field names
+
+    """
+    __slots__ = ("fields", "positions", "columns", "rows", "free")
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.positions = dict((field, i) for i, field in enumerate(fields))
+        self.columns = [None] * len(fields)
+        # pk => row
+        self.rows = {}
+        self.free = []
+
+    def insert(self, pk, item):
+        if self.free:
+            row = self.free.pop()
+            self.rows[pk] = row
+            self.update(row, item)
+            return
+        row = len(self.rows)
+        self.rows[pk] = row
+        columns = self.columns
+        for i, field in enumerate(self.fields):
+            value = item[field]
+            column = columns[i]
+            if column is None:
+                typecode = _ARRAY_TYPECODES.get(type(value))
+                columns[i] = array(typecode, [value]) if typecode else [value]
+            elif isinstance(column, array) and \
+                    _ARRAY_TYPECODES.get(type(value)) != column.typecode:
+                columns[i] = list(column)
+                columns[i].append(value)
+            else:
+                column.append(value)
+
+    def update(self, row, item):
+        columns = self.columns
+        for i, field in enumerate(self.fields):
+            value = item[field]
+            column = columns[i]
+            if isinstance(column, array) and \
+                    _ARRAY_TYPECODES.get(type(value)) != column.typecode:
+                column = columns[i] = list(column)
+            column[row] = value
+
+    def remove(self, pk):
+        row = self.rows.pop(pk)
+        for column in self.columns:
+            # Release the values
+            column[row] = 0 if isinstance(column, array) else None
+        self.free.append(row)
+
+    def materialize(self, row):
+        return dict(izip(self.fields, [column[row] for column in self.columns]))
+
+
+class CompactCollection(MutableMapping):
+    """ A resource stored in columns, items sharing the same fields
+    are stored in a Shape, each field name is stored once per shape,
+    items are materialized as dicts when accessed.
+
+    ?where queries are evaluated on the columns (see find), only the
+    matching items are materialized.
+
+    """
+    def __init__(self, items=()):
+        # fields => Shape
+        self.shapes = {}
+        self.update(items)
+
+    def _locate(self, pk):
+        for shape in self.shapes.itervalues():
+            row = shape.rows.get(pk)
+            if row is not None:
+                return shape, row
+        return None, None
+
+    def get(self, pk, default=None):
+        shape, row = self._locate(pk)
+        if shape is None:
+            return default
+        return shape.materialize(row)
+
+    def __getitem__(self, pk):
+        shape, row = self._locate(pk)
+        if shape is None:
+            raise KeyError(pk)
+        return shape.materialize(row)
+
+    def __setitem__(self, pk, item):
+        fields = tuple(sorted(item))
+        shape, row = self._locate(pk)
+        if shape is not None:
+            if shape.fields == fields:
+                shape.update(row, item)
+                return
+            shape.remove(pk)
+        shape = self.shapes.get(fields)
+        if shape is None:
+            shape = self.shapes[fields] = Shape(fields)
+        shape.insert(pk, item)
+
+    def __delitem__(self, pk):
+        shape, row = self._locate(pk)
+        if shape is None:
+            raise KeyError(pk)
+        shape.remove(pk)
+
+    def __contains__(self, pk):
+        return self._locate(pk)[0] is not None
+
+    def __len__(self):
+        return sum(len(shape.rows) for shape in self.shapes.itervalues())
+
+    def __iter__(self):
+        for shape in self.shapes.values():
+            for pk in shape.rows:
+                yield pk
+
+    def iteritems(self):
+        for shape in self.shapes.values():
+            for pk, row in shape.rows.iteritems():
+                yield pk, shape.materialize(row)
+
+    def itervalues(self):
+        for shape in self.shapes.values():
+            for row in shape.rows.itervalues():
+                yield shape.materialize(row)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def clear(self):
+        self.shapes = {}
+
+    def find(self, plan, pks=None):
+        """ Return the items matching a QueryPlan, testing the values
+        in the columns, restricted to the given pks (if any). """
+        out = []
+        for shape in self.shapes.values():
+            rows = shape.rows
+            if pks is None:
+                candidates = rows.itervalues()
+            else:
+                candidates = (rows[pk] for pk in pks if pk in rows)
+            if plan.alternatives:
+                # $or spans several fields, test the materialized items
+                out.extend(ifilter(plan.predicate,
+                                   imap(shape.materialize, candidates)))
+                continue
+            tests = []
+            for test in plan.fields:
+                position = shape.positions.get(test.path[0])
+                if position is None:
+                    if test.test_value(ABSENT):
+                        continue
+                    # The field is required
+                    break
+                get = _path_getter(test.path[1:]) if test.path[1:] else None
+                tests.append((shape.columns[position], get, test.test_value))
+            else:
+                def match(row):
+                    for column, get, test_value in tests:
+                        value = column[row]
+                        if get is not None:
+                            value = get(value)
+                        if not test_value(value):
+                            return False
+                    return True
+                out.extend(shape.materialize(row)
+                           for row in candidates if match(row))
+        return out
+
+
+class DictStorage(defaultdict):
+    """ Default storage engine, every resource is a dict pk => item
+    held in memory.
+
+    A storage engine is a mapping resource => collection (created
+    on first access, pop returns the dropped collection, and setting
+    it back restores it), a collection being a mapping pk => item
+    (get, [], []=, pop, in, len, iteration, iteritems,
+    itervalues, values, update and clear).
+
+    Engines may also implement find(resource, plan, spec, offset, limit),
+    count(resource, plan), create_index(resource, field, kind) and
+    drop_index(resource, field) to answer queries themselves,
+    find and count return None when they can't.
+
+    :type compact: list
+    :param compact: Resources stored in a CompactCollection
+        instead of a dict, to save memory.
+
+    """
+    def __init__(self, compact=()):
+        super(DictStorage, self).__init__(dict)
+        self.compact = set(compact)
+
+    def __missing__(self, resource):
+        if resource in self.compact:
+            collection = self[resource] = CompactCollection()
+            return collection
+        return super(DictStorage, self).__missing__(resource)
+
+
+def _sql_string(value):
+    return "'{0}'".format(value.replace("'", "''"))
+
+
+def _sql_path(field):
+    """ Return the json_extract path for a (dotted) field, None if
+    the field can't be used in a path. """
+    if any(c in field for c in '"\\{}'):
+        return None
+    if any(ord(c) > 127 for c in field):
+        # Keys are stored escaped ("\u00e9"), and json_extract
+        # only matches them verbatim
+        return None
+    keys = field.split(".")
+    if any(key.isdigit() for key in keys):
+        # Array indexes are looked up in Python
+        return None
+    return _sql_string("$" + "".join('."{0}"'.format(key) for key in keys))
+
+
+# JSON types matching a value with Python equality
+# (True == 1, json_extract returns 1 for true)
+_SQL_NUMBERS = "('integer', 'real', 'true', 'false')"
+
+
+def _sql_in(path, values):
+    """ Return (sql, params) testing a field equals one of the values,
+    None if a value can't be compared in SQL (objects and arrays). """
+    numbers = []
+    strings = []
+    null = False
+    for val in values:
+        if val is None:
+            null = True
+        elif isinstance(val, (bool, int, long, float)):
+            numbers.append(val)
+        elif isinstance(val, basestring):
+            strings.append(val)
+        else:
+            return None
+    conditions = []
+    sql = "(json_type(doc, {0}) IN {1} AND json_extract(doc, {0}) {2})"
+    for types, vals in ((_SQL_NUMBERS, numbers), ("('text')", strings)):
+        if len(vals) == 1:
+            conditions.append(sql.format(path, types, "= ?"))
+        elif vals:
+            conditions.append(sql.format(
+                path, types, "IN ({0})".format(", ".join("?" * len(vals)))))
+    if null:
+        conditions.append("json_type(doc, {0}) = 'null'".format(path))
+    if not conditions:
+        return "0", []
+    return "({0})".format(" OR ".join(conditions)), numbers + strings
+
+
+_SQL_RANGES = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def sql_where(plan):
+    """ Translate a QueryPlan into a SQL condition on the doc column,
+    return (sql, params), or None if the query can't be translated.
+
+    Equality, $ne, $in and $nin match like the Python predicates,
+    ranges only compare numbers with numbers and strings with strings
+    (like MongoDB, not Python 2 mixed type comparisons), $regex
+    calls the eve_regexp function registered by SQLiteStorage.
+
+    """
+    params = []
+    sql = _sql_query(plan.query, params)
+    if sql is None:
+        return None
+    return sql, params
+
+
+def _sql_query(q, params):
+    """ Translate a query into a SQL condition, appending its params,
+    return None if the query can't be translated. """
+    conditions = []
+    for field, f in q.items():
+        if field in ("$and", "$or"):
+            subqueries = [_sql_query(sub, params) for sub in f]
+            if None in subqueries:
+                return None
+            joiner = " AND " if field == "$and" else " OR "
+            conditions.append("({0})".format(joiner.join(subqueries)))
+            continue
+        path = _sql_path(field)
+        if path is None or field in DATE_FIELDS:
+            # Dates are compared in Python
+            return None
+        sql = _sql_field(path, f, params)
+        if sql is None:
+            return None
+        conditions.extend(sql)
+    return " AND ".join(conditions) or "1"
+
+
+def _sql_field(path, f, params):
+    """ Translate the test of a field, return a list of conditions. """
+    if not isinstance(f, dict):
+        ops = [("$eq", f)]
+    elif not any(op.startswith("$") for op in f):
+        # Embedded document equality
+        return None
+    elif "$exists" in f and not f["$exists"]:
+        # The other operators are ignored, like in FieldTest
+        return ["json_type(doc, {0}) IS NULL".format(path)]
+    else:
+        ops = f.items()
+    present = "json_type(doc, {0}) IS NOT NULL".format(path)
+    conditions = []
+    for op, val in ops:
+        if op in ("$eq", "$ne", "$in", "$nin"):
+            if op in ("$eq", "$ne"):
+                val = [val]
+            test = _sql_in(path, val)
+            if test is None:
+                return None
+            if op in ("$eq", "$in"):
+                conditions.append(test[0])
+            else:
+                conditions.append("({0} AND NOT {1})".format(present, test[0]))
+            params.extend(test[1])
+        elif op in _SQL_RANGES:
+            if isinstance(val, bool) or \
+                    not isinstance(val, (int, long, float, basestring)):
+                return None
+            types = "('text')" if isinstance(val, basestring) \
+                else "('integer', 'real')"
+            sql = "(json_type(doc, {0}) IN {1} AND json_extract(doc, {0}) {2} ?)"
+            conditions.append(sql.format(path, types, _SQL_RANGES[op]))
+            params.append(val)
+        elif op == "$exists":
+            conditions.append(present)
+        elif op == "$regex":
+            sql = ("(json_type(doc, {0}) = 'text' AND "
+                   "eve_regexp(?, ?, json_extract(doc, {0})))")
+            conditions.append(sql.format(path))
+            params.extend([val, f.get("$options", "")])
+    return conditions
+
+
+def _sql_regexp(pattern, options, value):
+    """ eve_regexp SQL function, used to translate $regex. """
+    return compile_regex(pattern, options).search(value) is not None
+
+
+def sql_order(spec):
+    """ Translate a sort spec into an ORDER BY clause, None if it can't
+    be translated, items lacking a field are sorted first. """
+    terms = []
+    for field, direction in spec:
+        path = _sql_path(field)
+        if path is None or field in DATE_FIELDS:
+            return None
+        terms.append("json_extract(doc, {0}){1}".format(
+            path, " DESC" if direction == -1 else ""))
+    terms.append("rowid" + (" DESC" if spec[-1][1] == -1 else ""))
+    return ", ".join(terms)
+
+
+class Document(dict):
+    """ An item decoded from its stored JSON, which is reused
+    to encode it (see SQLiteStorage). """
+    __slots__ = ("json",)
+
+
+def _load_document(data):
+    item = Document(json.loads(data))
+    # SQLite returns unicode, responses bodies are str
+    item.json = data.encode("utf-8") if isinstance(data, unicode) else data
+    return item
+
+
+class SQLiteCollection(MutableMapping):
+    """ A resource stored in a SQLite table (pk, doc), items are
+    stored as JSON and decoded on every access.
+
+    :type storage: SQLiteStorage
+    :param storage: Storage holding the table
+
+    :type table: str
+    :param table: Table name
+
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, storage, table):
+        self.storage = storage
+        self.table = table
+        self.detached = False
+
+    def execute(self, sql, params=()):
+        return self.storage.execute(sql.format(table='"{0}"'.format(self.table)),
+                                    params)
+
+    def get(self, pk, default=None):
+        rows = self.execute("SELECT doc FROM {table} WHERE pk = ?", (pk,))
+        return _load_document(rows[0][0]) if rows else default
+
+    def __getitem__(self, pk):
+        item = self.get(pk)
+        if item is None:
+            raise KeyError(pk)
+        return item
+
+    def __setitem__(self, pk, item):
+        self.update([(pk, item)])
+
+    def __delitem__(self, pk):
+        with self.storage.lock:
+            if pk not in self:
+                raise KeyError(pk)
+            self.execute("DELETE FROM {table} WHERE pk = ?", (pk,))
+
+    def pop(self, pk, *default):
+        with self.storage.lock:
+            item = self.get(pk)
+            if item is None:
+                if default:
+                    return default[0]
+                raise KeyError(pk)
+            self.execute("DELETE FROM {table} WHERE pk = ?", (pk,))
+            return item
+
+    def __contains__(self, pk):
+        return bool(self.execute("SELECT 1 FROM {table} WHERE pk = ?", (pk,)))
+
+    def __len__(self):
+        return self.execute("SELECT count(*) FROM {table}")[0][0]
+
+    def _batches(self, columns):
+        """ Iterate over the rows in batches, without keeping
+        a cursor open between batches. """
+        rowid = -sys.maxint
+        while True:
+            rows = self.execute("SELECT rowid, {0} FROM {{table}} WHERE rowid > ? "
+                                "ORDER BY rowid LIMIT ?".format(columns),
+                                (rowid, self.BATCH_SIZE))
+            for row in rows:
+                yield row[1:]
+            if len(rows) < self.BATCH_SIZE:
+                return
+            rowid = rows[-1][0]
+
+    def __iter__(self):
+        return (pk for pk, in self._batches("pk"))
+
+    def iteritems(self):
+        return ((pk, _load_document(doc)) for pk, doc in self._batches("pk, doc"))
+
+    def itervalues(self):
+        return (_load_document(doc) for doc, in self._batches("doc"))
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, items):
+        """ Insert or replace (pk, item) pairs in a single transaction. """
+        if isinstance(items, dict):
+            items = items.iteritems()
+        rows = ((pk, json.dumps(item)) for pk, item in items)
+        with self.storage.transaction():
+            self.storage.conn.executemany(
+                'INSERT INTO "{0}" (pk, doc) VALUES (?, ?) '
+                "ON CONFLICT(pk) DO UPDATE SET doc = excluded.doc".format(self.table),
+                rows)
+
+    def clear(self):
+        """ Remove all the items, the table of a dropped
+        collection is dropped. """
+        if self.detached:
+            self.execute("DROP TABLE IF EXISTS {table}")
+        else:
+            self.execute("DELETE FROM {table}")
+
+
+class SQLiteStorage(object):
+    """ SQLite storage engine, for datasets larger than memory, every
+    resource is a table of JSON documents, ?where and ?sort are
+    translated to SQL (see sql_where) and indexes are expression
+    indexes on the documents.
+
+    A storage file can be reused, resources (and their indexes)
+    are loaded from the file.
+
+    :type path: str
+    :param path: Database file, in memory by default
+
+    """
+    CATALOG = "eve_mocker_resources"
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        try:
+            self.execute("SELECT json_extract('{}', '$.a')")
+        except sqlite3.OperationalError:
+            raise RuntimeError("SQLite {0} lacks the JSON functions".format(
+                sqlite3.sqlite_version))
+        self.conn.create_function("eve_regexp", 3, _sql_regexp)
+        # Durability is not needed in a mock
+        self.execute("PRAGMA synchronous = OFF")
+        self.execute("PRAGMA journal_mode = MEMORY")
+        self.execute("CREATE TABLE IF NOT EXISTS {0} "
+                     "(resource PRIMARY KEY, tbl TEXT NOT NULL)".format(self.CATALOG))
+        self.collections = {}
+        # Indexed fields of each resource, kept when a resource is dropped
+        self.indexed = defaultdict(set)
+        for resource, table in self.execute("SELECT resource, tbl FROM {0}".format(
+                self.CATALOG)):
+            self.collections[resource] = SQLiteCollection(self, table)
+            for name, in self.execute("SELECT name FROM sqlite_master WHERE "
+                                      "type = 'index' AND tbl_name = ?", (table,)):
+                if name.startswith(table + ":"):
+                    self.indexed[resource].add(name[len(table) + 1:])
+        # Tables of resources dropped by a previous run
+        tables = set(collection.table for collection in self.collections.values())
+        for table, in self.execute("SELECT name FROM sqlite_master WHERE "
+                                   "type = 'table' AND name LIKE 'r\\_%' ESCAPE '\\'"):
+            if table not in tables:
+                self.execute('DROP TABLE "{0}"'.format(table))
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def __getitem__(self, resource):
+        with self.lock:
+            collection = self.collections.get(resource)
+            if collection is None:
+                collection = SQLiteCollection(self, "r_" + uuid.uuid4().hex)
+                with self.transaction():
+                    collection.execute("CREATE TABLE {table} "
+                                       "(pk PRIMARY KEY, doc TEXT NOT NULL)")
+                    self.execute("INSERT INTO {0} VALUES (?, ?)".format(self.CATALOG),
+                                 (resource, collection.table))
+                self.collections[resource] = collection
+                for field in self.indexed[resource]:
+                    self._create_index(collection, field)
+            return collection
+
+    def __setitem__(self, resource, items):
+        """ Restore a dropped collection, or replace the
+        resource items with a mapping pk => item. """
+        with self.lock:
+            self.pop(resource, None)
+            if isinstance(items, SQLiteCollection) and items.storage is self:
+                self.execute("INSERT INTO {0} VALUES (?, ?)".format(self.CATALOG),
+                             (resource, items.table))
+                items.detached = False
+                self.collections[resource] = items
+                for field in self.indexed[resource]:
+                    self._create_index(items, field)
+            else:
+                self[resource].update(items)
+
+    def __contains__(self, resource):
+        return resource in self.collections
+
+    def __iter__(self):
+        return iter(self.collections.keys())
+
+    def keys(self):
+        return self.collections.keys()
+
+    def pop(self, resource, default=None):
+        """ Drop a resource, its table is kept until the returned
+        collection is cleared, or restored. """
+        with self.lock:
+            collection = self.collections.pop(resource, None)
+            if collection is None:
+                return default
+            self.execute("DELETE FROM {0} WHERE resource = ?".format(self.CATALOG),
+                         (resource,))
+            collection.detached = True
+            return collection
+
+    def clear(self):
+        with self.lock:
+            for resource in self.keys():
+                self.pop(resource).clear()
+
+    def _create_index(self, collection, field):
+        collection.execute('CREATE INDEX IF NOT EXISTS "{0}:{1}" ON {{table}} '
+                           "(json_extract(doc, {2}))".format(
+                               collection.table, field.replace('"', '""'),
+                               _sql_path(field)))
+
+    def create_index(self, resource, field, kind="hash"):
+        """ Create an expression index on a field, for both
+        kinds of index. """
+        if _sql_path(field) is None:
+            raise ValueError("Can't index field: {0!r}".format(field))
+        with self.lock:
+            self.indexed[resource].add(field)
+            self._create_index(self[resource], field)
+
+    def drop_index(self, resource, field):
+        with self.lock:
+            self.indexed[resource].discard(field)
+            self.execute('DROP INDEX IF EXISTS "{0}:{1}"'.format(
+                self[resource].table, field.replace('"', '""')))
+
+    def find(self, resource, plan=None, spec=None, offset=0, limit=None):
+        """ Return the items matching the query plan, sorted and
+        paginated, None if the query can't be translated. """
+        where = sql_where(plan) if plan is not None else ("1", [])
+        order = sql_order(spec) if spec else "rowid"
+        if where is None or order is None:
+            return None
+        sql, params = where
+        rows = self[resource].execute(
+            "SELECT doc FROM {{table}} WHERE {0} ORDER BY {1} "
+            "LIMIT ? OFFSET ?".format(sql, order),
+            params + [-1 if limit is None else limit, offset])
+        return [_load_document(doc) for doc, in rows]
+
+    def count(self, resource, plan=None):
+        """ Return the number of items matching the query plan,
+        None if the query can't be translated. """
+        where = sql_where(plan) if plan is not None else ("1", [])
+        if where is None:
+            return None
+        sql, params = where
+        return self[resource].execute(
+            "SELECT count(*) FROM {{table}} WHERE {0}".format(sql), params)[0][0]
+
+
+class Clock(object):
+    """ Real time clock, pending sleeps can be cancelled. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        """ Sleep for the given seconds, return False if cancelled. """
+        if seconds <= 0:
+            return True
+        with self._lock:
+            cancelled = self._cancelled
+        return not cancelled.wait(seconds)
+
+    def cancel(self):
+        """ Wake up all the pending sleeps. """
+        with self._lock:
+            cancelled, self._cancelled = self._cancelled, threading.Event()
+        cancelled.set()
+
+
+class VirtualClock(object):
+    """ Clock that only advances when sleeping (or with advance),
+    sleeps return immediately, to test timing logic without waiting.
+
+    :type now: float
+    :param now: Initial time
+
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += max(seconds, 0)
+        return True
+
+    def advance(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+    def cancel(self):
+        pass
+
+
+def fixed_latency(seconds):
+    """ Latency distribution always returning seconds. """
+    return lambda rng: seconds
+
+
+def uniform_latency(low, high):
+    """ Latency distribution uniform between low and high seconds. """
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma):
+    """ Log-normal latency distribution, with a long tail
+    of slow responses like real services.
+
+    :type median: float
+    :param median: Median latency in seconds
+
+    :type sigma: float
+    :param sigma: Standard deviation of the latency logarithm
+
+    """
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+# Statuses of injected errors (Retry-After is sent with 429 and 503)
+ERROR_STATUSES = (500, 502, 503, 429)
+
+RETRY_AFTER_STATUSES = (429, 503)
+
+
+class Conditions(object):
+    """ Simulated network and server conditions for the responses
+    of a mocker, see EveMocker.set_conditions.
+
+    :type latency: float or callable
+    :param latency: Latency in seconds, or a distribution
+        (fixed_latency, uniform_latency, lognormal_latency),
+        any callable taking a random.Random.
+
+    :type bandwidth: float
+    :param bandwidth: Bandwidth in bytes per second, the time to
+        transfer the response body is added to the latency.
+
+    :type error_rate: float
+    :param error_rate: Probability of an error response, the request
+        is not handled (the store is not modified).
+
+    :type error_statuses: tuple
+    :param error_statuses: Status codes of the errors, picked at random.
+
+    :type retry_after: int
+    :param retry_after: Retry-After header (seconds) of 429 and 503 errors.
+
+    :type seed: int
+    :param seed: Seed of the random generator, for reproducible runs.
+
+    """
+    def __init__(self, latency=None, bandwidth=None, error_rate=0,
+                 error_statuses=ERROR_STATUSES, retry_after=1, seed=None):
+        if isinstance(latency, (int, long, float)):
+            latency = fixed_latency(latency)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+    def delay(self, size=0):
+        """ Return the delay (seconds) of a response with a body
+        of the given size. """
+        delay = max(self.latency(self.random), 0) if self.latency else 0
+        if self.bandwidth:
+            delay += float(size) / self.bandwidth
+        return delay
+
+    def error(self):
+        """ Return the status code of an injected error, None if
+        the request must be handled. """
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.random.choice(self.error_statuses)
+
+
+def parse_accept_encoding(header):
+    """ Return the preferred content coding (see CONTENT_CODINGS)
+    accepted by an Accept-Encoding header, None if the body
+    must be sent as is. """
+    if not header:
+        return None
+    qvalues = {}
+    for coding in header.split(","):
+        coding, _, params = coding.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip().lower()] = q
+    best, best_q = None, 0
+    for coding in CONTENT_CODINGS:
+        q = qvalues.get(coding, qvalues.get("*", 0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress_chunks(chunks, coding, level=COMPRESS_LEVEL):
+    """ Compress an iterable of chunks with a content coding
+    (gzip or deflate), yielding the compressed chunks. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CONTENT_CODINGS[coding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def join_body(body):
+    """ Return a response body as a str, joining streamed bodies. """
+    if isinstance(body, str):
+        return body
+    return "".join(body)
+
+
+class ChunkReader(object):
+    """ Read-only file object over a streamed body (an iterable
+    of chunks), chunks are only pulled when they're read. """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer + "".join(self.chunks)
+            self.buffer = ""
+            return data
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+# Snapshot header: magic, format version, table of contents offset
+SNAPSHOT_MAGIC = "EVEMOCK\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct(">8sIQ")
+
+
+class Snapshot(object):
+    """ A snapshot file written by EveMocker.save_snapshot, the file
+    is memory mapped and each resource is a separate pickle, only
+    decoded when the resource is first used (see load).
+
+    Raise ValueError if the file isn't a snapshot of this version.
+
+    :type path: str
+    :param path: Snapshot file
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+                raise ValueError("Not a snapshot: {0}".format(path))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, toc_offset = SNAPSHOT_HEADER.unpack_from(self.mmap)
+        if magic != SNAPSHOT_MAGIC:
+            self.close()
+            raise ValueError("Not a snapshot: {0}".format(path))
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError("Unsupported snapshot version {0}: {1}".format(
+                version, path))
+        toc = cPickle.loads(self.mmap[toc_offset:])
+        self.pk_maps = toc["pk_maps"]
+        self.default_pk = toc["default_pk"]
+        self.etag = toc["etag"]
+        self.etag_counter = toc["etag_counter"]
+        # resource => (offset, length)
+        self.resources = toc["resources"]
+        # Resources not decoded yet
+        self.pending = set(self.resources)
+
+    def __contains__(self, resource):
+        return resource in self.pending
+
+    def raw(self, resource):
+        """ Return the pickled state of a resource. """
+        offset, length = self.resources[resource]
+        return self.mmap[offset:offset + length]
+
+    def load(self, resource):
+        """ Decode the state of a resource, a dict with its items,
+        indexes, changelog and version. """
+        state = cPickle.loads(self.raw(resource))
+        if state["marshal"]:
+            state["items"] = marshal.loads(state["items"])
+        return state
+
+    def close(self):
+        self.pending = set()
+        self.mmap.close()
+
+
+class EveMocker(object):
+    """ Eve API mocker
+
+    Everything is stored in self.items, in memory by default
+    (see DictStorage and SQLiteStorage).
+
+    Support:
+        - All methods, including HEAD and OPTIONS
+        - Handle etags
+        - Return good status_code
+
+    Not (yet?) supported:
+        - HATEOAS links (only returned when paginating)
+        - schema validation
+
+    :type base_url: str
+    :param base_url: API base url
+
+    :type pk_maps: dict
+    :param pk_maps: Primary key mapping {resource: pk}
+
+    :type default_pk: str
+    :param default_pk: Default primary key, _id by default.
+
+    :type json_cache_size: int
+    :param json_cache_size: Maximum number of JSON encoded items to cache.
+
+    :type etag_strategy: str or callable
+    :param etag_strategy: "counter" (default) for a monotonic counter,
+        "hash" for a content hash, or a callable taking the item.
+
+    :type instrument: bool
+    :param instrument: Record requests counts, latency histograms
+        and the recent requests (see stats and self.requests).
+
+    :type request_log_size: int
+    :param request_log_size: Number of recent requests to keep.
+
+    :type storage: DictStorage or SQLiteStorage
+    :param storage: Storage engine, a DictStorage by default.
+
+    :type clock: Clock or VirtualClock
+    :param clock: Clock used for the simulated conditions,
+        the instrumentation and the dates, a real Clock by default.
+
+    :type timestamps: bool
+    :param timestamps: Set _created and _updated (RFC 1123 dates)
+        on set_resource, load_resource, POST and PATCH, like Eve.
+
+    :type stream: bool
+    :param stream: Return the list GETs of more than STREAM_BATCH_SIZE
+        items as an iterator of chunks (see iter_items), instead of
+        a str, the server sends them with chunked transfer encoding.
+
+    :type compress: bool
+    :param compress: Compress the responses with gzip or deflate
+        when the client accepts it (Accept-Encoding).
+
+    """
+    def __init__(self, base_url, pk_maps={}, default_pk="_id",
+                 json_cache_size=10000, etag_strategy="counter",
+                 instrument=False, request_log_size=1000, storage=None,
+                 clock=None, timestamps=False, stream=False, compress=False):
+        self.items = DictStorage() if storage is None else storage
+        self.clock = Clock() if clock is None else clock
+        self.timestamps = timestamps
+        self.stream = stream
+        self.compress = compress
+        # (resource, method) => Conditions
+        self.conditions = {}
+        self.base_url = base_url
+        self.default_pk = default_pk
+        self.pk_maps = pk_maps
+        self.etag = {}
+        self.indexes = defaultdict(dict)
+        self.json_cache = LRUCache(json_cache_size)
+        if callable(etag_strategy):
+            self.generate_etag = etag_strategy
+        elif etag_strategy in ETAG_STRATEGIES:
+            self.generate_etag = ETAG_STRATEGIES[etag_strategy]
+        else:
+            raise ValueError("Unknown etag strategy: {0}".format(etag_strategy))
+        # Bumped on every write, used for collection etags
+        self.versions = defaultdict(int)
+        # resource => ChangeLog, built on first use
+        self.changelogs = {}
+        self._changelogs_lock = threading.Lock()
+        # Snapshot with resources not loaded yet (see from_snapshot)
+        self.snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._etag_token = uuid.uuid4().hex
+        # Undo journal of (resource, pk, old item), only kept
+        # once a savepoint has been taken
+        self._journal = None
+        self._journal_id = None
+        # Per resource reader/writer locks, savepoint, rollback, reset
+        # and save_snapshot lock all of them (see store_locked)
+        self.locks = {}
+        self._locks_lock = threading.Lock()
+
+        base_path = urlsplit(self.base_url).path
+        self.base_path = base_path if base_path.endswith("/") else base_path + "/"
+        # (method, resource or item) => (handler, write lock needed)
+        self.routes = {
+            ("GET", RESOURCE): (self.get_resource_response, False),
+            ("HEAD", RESOURCE): (self.get_resource_response, False),
+            ("POST", RESOURCE): (self.post_resource_response, True),
+            ("DELETE", RESOURCE): (self.delete_resource_response, True),
+            ("GET", ITEM): (self.get_item_response, False),
+            ("HEAD", ITEM): (self.get_item_response, False),
+            ("PATCH", ITEM): (self.patch_item_response, True),
+            ("DELETE", ITEM): (self.delete_item_response, True),
+        }
+        self.allowed_methods = defaultdict(list)
+        for method, kind in sorted(self.routes):
+            self.allowed_methods[kind].append(method)
+        for methods in self.allowed_methods.values():
+            methods.append("OPTIONS")
+
+        # Instrumentation, profile_hook is called with the request
+        # log entry and the cProfile.Profile of each request
+        self.instrument = instrument
+        self.profile_hook = None
+        self.requests = deque(maxlen=request_log_size)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+        ROUTER.mount(self)
+
+    def __enter__(self):
+        HTTPretty.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.clock.cancel()
+        HTTPretty.disable()
+
+    def split_path(self, path):
+        """ Split a request path into its parts relative to the base url,
+        [resource] or [resource, item_id]. """
+        path = urlsplit(path).path
+        if not path.startswith(self.base_path):
+            return []
+        return [part for part in path[len(self.base_path):].split("/") if part]
+
+    @contextmanager
+    def locked(self, resource, write=False):
+        """ Lock a resource for reading (shared) or writing (exclusive),
+        locks are reentrant within a thread.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type write: bool
+        :param write: Acquire the write lock
+
+        """
+        # Read once, another thread may drop the snapshot meanwhile
+        snapshot = self.snapshot
+        if snapshot is not None and resource in snapshot:
+            self._load_snapshot(resource)
+        lock = self.locks.get(resource)
+        if lock is None:
+            with self._locks_lock:
+                lock = self.locks.setdefault(resource, RWLock())
+        if write:
+            lock.acquire_write()
+        else:
+            lock.acquire_read()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @contextmanager
+    def store_locked(self):
+        """ Lock the whole store, every resource is locked for writing,
+        and no new resource lock can be created meanwhile. """
+        with self._locks_lock:
+            locks = [lock for _, lock in sorted(self.locks.items())]
+            acquired = []
+            try:
+                for lock in locks:
+                    lock.acquire_write()
+                    acquired.append(lock)
+                with self._snapshot_lock:
+                    yield
+            finally:
+                for lock in reversed(acquired):
+                    lock.release()
+
+    def get_pk(self, resource):
+        return self.pk_maps.get(resource, self.default_pk)
+
+    def create_index(self, resource, field, kind="hash"):
+        """ Create (or replace) a secondary index on a resource field,
+        used to speed up ?where queries.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type field: str
+        :param field: Field to index
+
+        :type kind: str
+        :param kind: "hash" for equality and $in,
+            "sorted" for $gt, $gte, $lt and $lte ranges.
+
+        Storage engines indexing fields themselves (SQLiteStorage)
+        create the index, and None is returned.
+
+        """
+        if kind not in INDEXES:
+            raise ValueError("Unknown index kind: {0}".format(kind))
+        with self.locked(resource, write=True):
+            if hasattr(self.items, "create_index"):
+                return self.items.create_index(resource, field, kind)
+            index = INDEXES[kind](field)
+            index.add_many(self.items[resource].iteritems())
+            self.indexes[resource][field] = index
+            return index
+
+    def drop_index(self, resource, field):
+        """ Remove the index on a resource field. """
+        with self.locked(resource, write=True):
+            if hasattr(self.items, "drop_index"):
+                self.items.drop_index(resource, field)
+            self.indexes[resource].pop(field, None)
+
+    def now(self):
+        """ Return the current date (RFC 1123), from the mocker clock. """
+        return format_date(self.clock.time())
+
+    def _modified(self, item, now=None):
+        """ Return the modification time of an item, its _updated
+        date, or now (the current time by default) if it has none. """
+        t = _date_value(item["_updated"]) if "_updated" in item else None
+        if t is None:
+            t = int(self.clock.time()) if now is None else now
+        return t
+
+    def changelog(self, resource):
+        """ Return the ChangeLog of a resource, built from the
+        stored items the first time it's needed (tombstones are only
+        kept from then on), or on the first write with timestamps. """
+        log = self.changelogs.get(resource)
+        if log is None:
+            with self._changelogs_lock:
+                log = self.changelogs.get(resource)
+                if log is None:
+                    log = ChangeLog()
+                    now = int(self.clock.time())
+                    for pk, item in self.items[resource].iteritems():
+                        log.add(pk, self._modified(item, now))
+                    self.changelogs[resource] = log
+        return log
+
+    def _active_changelog(self, resource):
+        """ Return the ChangeLog of a resource if it's kept up to date,
+        None if it's not built yet, so writes don't have to scan
+        the stored items when nothing needs the log. """
+        if self.timestamps:
+            return self.changelog(resource)
+        return self.changelogs.get(resource)
+
+    def _put(self, resource, pk, item):
+        """ Store an item, keeping indexes up to date. """
+        log = self._active_changelog(resource)
+        indexes = self.indexes[resource].values()
+        old = self.items[resource].get(pk)
+        if self._journal is not None:
+            self._journal.append((resource, pk, old))
+        for index in indexes:
+            if old is not None:
+                index.remove(pk, old)
+            index.add(pk, item)
+        self.items[resource][pk] = item
+        if log is not None:
+            log.add(pk, self._modified(item))
+        self.json_cache.pop((resource, pk))
+        self.versions[resource] += 1
+
+    def _put_many(self, resource, items):
+        """ Store items (a list of (pk, item), with unique pks) in
+        a single write, the resource version is bumped once. """
+        log = self._active_changelog(resource)
+        r = self.items[resource]
+        if self._journal is not None:
+            self._journal.extend((resource, pk, r.get(pk)) for pk, item in items)
+        for index in self.indexes[resource].values():
+            for pk, item in items:
+                old = r.get(pk)
+                if old is not None:
+                    index.remove(pk, old)
+            index.add_many(items)
+        r.update(items)
+        now = int(self.clock.time())
+        for pk, item in items:
+            if log is not None:
+                log.add(pk, self._modified(item, now))
+            self.json_cache.pop((resource, pk))
+        self.versions[resource] += 1
+
+    def _pop(self, resource, pk):
+        """ Remove an item, keeping indexes up to date. """
+        log = self._active_changelog(resource)
+        item = self.items[resource].pop(pk)
+        if log is not None:
+            log.add(pk, int(self.clock.time()), deleted=True)
+        if self._journal is not None:
+            self._journal.append((resource, pk, item))
+        for index in self.indexes[resource].values():
+            index.remove(pk, item)
+        self.json_cache.pop((resource, pk))
+        self.versions[resource] += 1
+        return item
+
+    def _drop(self, resource):
+        """ Remove all the items of a resource, indexes are kept empty. """
+        log = self._active_changelog(resource)
+        r = self.items.pop(resource, {})
+        now = int(self.clock.time())
+        for pk in r:
+            if log is not None:
+                log.add(pk, now, deleted=True)
+            self.json_cache.pop((resource, pk))
+        if self._journal is not None:
+            self._journal.append((resource, DROPPED, r))
+        else:
+            r.clear()
+        for index in self.indexes[resource].values():
+            index.clear()
+        self.versions[resource] += 1
+
+    def savepoint(self):
+        """ Take a savepoint of the store, to restore it later with
+        rollback, it costs nothing, items are never copied
+        (writes replace items instead of updating them in place).
+
+        :rtype: tuple
+        :return: Savepoint to pass to rollback
+
+        """
+        with self.store_locked():
+            if self._journal is None:
+                self._journal = []
+                self._journal_id = uuid.uuid4().hex
+            return (self._journal_id, len(self._journal))
+
+    def rollback(self, savepoint):
+        """ Restore the store (items, etags, indexes and caches)
+        as it was when the savepoint was taken, only the items
+        written since are touched, the savepoint stays valid.
+
+        :type savepoint: tuple
+        :param savepoint: Savepoint returned by savepoint
+
+        """
+        with self.store_locked():
+            journal_id, position = savepoint
+            if journal_id != self._journal_id or position > len(self._journal):
+                raise ValueError("Invalid savepoint: {0!r}".format(savepoint))
+            journal = self._journal
+            # Restoring must not be journaled
+            self._journal = None
+            try:
+                while len(journal) > position:
+                    resource, pk, old = journal.pop()
+                    if pk is DROPPED:
+                        self._restore(resource, old)
+                    elif old is None:
+                        self._pop(resource, pk)
+                    else:
+                        self._put(resource, pk, old)
+            finally:
+                self._journal = journal
+
+    def _restore(self, resource, items):
+        """ Restore all the items of a dropped resource. """
+        self.items[resource] = items
+        log = self._active_changelog(resource)
+        now = int(self.clock.time())
+        if log is not None:
+            for pk, item in items.iteritems():
+                log.add(pk, self._modified(item, now))
+        for index in self.indexes[resource].values():
+            index.clear()
+            index.add_many(items.iteritems())
+        self.versions[resource] += 1
+
+    def reset(self):
+        """ Empty the store in O(1), index definitions are kept,
+        and savepoints are invalidated. """
+        with self.store_locked():
+            self.items.clear()
+            self.changelogs.clear()
+            if self.snapshot is not None:
+                self.snapshot.close()
+                self.snapshot = None
+            for indexes in self.indexes.values():
+                for index in indexes.values():
+                    index.clear()
+            self.json_cache.clear()
+            # New collection etags for every resource
+            self._etag_token = uuid.uuid4().hex
+            self._journal = None
+            self._journal_id = None
+
+    @classmethod
+    def from_snapshot(cls, base_url, path, **kwargs):
+        """ Create a mocker from a snapshot file (see save_snapshot),
+        the file is memory mapped, and resources are only decoded
+        when they are first used (self.items only holds the
+        resources loaded so far, use get_resource).
+
+        :type base_url: str
+        :param base_url: API base url
+
+        :type path: str
+        :param path: Snapshot file
+
+        :param kwargs: Other EveMocker arguments, pk_maps and
+            default_pk default to the ones of the snapshot.
+
+        """
+        snapshot = Snapshot(path)
+        kwargs.setdefault("pk_maps", snapshot.pk_maps)
+        kwargs.setdefault("default_pk", snapshot.default_pk)
+        mocker = cls(base_url, **kwargs)
+        mocker.etag.update(snapshot.etag)
+        # New etags must not collide with the stored ones
+        _advance_etag_counter(snapshot.etag_counter)
+        if snapshot.pending:
+            mocker.snapshot = snapshot
+        else:
+            snapshot.close()
+        return mocker
+
+    def save_snapshot(self, path):
+        """ Save the whole store (items with their etags, indexes,
+        change logs and pk_maps) into a binary snapshot file,
+        one pickle per resource, see from_snapshot.
+
+        The file is replaced atomically, resources of the snapshot
+        the mocker was created from which haven't been loaded
+        are copied without being decoded.
+
+        :type path: str
+        :param path: Snapshot file
+
+        """
+        with self.store_locked():
+            snapshot = self.snapshot
+            resources = set(self.items.keys())
+            if snapshot is not None:
+                resources |= snapshot.pending
+            toc = {}
+            tmp = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+            with open(tmp, "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0))
+                for resource in sorted(resources):
+                    if snapshot is not None and resource in snapshot:
+                        data = snapshot.raw(resource)
+                    else:
+                        data = cPickle.dumps(self._snapshot_state(resource),
+                                             cPickle.HIGHEST_PROTOCOL)
+                    toc[resource] = (f.tell(), len(data))
+                    f.write(data)
+                toc_offset = f.tell()
+                cPickle.dump({"resources": toc,
+                              "pk_maps": self.pk_maps,
+                              "default_pk": self.default_pk,
+                              "etag": self.etag,
+                              "etag_counter": next(_etag_counter)},
+                             f, cPickle.HIGHEST_PROTOCOL)
+                f.seek(0)
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                             toc_offset))
+            os.rename(tmp, path)
+
+    def _snapshot_state(self, resource):
+        """ Return the state of a resource saved in a snapshot. """
+        items = self.items[resource]
+        if not isinstance(items, (dict, CompactCollection)):
+            # Collections of other storage engines are saved as dicts
+            items = dict((pk, dict(item)) for pk, item in items.iteritems())
+        encoded = False
+        if type(items) is dict:
+            # JSON items are faster to save and load with marshal
+            try:
+                items = marshal.dumps(items)
+                encoded = True
+            except ValueError:
+                pass
+        return {"items": items,
+                "marshal": encoded,
+                "indexes": self.indexes.get(resource, {}),
+                "changelog": self.changelogs.get(resource),
+                "version": self.versions[resource]}
+
+    def _load_snapshot(self, resource):
+        """ Decode a resource of the snapshot, on first use. """
+        with self._snapshot_lock:
+            snapshot = self.snapshot
+            if snapshot is None or resource not in snapshot:
+                return
+            state = snapshot.load(resource)
+            if isinstance(self.items, DictStorage):
+                self.items[resource] = state["items"]
+            else:
+                self.items[resource].update(state["items"].iteritems())
+            for field, index in state["indexes"].items():
+                if hasattr(self.items, "create_index"):
+                    self.items.create_index(resource, field, index.kind)
+                else:
+                    self.indexes[resource][field] = index
+            if state["changelog"] is not None:
+                self.changelogs[resource] = state["changelog"]
+            self.versions[resource] += state["version"]
+            # Only visible once installed
+            snapshot.pending.discard(resource)
+            if not snapshot.pending:
+                snapshot.close()
+                self.snapshot = None
+
+    def get_etag(self, resource, item):
+        """ Return the etag of an item, items set without
+        an etag get the hash of their JSON representation. """
+        if "etag" in item:
+            return item["etag"]
+        return hashlib.sha1(self.encode_item(resource, item)).hexdigest()
+
+    def collection_etag(self, resource, query=""):
+        """ Return the etag of a resource collection, derived from the
+        resource version, so it changes on every write.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type query: str
+        :param query: Raw querystring, since it changes the response
+
+        """
+        return hashlib.sha1("{0}:{1}:{2}:{3}".format(
+            self._etag_token, resource,
+            self.versions[resource], query)).hexdigest()
+
+    def encode_item(self, resource, item, projection=None):
+        """ Return the JSON encoded item, encoded items are cached
+        until their etag changes (or the item is replaced).
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type item: dict
+        :param item: Item to encode
+
+        :type projection: tuple
+        :param projection: Fields to include or exclude, as returned
+            by parse_projection, the pk and etag are always included.
+
+        """
+        if projection is None and isinstance(item, Document):
+            return item.json
+        pk = self.get_pk(resource)
+        key = (resource, item[pk])
+        if projection is not None:
+            key += (projection,)
+        etag = item.get("etag")
+        # Items of compact and SQLite collections are materialized on
+        # every access, their entries are only checked by etag (writes
+        # evict them), and don't keep the item alive
+        if isinstance(self.items, DictStorage) and \
+                resource not in self.items.compact:
+            ref = item
+        else:
+            ref = None
+        cached = self.json_cache.get(
+            key, valid=lambda cached: cached[0] is ref and cached[1] == etag)
+        if cached is not None:
+            return cached[2]
+        if projection is None:
+            data = json.dumps(item)
+        else:
+            data = self.encode_fields(item, pk, projection)
+        self.json_cache.set(key, (ref, etag, data))
+        return data
+
+    def encode_fields(self, item, pk, projection):
+        """ JSON encode only the projected fields of an item,
+        see fields_encoder. """
+        return fields_encoder(pk, projection)(item)
+
+    def encode_items(self, resource, items, projection=None, **extra):
+        """ Return the JSON encoded {"_items": items}, extra keys are
+        added to the response. """
+        return "".join(['{"_items": [',
+                        self._encode_list(resource, items, projection),
+                        "]",
+                        self._encode_extra(extra)])
+
+    def _encode_list(self, resource, items, projection):
+        """ JSON encode a list of items, without the brackets.
+
+        Items are encoded in a single json.dumps call, the JSON cache
+        is only used by item GETs: joining cached encodings costs
+        more than encoding the whole list at once. """
+        if not isinstance(self.items, DictStorage):
+            # Documents reuse their stored JSON
+            return ", ".join([self.encode_item(resource, item, projection)
+                              for item in items])
+        if projection is not None:
+            encode = fields_encoder(self.get_pk(resource), projection)
+            return ", ".join([encode(item) for item in items])
+        return json.dumps(items)[1:-1]
+
+    def iter_items(self, resource, items, projection=None, **extra):
+        """ Encode {"_items": items} like encode_items, yielding
+        a chunk for every STREAM_BATCH_SIZE items, so the whole
+        response is never held in memory. """
+        yield '{"_items": ['
+        items = iter(items)
+        sep = ""
+        while True:
+            batch = list(islice(items, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            yield sep + self._encode_list(resource, batch, projection)
+            sep = ", "
+        yield "]" + self._encode_extra(extra)
+
+    def _encode_extra(self, extra):
+        out = []
+        for k, v in extra.items():
+            out.append(", {0}: {1}".format(json.dumps(k), json.dumps(v)))
+        out.append("}")
+        return "".join(out)
+
+    def find(self, resource, q, since=None):
+        """ Retrieve items for a resource matching a MongoDB query,
+        using indexes (if any) to narrow the candidates
+        before running query_data.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type q: dict or QueryPlan
+        :param q: MongoDB Query
+
+        :type since: int
+        :param since: Only the items changed after this timestamp
+
+        """
+        if not isinstance(q, QueryPlan):
+            q = QueryPlan(q)
+        with self.locked(resource):
+            if hasattr(self.items, "find") and since is None:
+                items = self.items.find(resource, q)
+                if items is not None:
+                    return items
+            r = self.items[resource]
+            candidates = None
+            # Only the items changed since the date are tested
+            for ops in ({"$gt": since} if since is not None else None,
+                        q.dates.get("_updated")):
+                pks = self.changelog(resource).lookup(ops) if ops else None
+                if pks is None:
+                    continue
+                candidates = pks if candidates is None else candidates & pks
+                if not candidates:
+                    return []
+            for field, index in self.indexes[resource].items():
+                if field not in q.clauses:
+                    continue
+                pks = index.lookup(q.clauses[field])
+                if pks is None:
+                    continue
+                candidates = pks if candidates is None else candidates & pks
+                if not candidates:
+                    return []
+            if hasattr(r, "find"):
+                return r.find(q, candidates)
+            if candidates is None:
+                return q(r.itervalues())
+            return q(r[pk] for pk in candidates)
+
+    def query(self, resource, q=None, spec=None, offset=0, limit=None,
+              since=None):
+        """ Retrieve a page of the items of a resource matching a query,
+        sorted, the storage engine answers it when it can.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type q: QueryPlan
+        :param q: MongoDB Query, all the items if None
+
+        :type spec: list
+        :param spec: Sort spec, list of (field, direction)
+
+        :type since: int
+        :param since: Only the items changed after this timestamp
+
+        :rtype: tuple
+        :return: (total number of matching items, items of the page)
+
+        """
+        with self.locked(resource):
+            if hasattr(self.items, "find") and since is None:
+                items = self.items.find(resource, q, spec, offset, limit)
+                if items is not None:
+                    if not offset and (limit is None or len(items) < limit):
+                        return len(items), items
+                    return self.items.count(resource, q), items
+            if q is None and since is None:
+                items = self.get_resource(resource)
+            else:
+                items = self.find(resource, QueryPlan({}) if q is None else q,
+                                  since)
+            total = len(items)
+            end = None if limit is None else offset + limit
+            if spec:
+                # Only the items up to the requested page need to be sorted
+                items = self.sort(resource, items, spec, end)
+            if offset or end is not None:
+                items = items[offset:end]
+            return total, items
+
+    def sort(self, resource, items, spec, limit=None):
+        """ Sort items of a resource, served from a sorted index
+        when sorting on a single indexed field.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type items: list
+        :param items: Items of the resource to sort
+
+        :type spec: list
+        :param spec: List of (field, direction), see parse_sort
+
+        :type limit: int
+        :param limit: Only return the first limit items
+
+        """
+        with self.locked(resource):
+            index = None
+            if len(spec) == 1 and spec[0][0] not in DATE_FIELDS:
+                index = self.indexes[resource].get(spec[0][0])
+            if index is None or index.kind != "sorted":
+                return sort_items(items, spec, limit)
+
+            r = self.items[resource]
+            ordered = index.pks
+            if len(items) != len(r):
+                pk = self.get_pk(resource)
+                wanted = set(item[pk] for item in items)
+                ordered = [pk for pk in ordered if pk in wanted]
+            # Items lacking the field are not indexed, they are sorted first
+            missing = []
+            if len(index.pks) < len(r):
+                missing = [item for item in items if index.get(item) is ABSENT]
+            if spec[0][1] == -1:
+                out = [r[pk] for pk in islice(reversed(ordered), limit)]
+                return (out + missing)[:limit]
+            return (missing + [r[pk] for pk in islice(ordered, limit)])[:limit]
+
+    def get_resource(self, resource):
+        """ Retrieve all items for a resource.
+
+        Resources are stored in a dict of list (self.items).
+
+        :type resource: str
+        :param resource: Resource name
+
+        """
+        with self.locked(resource):
+            return self.items[resource].values()
+
+    def changes(self, resource, since=None):
+        """ Retrieve the changes of a resource since a date, ordered
+        by modification time, each item once, with its last version.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type since: str or int
+        :param since: RFC 1123 date or timestamp, all the changes if None
+
+        :rtype: list
+        :return: List of (pk, item), item is None for deleted items
+
+        """
+        if isinstance(since, basestring):
+            since = parse_date(since)
+        with self.locked(resource):
+            r = self.items[resource]
+            return [(pk, None if deleted else r[pk])
+                    for pk, deleted in self.changelog(resource).since(since)]
+
+    def set_resource(self, resource, items=[]):
+        """ Set items for a given resource.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type items: list
+        :param items: List of items (dict),
+            also don't forget the pk for each items,
+            _created and _updated are set if missing (see timestamps).
+
+        """
+        with self.locked(resource, write=True):
+            pk = self.get_pk(resource)
+            now = self.now()
+            for item in items:
+                if pk in item:
+                    if self.timestamps:
+                        _stamp(item, now)
+                    self._put(resource, item[pk], item)
+                else:
+                    exc = "No primary key: {0} found for item: {1}".format(pk, item)
+                    raise Exception(exc)
+
+    def load_resource(self, resource, source, indexes=None):
+        """ Stream items into a resource, without building a list first.
+
+        Malformed lines and items without primary key are reported
+        instead of aborting the load.
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type source: str, file or iterable
+        :param source: Path to a JSON Lines file, a file object,
+            or any iterable of JSON encoded lines or dicts.
+
+        :type indexes: dict
+        :param indexes: Indexes to build once loaded {field: kind}
+
+        :rtype: tuple
+        :return: (number of items loaded, list of (line, error))
+
+        """
+        if isinstance(source, basestring):
+            with open(source) as f:
+                return self.load_resource(resource, f, indexes)
+
+        with self.locked(resource, write=True):
+            # The requested indexes are built in one pass at the end,
+            # instead of being updated on every batch
+            for field, kind in (indexes or {}).items():
+                if kind not in INDEXES:
+                    raise ValueError("Unknown index kind: {0}".format(kind))
+                self.indexes[resource].pop(field, None)
+
+            pk = self.get_pk(resource)
+            now = self.now()
+            loaded = 0
+            errors = []
+            # Items are written in batches
+            batch = OrderedDict()
+            for lineno, item in enumerate(source, 1):
+                if isinstance(item, basestring):
+                    if not item.strip():
+                        continue
+                    try:
+                        item = json.loads(item)
+                    except ValueError as exc:
+                        errors.append((lineno, str(exc)))
+                        continue
+                if not isinstance(item, dict):
+                    error = "Item is not an object: {0!r}".format(item)
+                    errors.append((lineno, error))
+                elif pk not in item:
+                    error = "No primary key: {0} found for item: {1}".format(pk, item)
+                    errors.append((lineno, error))
+                else:
+                    if self.timestamps:
+                        _stamp(item, now)
+                    batch[item[pk]] = item
+                    loaded += 1
+                    if len(batch) >= LOAD_BATCH_SIZE:
+                        self._put_many(resource, batch.items())
+                        batch.clear()
+            self._put_many(resource, batch.items())
+            for field, kind in (indexes or {}).items():
+                self.create_index(resource, field, kind)
+            return loaded, errors
+
+    def generate_resource(self, resource, count, schema, seed=0, indexes=None):
+        """ Seed a resource with generated documents, streamed into
+        the store in batches (see generate_items for the schema).
+
+        :type resource: str
+        :param resource: Resource name
+
+        :type count: int
+        :param count: Number of documents
+
+        :type schema: dict
+        :param schema: Spec of each field
+
+        :type seed: int
+        :param seed: Seed of the random generator
+
+        :type indexes: dict
+        :param indexes: Indexes to build once loaded {field: kind}
+
+        :rtype: int
+        :return: Number of documents loaded
+
+        """
+        items = generate_items(count, schema, self.get_pk(resource), seed)
+        return self.load_resource(resource, items, indexes)[0]
+
+    def get_projection(self, querystring):
+        """ Return the parsed ?projection if any (see parse_projection),
+        raise ValueError if it's invalid. """
+        if "projection" not in querystring:
+            return None
+        return parse_projection(querystring["projection"][0])
+
+    def get_paging(self, querystring):
+        """ Return (page, max_results) if pagination is requested
+        via ?page or ?max_results, None otherwise. """
+        if "page" not in querystring and "max_results" not in querystring:
+            return None
+        try:
+            page = int(querystring.get("page", [1])[0])
+        except ValueError:
+            page = 1
+        try:
+            max_results = int(querystring.get("max_results",
+                                              [PAGINATION_DEFAULT])[0])
+        except ValueError:
+            max_results = PAGINATION_DEFAULT
+        if max_results < 1:
+            max_results = PAGINATION_DEFAULT
+        return max(page, 1), max_results
+
+    def get_links(self, resource, querystring, page, max_results, total):
+        """ Build the HATEOAS _links (self, parent, prev, next, last)
+        for a page of a resource, keeping the other query parameters. """
+        url = urljoin(self.base_url, resource)
+        args = dict((k, v[0]) for k, v in querystring.items())
+        args["max_results"] = max_results
+
+        def page_link(title, p):
+            args["page"] = p
+            return {"title": title,
+                    "href": "{0}?{1}".format(url, urlencode(sorted(args.items())))}
+
+        links = {"self": {"title": resource, "href": url},
+                 "parent": {"title": "home", "href": self.base_url}}
+        last = max(1, (total + max_results - 1) // max_results)
+        if page > 1:
+            links["prev"] = page_link("previous page", page - 1)
+        if page < last:
+            links["next"] = page_link("next page", page + 1)
+            links["last"] = page_link("last page", last)
+        return links
+
+    def generate_resource_response(self, request, uri, headers):
+        """ Generate a response for a resource,
+            support all methods. """
+        return self.dispatch(request, headers)
+
+    def generate_item_response(self, request, uri, headers):
+        """ Generate a response for an item,
+            support all methods. """
+        return self.dispatch(request, headers)
+
+    def dispatch(self, request, headers):
+        """ Dispatch a request (with method, path, headers, querystring
+        and body attributes) to its handler, looked up in self.routes
+        by (method, resource or item).
+
+        The handler is called with the resource locked, writes
+        (including the If-Match check) hold the write lock,
+        as an atomic compare-and-swap.
+
+        The simulated conditions (if any) delay the response,
+        or replace it with an error.
+
+        The body is a str, or an iterator of chunks for streamed
+        responses (see stream), only the time to the first byte
+        is recorded for them.
+
+        :rtype: list
+        :return: [status_code, headers, body]
+
+        """
+        if not self.instrument and self.profile_hook is None:
+            return self._simulate(request, headers)
+
+        profile = None
+        if self.profile_hook is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        start = self.clock.time()
+        try:
+            response = self._simulate(request, headers)
+        finally:
+            duration = self.clock.time() - start
+            if profile is not None:
+                profile.disable()
+        url = urlsplit(request.path)
+        entry = {"method": request.method.upper(),
+                 "path": url.path,
+                 "query": url.query,
+                 "status": response[0],
+                 "duration": duration}
+        if self.instrument:
+            self.record(entry)
+        if profile is not None:
+            self.profile_hook(entry, profile)
+        return response
+
+    def set_conditions(self, conditions, resource=None, method=None):
+        """ Simulate network and server conditions (latency, bandwidth
+        and errors) for the requests of a resource and/or a method,
+        or all the requests, the most specific conditions apply.
+
+        :type conditions: Conditions
+        :param conditions: Conditions, None to remove them
+
+        :type resource: str
+        :param resource: Resource name, every resource if None
+
+        :type method: str
+        :param method: HTTP method, every method if None
+
+        """
+        key = (resource, method and method.upper())
+        if conditions is None:
+            self.conditions.pop(key, None)
+        else:
+            self.conditions[key] = conditions
+
+    def get_conditions(self, resource, method):
+        """ Return the conditions for a request, None if there's none. """
+        if not self.conditions:
+            return None
+        for key in ((resource, method), (resource, None),
+                    (None, method), (None, None)):
+            if key in self.conditions:
+                return self.conditions[key]
+
+    def _simulate(self, request, headers):
+        """ Dispatch a request under the simulated conditions, sleeping
+        outside of the store locks. """
+        method = request.method.upper()
+        parts = self.split_path(request.path)
+        conditions = self.get_conditions(parts[0] if parts else None, method)
+        if conditions is None:
+            return self._dispatch(request, headers, method, parts)
+
+        status = conditions.error()
+        if status is not None:
+            headers["content-type"] = "application/json"
+            if status in RETRY_AFTER_STATUSES:
+                headers["retry-after"] = str(conditions.retry_after)
+            message = BaseHTTPRequestHandler.responses.get(status, ("Error",))[0]
+            body = json.dumps({"_status": "ERR",
+                               "_error": {"code": status, "message": message}})
+            response = [status, headers, body]
+        else:
+            response = self._dispatch(request, headers, method, parts)
+        if isinstance(response[2], str):
+            self.clock.sleep(conditions.delay(len(response[2])))
+        else:
+            # Only the latency is known, the transfer time
+            # is spent as the chunks are sent
+            self.clock.sleep(conditions.delay())
+            if conditions.bandwidth:
+                response[2] = self._throttle(response[2], conditions.bandwidth)
+        return response
+
+    def _throttle(self, chunks, bandwidth):
+        for chunk in chunks:
+            self.clock.sleep(float(len(chunk)) / bandwidth)
+            yield chunk
+
+    def record(self, entry):
+        """ Record a request in the stats and the request log. """
+        parts = self.split_path(entry["path"])
+        endpoint = "{0} /{1}".format(entry["method"], parts[0] if parts else "")
+        if len(parts) > 1:
+            endpoint += "/<id>"
+        bucket = bisect_left(LATENCY_BUCKETS, entry["duration"] * 1000)
+        with self._stats_lock:
+            self.requests.append(entry)
+            self._stats["total"] += 1
+            self._stats["methods"][entry["method"]] += 1
+            stats = self._stats["endpoints"].get(endpoint)
+            if stats is None:
+                stats = self._stats["endpoints"][endpoint] = {
+                    "count": 0,
+                    "time": 0.0,
+                    "statuses": defaultdict(int),
+                    "latency": [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats["count"] += 1
+            stats["time"] += entry["duration"]
+            stats["statuses"][entry["status"]] += 1
+            stats["latency"][bucket] += 1
+
+    def stats(self):
+        """ Return the requests stats, the total count, the count by
+        method, and for each endpoint ("GET /resource/<id>") the count,
+        the total time, the count by status and the latency histogram,
+        counts for each LATENCY_BUCKETS (in ms) upper bound, the last
+        one for slower requests. """
+        with self._stats_lock:
+            return {"total": self._stats["total"],
+                    "methods": dict(self._stats["methods"]),
+                    "endpoints": dict((endpoint, {"count": stats["count"],
+                                                  "time": stats["time"],
+                                                  "statuses": dict(stats["statuses"]),
+                                                  "latency": list(stats["latency"])})
+                                      for endpoint, stats
+                                      in self._stats["endpoints"].items()),
+                    "latency_buckets": LATENCY_BUCKETS}
+
+    def reset_stats(self):
+        """ Reset the requests stats and the request log. """
+        with self._stats_lock:
+            self._stats = {"total": 0,
+                           "methods": defaultdict(int),
+                           "endpoints": {}}
+            self.requests.clear()
+
+    def _dispatch(self, request, headers, method, parts):
+        if len(parts) == 1:
+            kind = RESOURCE
+        elif len(parts) == 2:
+            kind = ITEM
+        else:
+            return [404, headers, "{}"]
+        headers["content-type"] = "application/json"
+        if method == "OPTIONS":
+            headers["allow"] = ", ".join(self.allowed_methods[kind])
+            return [200, headers, ""]
+        route = self.routes.get((method, kind))
+        if route is None:
+            headers["allow"] = ", ".join(self.allowed_methods[kind])
+            return [405, headers, "{}"]
+        handler, write = route
+        with self.locked(parts[0], write):
+            response = handler(request, headers, *parts)
+        if self.compress and response[2]:
+            self.compress_response(request, response)
+        if method == "HEAD":
+            # Keep the length of the GET body
+            response[1]["content-length"] = str(len(join_body(response[2])))
+            response[2] = ""
+        return response
+
+    def compress_response(self, request, response):
+        """ Compress the body of a response in place, with the
+        preferred content coding accepted by the client, bodies
+        smaller than COMPRESS_MIN_SIZE are left as is. """
+        body = response[2]
+        headers = response[1]
+        headers["vary"] = "Accept-Encoding"
+        if isinstance(body, str) and len(body) < COMPRESS_MIN_SIZE:
+            return
+        coding = parse_accept_encoding(request.headers.get("Accept-Encoding"))
+        if coding is None:
+            return
+        headers["content-encoding"] = coding
+        if isinstance(body, str):
+            response[2] = "".join(compress_chunks([body], coding))
+        else:
+            response[2] = compress_chunks(body, coding)
+
+    def get_modified_since(self, request):
+        """ Return the If-Modified-Since timestamp, None if the header
+        is missing or invalid, or if If-None-Match is given. """
+        value = request.headers.get("If-Modified-Since")
+        if value is None or "If-None-Match" in request.headers:
+            return None
+        return _date_value(value)
+
+    def get_resource_response(self, request, headers, resource):
+        qs = request.querystring or {}
+        query = urlsplit(request.path).query
+        since = self.get_modified_since(request)
+        if since is not None:
+            log = self.changelog(resource)
+        else:
+            log = self._active_changelog(resource)
+        if log is not None and log.last is not None:
+            headers["last-modified"] = format_date(log.last)
+        if since is not None:
+            # Only the items changed since are returned
+            if log.last is None or log.last <= since:
+                return [304, headers, ""]
+            query += "&If-Modified-Since={0}".format(since)
+        etag = self.collection_etag(resource, query)
+        headers["etag"] = '"{0}"'.format(etag)
+        if etag_matches(request.headers.get("If-None-Match", ""), etag):
+            return [304, headers, ""]
+
+        try:
+            projection = self.get_projection(qs)
+        except ValueError:
+            return [400, headers, "{}"]
+
+        q = None
+        # Check if a querystring is provided
+        if "where" in qs:
+            try:
+                # Load the (cached) mongo query
+                q = parse_where(qs["where"][0])
+            except ValueError:
+                return [400, headers, "{}"]
+
+        spec = None
+        if "sort" in qs:
+            try:
+                spec = parse_sort(qs["sort"][0])
+            except ValueError:
+                return [400, headers, "{}"]
+
+        paging = self.get_paging(qs)
+        if paging is None:
+            start, max_results = 0, None
+        else:
+            page, max_results = paging
+            start = (page - 1) * max_results
+
+        total, _items = self.query(resource, q, spec, start, max_results, since)
+
+        encode_items = self.encode_items
+        if self.stream and len(_items) > STREAM_BATCH_SIZE:
+            # Items are never updated in place, so they can be
+            # encoded once the lock is released
+            encode_items = self.iter_items
+
+        if paging is None:
+            return [200,
+                    headers,
+                    encode_items(resource, _items, projection)]
+
+        return [200,
+                headers,
+                encode_items(resource,
+                             _items,
+                             projection,
+                             _meta={"total": total,
+                                    "page": page,
+                                    "max_results": max_results},
+                             _links=self.get_links(resource, qs, page,
+                                                   max_results, total))]
+
+    def post_resource_response(self, request, headers, resource):
+        content_type = request.headers.get("Content-Type") or ""
+        if content_type.split(";")[0].strip() == "application/json":
+            return self.post_json_response(request, headers, resource)
+        qs = parse_qs(request.body)
+        pk_field = self.get_pk(resource)
+        out = {}
+        new_items = {}
+        now = self.now()
+        for key, data in qs.items():
+            item = json.loads(data[0])
+            pk = item[pk_field]
+            if pk in self.items[resource] or pk in new_items:
+                out[key] = {"status": "ERR", "issues": ["pk not unique"]}
+            else:
+                if self.timestamps:
+                    item["_created"] = item["_updated"] = now
+                item_etag = self.generate_etag(item)
+                item["etag"] = item_etag
+                new_items[pk] = item
+                out[key] = {"status": "OK", "etag": item_etag}
+        self._put_many(resource, new_items.items())
+        return [200, headers, json.dumps(out)]
+
+    def post_json_response(self, request, headers, resource):
+        """ Insert a JSON document, or an array of documents, the way
+        Eve does: the body is decoded once and the documents are
+        inserted in a single write, or not at all if any of them
+        is invalid (e.g. duplicate primary key).
+
+        Respond 201 with {"_status": "OK", pk, "etag"}, or for an array
+        {"_status": "OK", "_items": [...]}, and 400 with "_status": "ERR",
+        an "_error" and the "_issues" of each invalid document.
+
+        """
+        try:
+            docs = json.loads(request.body)
+        except ValueError as exc:
+            return [400, headers, json.dumps(
+                {"_status": "ERR",
+                 "_error": {"code": 400, "message": str(exc)}})]
+        bulk = isinstance(docs, list)
+        if not bulk:
+            docs = [docs]
+        pk_field = self.get_pk(resource)
+        existing = self.items[resource]
+        new_items = OrderedDict()
+        results = []
+        failures = 0
+        now = self.now()
+        for doc in docs:
+            issues = None
+            if not isinstance(doc, dict):
+                issues = {"_items": "document is not an object"}
+            elif pk_field not in doc:
+                issues = {pk_field: "required field"}
+            else:
+                pk = doc[pk_field]
+                try:
+                    duplicate = pk in existing or pk in new_items
+                except TypeError:
+                    issues = {pk_field: "unhashable value"}
+                else:
+                    if duplicate:
+                        issues = {pk_field: u"value '{0}' is not unique".format(pk)}
+            if issues is not None:
+                failures += 1
+                results.append({"_status": "ERR", "_issues": issues})
+                continue
+            item = dict(doc)
+            if self.timestamps:
+                item["_created"] = item["_updated"] = now
+            item["etag"] = self.generate_etag(item)
+            new_items[pk] = item
+            results.append({"_status": "OK", pk_field: pk, "etag": item["etag"]})
+
+        if failures:
+            # Nothing is inserted, valid documents only report their status
+            for result in results:
+                if result["_status"] == "OK":
+                    del result[pk_field], result["etag"]
+            message = "Insertion failure: {0} document(s) contain(s) " \
+                      "error(s)".format(failures)
+            out = {"_status": "ERR",
+                   "_error": {"code": 400, "message": message}}
+            if bulk:
+                out["_items"] = results
+            else:
+                out["_issues"] = results[0]["_issues"]
+            return [400, headers, json.dumps(out)]
+
+        self._put_many(resource, new_items.items())
+        if bulk:
+            out = {"_status": "OK", "_items": results}
+        else:
+            out = results[0]
+        return [201, headers, json.dumps(out)]
+
+    def delete_resource_response(self, request, headers, resource):
+        self._drop(resource)
+        return [200, headers, "{}"]
+
+    def check_if_match(self, request, resource, item):
+        """ Return the error status code if the If-Match header
+        is missing (403) or doesn't match the item etag (412). """
+        if not "If-Match" in request.headers:
+            return 403
+        if not etag_matches(request.headers["If-Match"],
+                            self.get_etag(resource, item)):
+            return 412
+
+    def get_item_response(self, request, headers, resource, item_id):
+        item = self.items[resource].get(item_id)
+        if item is None:
+            return [404, headers, "{}"]
+        etag = self.get_etag(resource, item)
+        headers["etag"] = '"{0}"'.format(etag)
+        if etag_matches(request.headers.get("If-None-Match", ""), etag):
+            return [304, headers, ""]
+        since = self.get_modified_since(request)
+        if since is not None:
+            log = self.changelog(resource)
+        else:
+            log = self._active_changelog(resource)
+        modified = log.latest.get(item_id) if log is not None else None
+        if modified is not None:
+            headers["last-modified"] = format_date(modified)
+            if since is not None and modified <= since:
+                return [304, headers, ""]
+        try:
+            projection = self.get_projection(request.querystring or {})
+        except ValueError:
+            return [400, headers, "{}"]
+        return [200, headers, self.encode_item(resource, item, projection)]
+
+    def delete_item_response(self, request, headers, resource, item_id):
+        item = self.items[resource].get(item_id)
+        if item is None:
+            return [405, headers, "{}"]
+        status = self.check_if_match(request, resource, item)
+        if status:
+            return [status, headers, "{}"]
+        self._pop(resource, item_id)
+        return [200, headers, "{}"]
+
+    def patch_item_response(self, request, headers, resource, item_id):
+        item = self.items[resource].get(item_id)
+        if item is None:
+            return [405, headers, "{}"]
+        status = self.check_if_match(request, resource, item)
+        if status:
+            return [status, headers, "{}"]
+        qs = parse_qs(request.body)
+        out = {}
+        for k, patch_data in qs.items():
+            patch_data = json.loads(patch_data[0])
+            patch_data.pop("etag", None)
+            if self.timestamps:
+                patch_data.pop("_created", None)
+                patch_data["_updated"] = self.now()
+            item = dict(self.items[resource][item_id])
+            item.update(patch_data)
+            new_etag = self.generate_etag(item)
+            item["etag"] = new_etag
+            self._put(resource, item_id, item)
+            out[k] = {"status": "OK", "etag": new_etag}
+        return [200, headers, json.dumps(out)]
+
+    def handle(self, request):
+        """ Dispatch a request outside of HTTPretty (see dispatch),
+        the body of streamed responses is an iterator of chunks.
+
+        :rtype: list
+        :return: [status_code, headers, body]
+
+        """
+        return self.dispatch(request, {})
+
+
+# Ports left out of the router keys
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _netloc(url):
+    """ Return the host (and port, unless it's the default
+    one for the scheme) of a split url. """
+    host = (url.hostname or "").lower()
+    port = url.port
+    if port is None or port == DEFAULT_PORTS.get(url.scheme):
+        return host
+    return "{0}:{1}".format(host, port)
+
+
+class Router(object):
+    """ Route HTTPretty requests to the EveMocker mounted on their
+    base url.
+
+    A single URI is registered with HTTPretty for each host,
+    the mocker is then looked up in a dict by base path,
+    so the cost doesn't grow with the number of mockers.
+
+    """
+    def __init__(self):
+        self.mockers = {}
+
+    def mount(self, mocker):
+        """ Mount a mocker on its base url, replacing any previous
+        mocker mounted on the same base url. """
+        url = urlsplit(mocker.base_url)
+        self.mockers[(_netloc(url), mocker.base_path)] = mocker
+        self.register(url.hostname.lower())
+
+    def register(self, host):
+        """ Register the host with HTTPretty, if it's not already. """
+        uri = re.compile(r"^https?://{0}(:\d+)?/".format(re.escape(host)))
+        for matcher in getattr(HTTPretty, "_entries", {}):
+            regex = getattr(matcher, "regex", None)
+            if regex is not None and regex.pattern == uri.pattern:
+                return
+        for method in HTTP_METHODS:
+            HTTPretty.register_uri(method, uri, body=self.dispatch)
+
+    def lookup(self, uri):
+        """ Return the mocker with the longest base path
+        matching the uri, or None. """
+        url = urlsplit(uri)
+        netloc = _netloc(url)
+        parts = url.path.split("/")
+        for i in xrange(len(parts) - 1, 0, -1):
+            mocker = self.mockers.get((netloc, "/".join(parts[:i]) + "/"))
+            if mocker is not None:
+                return mocker
+        return None
+
+    def dispatch(self, request, uri, headers):
+        host = request.headers.get("Host")
+        if host:
+            # HTTPretty drops the port from the url
+            url = urlsplit(uri)
+            uri = "{0}://{1}{2}".format(url.scheme, host, url.path)
+        mocker = self.lookup(uri)
+        if mocker is None:
+            return [404, headers, "{}"]
+        status, headers, body = mocker.dispatch(request, headers)
+        # HTTPretty only takes str bodies from callbacks
+        return [status, headers, join_body(body)]
+
+
+ROUTER = Router()
+
+
+class ServerRequest(object):
+    """ Request passed to the EveMocker handlers by the server,
+    it mimics the HTTPretty request attributes. """
+    def __init__(self, method, path, headers, body=""):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.querystring = parse_qs(urlsplit(path).query)
+
+
+class EveMockerRequestHandler(BaseHTTPRequestHandler):
+    """ Serve the EveMocker of the server, with keep-alive. """
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length) if length else ""
+        request = ServerRequest(self.command, self.path, self.headers, body)
+        try:
+            status, headers, body = self.server.mocker.handle(request)
+        except Exception:
+            # Logged with --verbose only, like the requests
+            self.log_error("%s", traceback.format_exc())
+            status, headers = 500, {"content-type": "application/json"}
+            body = json.dumps({"_status": "ERR",
+                               "_error": {"code": 500,
+                                          "message": self.responses[500][0]}})
+        if not isinstance(body, str) and self.request_version == "HTTP/1.0":
+            body = join_body(body)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if isinstance(body, str):
+            if "content-length" not in headers:
+                self.send_header("content-length", len(body))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+            return
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        for chunk in body:
+            if chunk:
+                self.wfile.write("{0:x}\r\n{1}\r\n".format(len(chunk), chunk))
+        self.wfile.write("0\r\n\r\n")
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = \
+        do_OPTIONS = handle_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class EveMockerServer(ThreadingMixIn, HTTPServer):
+    """ Multi-threaded HTTP server for an EveMocker,
+    to use it from another process or a non-Python client.
+
+    :type mocker: EveMocker
+    :param mocker: Mocker to serve
+
+    :type address: tuple
+    :param address: (host, port) to listen to
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mocker, address=("127.0.0.1", 5000), verbose=False):
+        HTTPServer.__init__(self, address, EveMockerRequestHandler)
+        self.mocker = mocker
+        self.verbose = verbose
+
+
+def _reason(status):
+    return BaseHTTPRequestHandler.responses.get(status, ("",))[0]
+
+
+class WSGIApp(object):
+    """ WSGI application dispatching requests straight to a mocker
+    (or to the mocker mounted on the request url), to mount it in
+    any WSGI server or test client, without HTTPretty.
+
+    :type mocker: EveMocker
+    :param mocker: Mocker to serve, all the mounted mockers if None
+
+    """
+    def __init__(self, mocker=None):
+        self.mocker = mocker
+
+    def __call__(self, environ, start_response):
+        path = quote(environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", ""))
+        if environ.get("QUERY_STRING"):
+            path += "?" + environ["QUERY_STRING"]
+        headers = Headers([(k[5:].replace("_", "-").title(), v)
+                           for k, v in environ.items() if k.startswith("HTTP_")])
+        if environ.get("CONTENT_TYPE"):
+            headers["Content-Type"] = environ["CONTENT_TYPE"]
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else ""
+        request = ServerRequest(environ["REQUEST_METHOD"], path, headers, body)
+        mocker = self.mocker
+        if mocker is None:
+            host = environ.get("HTTP_HOST")
+            if not host:
+                host = environ.get("SERVER_NAME", "")
+                if environ.get("SERVER_PORT"):
+                    host += ":" + environ["SERVER_PORT"]
+            mocker = ROUTER.lookup("{0}://{1}{2}".format(
+                environ.get("wsgi.url_scheme", "http"), host, path))
+        if mocker is None:
+            status, response_headers, body = 404, {}, "{}"
+        else:
+            status, response_headers, body = mocker.dispatch(request, {})
+        has_length = "content-length" in response_headers
+        response_headers = [(k, str(v)) for k, v in response_headers.items()]
+        if not isinstance(body, str):
+            # Streamed body, sent as the server sees fit
+            start_response("{0} {1}".format(status, _reason(status)),
+                           response_headers)
+            return body
+        if not has_length:
+            response_headers.append(("Content-Length", str(len(body))))
+        start_response("{0} {1}".format(status, _reason(status)), response_headers)
+        return [body]
+
+
+class EveMockerAdapter(object):
+    """ requests transport adapter dispatching requests straight to a
+    mocker (or to the mocker mounted on the request url), without
+    HTTPretty nor sockets:
+
+        session = requests.Session()
+        session.mount("http://localhost/api/", EveMockerAdapter(eve_mocker))
+
+    :type mocker: EveMocker
+    :param mocker: Mocker to send the requests to, the mocker
+        mounted on the request url if None
+
+    """
+    def __init__(self, mocker=None):
+        self.mocker = mocker
+
+    def send(self, request, **kwargs):
+        from requests.models import Response
+        from requests.structures import CaseInsensitiveDict
+
+        url = urlsplit(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        body = request.body
+        if body is None:
+            body = ""
+        elif isinstance(body, unicode):
+            body = body.encode("utf-8")
+        elif not isinstance(body, str):
+            # Iterable (streamed) body
+            body = "".join(body)
+        mocker = self.mocker or ROUTER.lookup(request.url)
+        if mocker is None:
+            status, headers, body = 404, {}, "{}"
+        else:
+            status, headers, body = mocker.dispatch(
+                ServerRequest(request.method, path,
+                              Headers(request.headers.items()), body), {})
+        response = Response()
+        response.status_code = status
+        response.reason = _reason(status)
+        response.headers = CaseInsensitiveDict(headers)
+        response.url = request.url
+        response.request = request
+        if isinstance(body, str) and "content-encoding" not in headers:
+            response.headers.setdefault("content-length", str(len(body)))
+            response.raw = BytesIO(body)
+            response._content = body
+            response._content_consumed = True
+            return response
+        # Streamed or compressed body, read (and decoded) by urllib3
+        from requests.packages.urllib3.response import HTTPResponse
+
+        if isinstance(body, str):
+            response.headers.setdefault("content-length", str(len(body)))
+            body = BytesIO(body)
+        else:
+            body = ChunkReader(body)
+        response.raw = HTTPResponse(body=body, headers=headers, status=status,
+                                    reason=response.reason,
+                                    preload_content=False, decode_content=True)
+        return response
+
+    def close(self):
+        pass
+
+
+# Default range of the generated dates (2025)
+GENERATED_DATES = (1735689600, 1767225600)
+
+
+def _ranks(spec, size):
+    """ Build a function drawing a rank in [0, size), the skew is an
+    exponent, 1 is uniform, higher values favour the first ranks. """
+    skew = float(spec.get("skew", 1))
+    if skew <= 0:
+        raise ValueError("skew must be positive: {0}".format(skew))
+    size = max(int(size), 1)
+    if skew == 1:
+        return lambda rng: int(rng.random() * size)
+    return lambda rng: int(size * rng.random() ** skew)
+
+
+def _spread(spec, lo, hi):
+    """ Build a function drawing an integer in [lo, hi], with
+    at most cardinality distinct values spread over the range. """
+    if hi < lo:
+        raise ValueError("max must be greater than min: {0}".format(spec))
+    size = min(spec.get("cardinality", hi - lo + 1), hi - lo + 1)
+    rank = _ranks(spec, size)
+    if size == hi - lo + 1:
+        return lambda rng: lo + rank(rng)
+    step = float(hi - lo) / max(size - 1, 1)
+    return lambda rng: lo + int(rank(rng) * step)
+
+
+def _int_field(field, spec, count):
+    draw = _spread(spec, spec.get("min", 0), spec.get("max", 1000))
+    return lambda rng, i: draw(rng)
+
+
+def _float_field(field, spec, count):
+    lo, hi = float(spec.get("min", 0)), float(spec.get("max", 1))
+    skew = float(spec.get("skew", 1))
+    return lambda rng, i: lo + (hi - lo) * rng.random() ** skew
+
+
+def _str_field(field, spec, count):
+    prefix = spec.get("prefix", field)
+    rank = _ranks(spec, spec.get("cardinality", count))
+    return lambda rng, i: prefix + str(rank(rng))
+
+
+def _bool_field(field, spec, count):
+    p = spec.get("p", 0.5)
+    return lambda rng, i: rng.random() < p
+
+
+def _choice_field(field, spec, count):
+    values = spec.get("values")
+    if not values:
+        raise ValueError("choice field {0} needs values".format(field))
+    if "weights" in spec:
+        if len(spec["weights"]) != len(values):
+            raise ValueError("choice field {0} needs a weight "
+                             "per value".format(field))
+        cumulative = []
+        total = 0
+        for weight in spec["weights"]:
+            total += weight
+            cumulative.append(total)
+        return lambda rng, i: values[bisect_right(cumulative,
+                                                  rng.random() * total)]
+    rank = _ranks(spec, len(values))
+    return lambda rng, i: values[rank(rng)]
+
+
+def _date_field(field, spec, count):
+    lo, hi = [parse_date(value) if isinstance(value, basestring) else value
+              for value in (spec.get("min", GENERATED_DATES[0]),
+                            spec.get("max", GENERATED_DATES[1]))]
+    draw = _spread(spec, int(lo), int(hi))
+    return lambda rng, i: format_date(draw(rng))
+
+
+def _seq_field(field, spec, count):
+    start, step = spec.get("start", 0), spec.get("step", 1)
+    if "prefix" in spec:
+        prefix = spec["prefix"]
+        return lambda rng, i: prefix + str(start + i * step)
+    return lambda rng, i: start + i * step
+
+
+def _objectid_field(field, spec, count):
+    start = spec.get("start", 0)
+    return lambda rng, i: "{0:024x}".format(start + i)
+
+
+def _object_field(field, spec, count):
+    return _document(spec.get("fields", {}), count)
+
+
+def _list_field(field, spec, count):
+    if "of" not in spec:
+        raise ValueError("list field {0} needs an item spec (of)".format(field))
+    item = _field_generator(field, spec["of"], count)
+    length = _spread({}, spec.get("min_length", 0), spec.get("max_length", 3))
+    return lambda rng, i: [item(rng, i) for _ in xrange(length(rng))]
+
+
+# Generated field types, see generate_items
+FIELD_TYPES = {
+    "int": _int_field,
+    "float": _float_field,
+    "str": _str_field,
+    "bool": _bool_field,
+    "choice": _choice_field,
+    "date": _date_field,
+    "seq": _seq_field,
+    "objectid": _objectid_field,
+    "object": _object_field,
+    "list": _list_field,
+}
+
+
+def _field_generator(field, spec, count):
+    """ Build the function generating a field value (rng, i). """
+    if not isinstance(spec, dict) or spec.get("type") not in FIELD_TYPES:
+        raise ValueError("Invalid spec for field {0}: {1!r}".format(field, spec))
+    generate = FIELD_TYPES[spec["type"]](field, spec, count)
+    null = spec.get("null", 0)
+    if null:
+        value = generate
+        generate = lambda rng, i: None if rng.random() < null else value(rng, i)
+    return generate
+
+
+def _document(fields, count):
+    """ Build the function generating a document (rng, i). """
+    generators = [(field, _field_generator(field, spec, count),
+                   spec.get("missing", 0))
+                  for field, spec in sorted(fields.items())]
+
+    def generate(rng, i):
+        doc = {}
+        for field, value, missing in generators:
+            if missing and rng.random() < missing:
+                continue
+            doc[field] = value(rng, i)
+        return doc
+    return generate
+
+
+def generate_items(count, schema, pk="_id", seed=0):
+    """ Generate count documents following a schema, the same seed
+    always generates the same documents, they are generated one at
+    a time (see EveMocker.generate_resource).
+
+    The schema maps each field to its spec, a dict with a "type":
+
+    - int: between "min" and "max" (0 and 1000 by default)
+    - float: between "min" and "max" (0 and 1 by default)
+    - str: "prefix" (the field name by default) followed by a number
+    - bool: true with probability "p" (0.5 by default)
+    - choice: one of "values", with optional "weights"
+    - date: RFC 1123 date between "min" and "max" (dates or timestamps)
+    - seq: "start" + i * "step", prefixed if "prefix" is given
+    - objectid: 24 hex digits, from "start" + i
+    - object: embedded document with its own "fields"
+    - list: list of "min_length" to "max_length" values of spec "of"
+
+    int, str and date values take at most "cardinality" distinct values,
+    "skew" (1 by default, uniform) favours the first values when higher,
+    any field can be None with probability "null", or be missing with
+    probability "missing".
+
+    The primary key is an objectid by default, its spec, if given,
+    must be a seq or an objectid so it's unique.
+
+    Raise ValueError if the schema is invalid.
+
+    :type count: int
+    :param count: Number of documents
+
+    :type schema: dict
+    :param schema: Spec of each field
+
+    :type pk: str
+    :param pk: Primary key field
+
+    :type seed: int
+    :param seed: Seed of the random generator
+
+    """
+    fields = dict(schema)
+    pk_spec = fields.pop(pk, {"type": "objectid"})
+    if not isinstance(pk_spec, dict) or \
+            pk_spec.get("type") not in ("seq", "objectid"):
+        raise ValueError("Primary key {0} must be a seq or an objectid: "
+                         "{1!r}".format(pk, pk_spec))
+    generate = _document(fields, count)
+    pk_value = FIELD_TYPES[pk_spec["type"]](pk, pk_spec, count)
+    return _generate_items(count, generate, pk, pk_value, seed)
+
+
+def _generate_items(count, generate, pk, pk_value, seed):
+    rng = random.Random(seed)
+    for i in xrange(count):
+        doc = generate(rng, i)
+        doc[pk] = pk_value(rng, i)
+        yield doc
+
+
+def load_fixtures(mocker, path):
+    """ Load every fixtures file of a directory into a mocker,
+    the resource name is the file name, either JSON Lines (.jsonl)
+    or a JSON list of items (.json).
+
+    :rtype: dict
+    :return: Errors for each resource {resource: [(line, error)]}
+
+    """
+    errors = {}
+    for filename in sorted(os.listdir(path)):
+        resource, ext = os.path.splitext(filename)
+        filename = os.path.join(path, filename)
+        if ext == ".jsonl":
+            _, errors[resource] = mocker.load_resource(resource, filename)
+        elif ext == ".json":
+            with open(filename) as f:
+                items = json.load(f)
+            if isinstance(items, dict):
+                items = items.get("_items", [])
+            _, errors[resource] = mocker.load_resource(resource, items)
+    return errors
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="eve_mocker",
+                                     description="Mocking tool for Eve powered REST API.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve = subparsers.add_parser("serve", help="Serve the mocker over HTTP")
+    serve.add_argument("--base-url", default="http://127.0.0.1:5000/",
+                       help="API base url, the host and port to listen to")
+    serve.add_argument("--fixtures",
+                       help="Directory of fixtures (resource.json or resource.jsonl)")
+    serve.add_argument("--default-pk", default="_id", help="Default primary key")
+    serve.add_argument("--pk", action="append", default=[],
+                       metavar="RESOURCE=PK", help="Primary key for a resource")
+    serve.add_argument("--generate", nargs=3, action="append", default=[],
+                       metavar=("RESOURCE", "COUNT", "SCHEMA"),
+                       help="Seed a resource with COUNT documents generated "
+                            "from a JSON schema file (see generate_items)")
+    serve.add_argument("--snapshot", metavar="PATH",
+                       help="Load the items from a snapshot file")
+    serve.add_argument("--sqlite", metavar="PATH",
+                       help="Store the items in a SQLite database file")
+    serve.add_argument("--compact", action="append", default=[],
+                       metavar="RESOURCE", help="Store a resource in columns")
+    serve.add_argument("--latency", type=float, metavar="SECONDS",
+                       help="Delay every response")
+    serve.add_argument("--bandwidth", type=float, metavar="BYTES",
+                       help="Bandwidth (bytes per second)")
+    serve.add_argument("--error-rate", type=float, default=0,
+                       help="Probability of a 5xx/429 response")
+    serve.add_argument("--timestamps", action="store_true",
+                       help="Set _created and _updated on the items")
+    serve.add_argument("--stream", action="store_true",
+                       help="Stream large list responses (chunked)")
+    serve.add_argument("--compress", action="store_true",
+                       help="Compress the responses (Accept-Encoding)")
+    serve.add_argument("--verbose", action="store_true", help="Log requests")
+
+    subparsers.add_parser("bench", add_help=False,
+                          help="Benchmark the mocker (see bench_eve_mocker)")
+
+    args, extra = parser.parse_known_args(args)
+    if args.command == "bench":
+        import bench_eve_mocker
+        return bench_eve_mocker.main(extra)
+    elif extra:
+        parser.error("unrecognized arguments: {0}".format(" ".join(extra)))
+
+    pk_maps = dict(pk.split("=", 1) for pk in args.pk)
+    if args.sqlite:
+        storage = SQLiteStorage(args.sqlite)
+    else:
+        storage = DictStorage(compact=args.compact)
+    if args.snapshot:
+        mocker = EveMocker.from_snapshot(args.base_url, args.snapshot,
+                                         storage=storage,
+                                         timestamps=args.timestamps,
+                                         stream=args.stream,
+                                         compress=args.compress)
+        mocker.pk_maps.update(pk_maps)
+    else:
+        mocker = EveMocker(args.base_url, pk_maps=pk_maps,
+                           default_pk=args.default_pk, storage=storage,
+                           timestamps=args.timestamps, stream=args.stream,
+                           compress=args.compress)
+    if args.fixtures:
+        for resource, errors in load_fixtures(mocker, args.fixtures).items():
+            for lineno, error in errors:
+                sys.stderr.write("{0}:{1}: {2}\n".format(resource, lineno, error))
+    for resource, count, schema in args.generate:
+        with open(schema) as f:
+            mocker.generate_resource(resource, int(count), json.load(f))
+    if args.latency or args.bandwidth or args.error_rate:
+        mocker.set_conditions(Conditions(latency=args.latency,
+                                         bandwidth=args.bandwidth,
+                                         error_rate=args.error_rate))
+
+    url = urlsplit(args.base_url)
+    server = EveMockerServer(mocker, (url.hostname, url.port or 80),
+                             verbose=args.verbose)
+    sys.stderr.write("Serving {0}\n".format(args.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mocker.clock.cancel()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,7 @@ setup(
     license="MIT",
     keywords="eve api mock mocking mocker",
     url="https://github.com/tsileo/eve-mocker",
-    py_modules=["eve_mocker"],
+    py_modules=["eve_mocker", "bench_eve_mocker"],
     long_description=read("README.rst"),
     install_requires=["httpretty"],
     tests_require=["sure", "requests"],
@@ -6,10 +6,21 @@ import unittest
 import requests
 from httpretty import HTTPretty
 from sure import expect
-from eve_mocker import EveMocker, query_data
-from urlparse import urljoin
+from eve_mocker import EveMocker, query_data, parse_where, LRUCache, \
+    parse_sort, sort_items, EveMockerServer, ServerRequest, RWLock, \
+    SQLiteStorage, sql_where, DictStorage, CompactCollection, Conditions, \
+    Clock, VirtualClock, uniform_latency, lognormal_latency, WSGIApp, \
+    EveMockerAdapter, parse_date, HashIndex, SortedIndex, generate_items, \
+    parse_accept_encoding, ROUTER
+from urllib import urlencode
+from urlparse import urljoin, parse_qs
 from functools import partial
 import json
+import threading
+import os
+import tempfile
+from StringIO import StringIO
+from wsgiref.util import setup_testing_defaults
 
 BASE_URL = "http://localhost/api/"
 api_url = partial(urljoin, BASE_URL)
@@ -216,6 +227,1190 @@ class TestEveMocker(unittest.TestCase):
         expect(data).to.have.key("_items")
         expect(data["_items"][0]).to.equal({"testpk": 30})
 
+    def testSortMultipleKeys(self):
+        """ Test ?sort on multiple keys, with Eve list syntax. """
+        test_items = [{"testpk": i, "group": i % 3} for i in range(30)]
+        test_items.append({"testpk": 30})
+
+        self.eve_mocker.set_resource("testresource", test_items)
+
+        # Items lacking group are sorted like null, last when descending
+        expected = sorted(range(30), key=lambda i: (-(i % 3), i)) + [30]
+
+        for sort in ('[("group", -1), ("testpk", 1)]',
+                     '[["group", -1], ["testpk", 1]]',
+                     '-group,testpk'):
+            response = requests.get(api_url("testresource/?sort=" + sort))
+            data = response.json()
+            expect(response.status_code).to.equal(200)
+            expect([i["testpk"] for i in data["_items"]]).to.equal(expected)
+
+        response = requests.get(api_url("testresource/?sort=[(1, 2, 3)]"))
+        expect(response.status_code).to.equal(400)
+
+    def testParseSort(self):
+        expect(parse_sort('{"a": 1}')).to.equal([("a", 1)])
+        expect(parse_sort('[("a", 1), ("b", -1)]')).to.equal([("a", 1),
+                                                               ("b", -1)])
+        expect(parse_sort('[["a", -1]]')).to.equal([("a", -1)])
+        expect(parse_sort('a,-b')).to.equal([("a", 1), ("b", -1)])
+        expect(parse_sort).when.called_with("[(").should.throw(ValueError)
+
+        items = [{"a": 2}, {"a": 1, "b": 2}, {"b": 1}, {"a": 1, "b": 3}]
+        expect(sort_items(items, [("a", 1), ("b", -1)])).to.equal(
+            [{"b": 1}, {"a": 1, "b": 3}, {"a": 1, "b": 2}, {"a": 2}])
+        expect(sort_items(items, [("a", -1)], limit=2)).to.equal(
+            [{"a": 2}, {"a": 1, "b": 2}])
+
+    def testSortIndex(self):
+        """ Test ?sort served from a sorted index. """
+        test_items = [{"testpk": i, "val": (i * 7) % 50} for i in range(50)]
+        test_items.append({"testpk": 50})
+        self.eve_mocker.set_resource("testresource", test_items)
+        self.eve_mocker.create_index("testresource", "val", kind="sorted")
+
+        for direction in (1, -1):
+            spec = [("val", direction)]
+            expected = sort_items(test_items, spec)
+            expect(self.eve_mocker.sort("testresource", test_items,
+                                        spec)).to.equal(expected)
+            expect(self.eve_mocker.sort("testresource", test_items,
+                                        spec, 5)).to.equal(expected[:5])
+
+            subset = [i for i in test_items if i["testpk"] % 2]
+            expect(self.eve_mocker.sort("testresource", subset,
+                                        spec)).to.equal(sort_items(subset, spec))
+
+        # Dotted field, with an item lacking it
+        items = [{"testpk": 1, "o": {"id": 3}}, {"testpk": 2, "o": {"id": 1}}, {"testpk": 3}]
+        self.eve_mocker.set_resource("r", items)
+        self.eve_mocker.create_index("r", "o.id", kind="sorted")
+        for direction in (1, -1):
+            spec = [("o.id", direction)]
+            expected = sort_items(items, spec)
+            expect(self.eve_mocker.sort("r", items, spec)).to.equal(expected)
+            expect(self.eve_mocker.query("r", spec=spec, limit=2)).to.equal(
+                (3, expected[:2]))
+
+    def testPagination(self):
+        """ Test ?max_results and ?page, with _meta and _links. """
+        test_items = [{"testpk": i} for i in range(50)]
+
+        self.eve_mocker.set_resource("testresource", test_items)
+
+        response = requests.get(api_url('testresource/?sort={"testpk": -1}&max_results=20&page=2'))
+        data = response.json()
+        expect(response.status_code).to.equal(200)
+        expect(data["_items"]).to.equal(test_items[29:9:-1])
+        expect(data["_meta"]).to.equal({"total": 50, "page": 2,
+                                        "max_results": 20})
+        expect(data["_links"]).to.have.key("prev")
+        expect(data["_links"]).to.have.key("next")
+
+        # Following the next link gives the last page
+        response = requests.get(data["_links"]["next"]["href"])
+        data = response.json()
+        expect(data["_items"]).to.equal(test_items[9::-1])
+        expect(data["_meta"]["page"]).to.equal(3)
+        expect(data["_links"]).to_not.have.key("next")
+
+        response = requests.get(api_url('testresource/?where={"testpk": {"$lt": 10}}&page=1'))
+        data = response.json()
+        expect(data["_items"]).to.have.length_of(10)
+        expect(data["_meta"]).to.equal({"total": 10, "page": 1,
+                                        "max_results": 25})
+        expect(data["_links"]).to_not.have.key("next")
+
+    def testJSONCache(self):
+        """ Test that encoded items are cached until their etag changes. """
+        test_items = [{"testpk": "pk{0}".format(i), "etag": "etag{0}".format(i)}
+                      for i in range(10)]
+        self.eve_mocker.set_resource("testresource", test_items)
+        cache = self.eve_mocker.json_cache
+
+        for i in range(2):
+            for item in test_items:
+                requests.get(api_url("testresource/" + item["testpk"]))
+        expect(cache.misses).to.equal(10)
+        expect(cache.hits).to.equal(10)
+
+        # List GETs are encoded at once, without the cache
+        response = requests.get(api_url("testresource/"))
+        expect(sorted(response.json()["_items"])).to.equal(sorted(test_items))
+        expect(cache.hits).to.equal(10)
+
+        response = requests.patch(api_url("testresource/pk1/"),
+                                  {"data": json.dumps({"content": "new"})},
+                                  headers={"If-Match": "etag1"})
+        expect(response.status_code).to.equal(200)
+
+        response = requests.get(api_url("testresource/pk1/"))
+        expect(response.json()["content"]).to.equal("new")
+        expect(cache.misses).to.equal(11)
+
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk2"}])
+        response = requests.get(api_url("testresource/pk2/"))
+        expect(response.json()).to.equal({"testpk": "pk2"})
+
+        # An item replaced directly is a miss, not a hit
+        misses = cache.misses
+        self.eve_mocker.items["testresource"]["pk2"] = {"testpk": "pk2", "val": 1}
+        response = requests.get(api_url("testresource/pk2/"))
+        expect(response.json()).to.equal({"testpk": "pk2", "val": 1})
+        expect(cache.misses).to.equal(misses + 1)
+
+    def testConditionalGet(self):
+        """ Test If-None-Match on items and collections. """
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk1"}])
+
+        response = requests.get(api_url("testresource/"))
+        etag = response.headers["etag"]
+        response = requests.get(api_url("testresource/"),
+                                headers={"If-None-Match": etag})
+        expect(response.status_code).to.equal(304)
+        expect(response.content).to.be.empty
+
+        # The querystring is part of the collection etag
+        response = requests.get(api_url("testresource/?max_results=1"),
+                                headers={"If-None-Match": etag})
+        expect(response.status_code).to.equal(200)
+
+        response = requests.get(api_url("testresource/pk1/"))
+        item_etag = response.headers["etag"]
+        response = requests.get(api_url("testresource/pk1/"),
+                                headers={"If-None-Match": item_etag})
+        expect(response.status_code).to.equal(304)
+
+        # Items set without etag can be patched with their computed etag
+        response = requests.patch(api_url("testresource/pk1/"),
+                                  {"data": json.dumps({"content": "new"})},
+                                  headers={"If-Match": item_etag})
+        expect(response.status_code).to.equal(200)
+
+        response = requests.get(api_url("testresource/pk1/"),
+                                headers={"If-None-Match": item_etag})
+        expect(response.status_code).to.equal(200)
+        response = requests.get(api_url("testresource/"),
+                                headers={"If-None-Match": etag})
+        expect(response.status_code).to.equal(200)
+
+    def testEtagStrategy(self):
+        """ Test the counter and content hash etag strategies. """
+        EveMocker("http://myapi.com/api/", etag_strategy="hash")
+        item = {"_id": "pk1", "content": "test"}
+        etags = set()
+        for i in range(2):
+            response = requests.post("http://myapi.com/api/hashed",
+                                     {"item": json.dumps(item)})
+            etag = response.json()["item"]["etag"]
+            etags.add(etag)
+            requests.delete("http://myapi.com/api/hashed/pk1",
+                            headers={"If-Match": etag})
+        # Same content, same etag
+        expect(etags).to.have.length_of(1)
+
+        counter_etags = set()
+        for i in range(100):
+            item = {"testpk": "pk{0}".format(i)}
+            response = requests.post(api_url("testresource"),
+                                     {"item": json.dumps(item)})
+            counter_etags.add(response.json()["item"]["etag"])
+        expect(counter_etags).to.have.length_of(100)
+
+        expect(EveMocker).when.called_with(BASE_URL, etag_strategy="time")\
+            .should.throw(ValueError)
+
+    def testLoadResource(self):
+        """ Test streaming items from JSON Lines and generators. """
+        lines = StringIO("\n".join([json.dumps({"testpk": "pk1", "val": 1}),
+                                     "{notjson",
+                                     "",
+                                     json.dumps({"val": 3}),
+                                     json.dumps({"testpk": "pk2", "val": 2})]))
+        loaded, errors = self.eve_mocker.load_resource("testresource", lines,
+                                                       indexes={"val": "sorted"})
+        expect(loaded).to.equal(2)
+        expect([lineno for lineno, error in errors]).to.equal([2, 4])
+        res = self.eve_mocker.find("testresource", {"val": {"$gt": 1}})
+        expect(res).to.equal([{"testpk": "pk2", "val": 2}])
+
+        items = ({"testpk": i} for i in range(100))
+        loaded, errors = self.eve_mocker.load_resource("generated", items)
+        expect(loaded).to.equal(100)
+        expect(errors).to.be.empty
+        expect(self.eve_mocker.get_resource("generated")).to.have.length_of(100)
+
+        # Indexes are built once the batches are loaded
+        items = ({"testpk": i, "val": i % 10} for i in range(2500))
+        self.eve_mocker.load_resource("generated", items, indexes={"val": "sorted"})
+        index = self.eve_mocker.indexes["generated"]["val"]
+        expect(index.pks).to.have.length_of(2500)
+        expect(index.values).to.equal(sorted(index.values))
+        expect(self.eve_mocker.load_resource).when.called_with(
+            "generated", [], indexes={"val": "btree"}).should.throw(ValueError)
+
+    def testGenerateResource(self):
+        """ Test seeding resources with generated documents. """
+        schema = {"val": {"type": "int", "min": 10, "max": 20},
+                  "group": {"type": "int", "max": 1000, "cardinality": 5},
+                  "status": {"type": "choice", "values": ["new", "old"],
+                             "weights": [1, 0]},
+                  "name": {"type": "str", "cardinality": 10, "skew": 3},
+                  "score": {"type": "float", "min": 1, "max": 2, "null": 0.5},
+                  "flag": {"type": "bool", "missing": 0.5},
+                  "owner": {"type": "object",
+                            "fields": {"id": {"type": "seq", "prefix": "u"}}},
+                  "tags": {"type": "list", "of": {"type": "bool"},
+                           "min_length": 1, "max_length": 2},
+                  "day": {"type": "date", "min": "Thu, 01 Jan 2026 00:00:00 GMT",
+                          "cardinality": 1}}
+        items = list(generate_items(1000, schema, pk="testpk", seed=1))
+        expect(items).to.equal(list(generate_items(1000, schema, pk="testpk", seed=1)))
+        expect(items).to_not.equal(list(generate_items(1000, schema, pk="testpk")))
+        expect(items[1]["testpk"]).to.equal("000000000000000000000001")
+        expect(items[1]["owner"]).to.equal({"id": "u1"})
+        expect(set(item["val"] for item in items)).to.equal(set(range(10, 21)))
+        expect(set(item["group"] for item in items)).to.equal(
+            set([0, 250, 500, 750, 1000]))
+        expect(set(item["status"] for item in items)).to.equal(set(["new"]))
+        expect(set(item["day"] for item in items)).to.equal(
+            set(["Thu, 01 Jan 2026 00:00:00 GMT"]))
+        names = [item["name"] for item in items]
+        expect(names.count("name0")).to.be.greater_than(names.count("name9") * 3)
+        scores = [item["score"] for item in items]
+        expect(scores.count(None)).to.be.within(400, 600)
+        expect(all(1 <= score < 2 for score in scores if score is not None)).to.be.true
+        expect(sum(1 for item in items if "flag" in item)).to.be.within(400, 600)
+        expect(set(len(item["tags"]) for item in items)).to.equal(set([1, 2]))
+
+        loaded = self.eve_mocker.generate_resource("testresource", 500, schema,
+                                                   indexes={"val": "sorted"})
+        expect(loaded).to.equal(500)
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(500)
+        response = requests.get(api_url("testresource/"),
+                                params={"where": '{"val": {"$gte": 20}}',
+                                        "sort": "-owner.id", "max_results": 1})
+        expected = max(item["owner"]["id"] for item in
+                       self.eve_mocker.find("testresource", {"val": 20}))
+        expect(response.json()["_items"][0]["owner"]["id"]).to.equal(expected)
+
+        for schema in ({"val": {"type": "nope"}}, {"val": "int"},
+                       {"testpk": {"type": "int"}},
+                       {"val": {"type": "choice"}},
+                       {"val": {"type": "int", "min": 2, "max": 1}},
+                       {"val": {"type": "int", "skew": 0}}):
+            expect(self.eve_mocker.generate_resource).when.called_with(
+                "testresource", 10, schema).should.throw(ValueError)
+
+    def testPostJSON(self):
+        """ Test inserting JSON documents and arrays, Eve style. """
+        self.eve_mocker.create_index("testresource", "val")
+        json_headers = {"Content-Type": "application/json"}
+        post = partial(requests.post, api_url("testresource/"),
+                       headers=json_headers)
+
+        response = post(data=json.dumps({"testpk": "pk1", "val": 1}))
+        expect(response.status_code).to.equal(201)
+        out = response.json()
+        expect(out["_status"]).to.equal("OK")
+        expect(out["testpk"]).to.equal("pk1")
+        item = self.eve_mocker.items["testresource"]["pk1"]
+        expect(out["etag"]).to.equal(item["etag"])
+
+        docs = [{"testpk": "bulk{0}".format(i), "val": i % 10}
+                for i in range(1000)]
+        version = self.eve_mocker.versions["testresource"]
+        response = post(data=json.dumps(docs))
+        expect(response.status_code).to.equal(201)
+        out = response.json()
+        expect(out["_status"]).to.equal("OK")
+        expect(out["_items"]).to.have.length_of(1000)
+        expect(out["_items"][999]["testpk"]).to.equal("bulk999")
+        expect(self.eve_mocker.versions["testresource"]).to.equal(version + 1)
+        expect(self.eve_mocker.find("testresource", {"val": 3})).to.have.length_of(100)
+
+        # One invalid document, nothing is inserted
+        response = post(data=json.dumps([{"testpk": "new1"},
+                                         {"testpk": "pk1"},
+                                         {"val": 2},
+                                         {"testpk": "new1"}]))
+        expect(response.status_code).to.equal(400)
+        out = response.json()
+        expect(out["_status"]).to.equal("ERR")
+        expect(out["_error"]["code"]).to.equal(400)
+        expect([item["_status"] for item in out["_items"]]).to.equal(
+            ["OK", "ERR", "ERR", "ERR"])
+        expect(out["_items"][2]["_issues"]).to.equal({"testpk": "required field"})
+        expect("new1" in self.eve_mocker.items["testresource"]).to.be.false
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(1001)
+
+        response = post(data=json.dumps({"testpk": "pk1"}))
+        expect(response.status_code).to.equal(400)
+        expect(response.json()["_issues"]).to.have.key("testpk")
+
+        # Non-ASCII duplicate pk
+        response = post(data=json.dumps({"testpk": u"caf\xe9"}))
+        expect(response.status_code).to.equal(201)
+        response = post(data=json.dumps({"testpk": u"caf\xe9"}))
+        expect(response.status_code).to.equal(400)
+        expect(response.json()["_issues"]).to.equal(
+            {"testpk": u"value 'caf\xe9' is not unique"})
+
+        response = post(data="{notjson")
+        expect(response.status_code).to.equal(400)
+
+    def testProjection(self):
+        """ Test ?projection on list and item GETs. """
+        test_items = [{"testpk": "pk{0}".format(i), "etag": str(i),
+                       "a": i, "b": {"c": i}, "d": "wide"}
+                      for i in range(5)]
+        self.eve_mocker.set_resource("testresource", test_items)
+
+        def get(path, projection):
+            return requests.get(api_url(path),
+                                params={"projection": json.dumps(projection)})
+
+        items = get("testresource/", {"a": 1}).json()["_items"]
+        expect(sorted(items, key=lambda x: x["a"])).to.equal(
+            [{"testpk": "pk{0}".format(i), "etag": str(i), "a": i}
+             for i in range(5)])
+
+        item = get("testresource/pk1/", {"b": 0, "d": 0, "testpk": 0}).json()
+        expect(item).to.equal({"testpk": "pk1", "etag": "1", "a": 1})
+
+        response = get("testresource/pk1/", {"missing": 1, "etag": 1})
+        expect(response.content).to.equal('{"testpk": "pk1", "etag": "1"}')
+
+        # Projected encodings are cached, until the item changes
+        response = requests.patch(api_url("testresource/pk1/"),
+                                  {"data": json.dumps({"a": 10})},
+                                  headers={"If-Match": "1"})
+        expect(response.status_code).to.equal(200)
+        expect(get("testresource/pk1/", {"a": 1}).json()["a"]).to.equal(10)
+
+        # Full items are still returned without projection
+        response = requests.get(api_url("testresource/pk2/"))
+        expect(response.json()).to.equal(test_items[2])
+
+        response = get("testresource/", {"a": 1, "b": 0})
+        expect(response.status_code).to.equal(400)
+        response = get("testresource/pk1/", ["a"])
+        expect(response.status_code).to.equal(400)
+
+    def testSQLiteStorage(self):
+        """ Test the SQLite storage engine answers like the dict storage. """
+        test_items = [{"testpk": "pk{0}".format(i), "val": i, "group": i % 3,
+                       "name": "item{0}".format(i % 7), "flag": i % 2 == 0}
+                      for i in range(50)]
+        test_items.append({"testpk": "nulls", "val": None, "name": [1, 2]})
+        test_items.append({"testpk": "noval"})
+        test_items.append({"testpk": "accents", u"\xe9t\xe9": {u"\xe0": 1}})
+        storage = SQLiteStorage()
+        sqlite_mocker = EveMocker("http://sqlite.eve-mocker/api/",
+                                  default_pk="testpk", storage=storage)
+        for mocker in (self.eve_mocker, sqlite_mocker):
+            mocker.set_resource("testresource", test_items)
+        sqlite_mocker.create_index("testresource", "val")
+
+        sort_pk = lambda items: sorted(items, key=lambda x: x["testpk"])
+        for q in ({"val": 10},
+                  {"val": None},
+                  {"flag": True},
+                  {"val": {"$gt": 10, "$lte": 20}},
+                  {"val": {"$ne": 3}},
+                  {"val": {"$in": [1, 2, None]}},
+                  {"val": {"$nin": [1, 2]}, "group": 1},
+                  {"name": "item3"},
+                  {"name": {"$gte": "item5"}},
+                  {"name": [1, 2]},
+                  {u"\xe9t\xe9.\xe0": 1}):
+            expected = sort_pk(self.eve_mocker.find("testresource", q))
+            expect(sort_pk(sqlite_mocker.find("testresource", q))).to.equal(expected)
+
+        expect(sql_where(parse_where('{"val": {"$gte": 1}}'))).to_not.be.none
+        expect(sql_where(parse_where('{"name": [1, 2]}'))).to.be.none
+        # Non-ASCII keys are stored escaped, they are looked up in Python
+        expect(sql_where(parse_where('{"\\u00e9t\\u00e9": 1}'))).to.be.none
+
+        # Paginated and sorted in SQL
+        total, items = sqlite_mocker.query("testresource",
+                                           parse_where('{"group": 1}'),
+                                           [("val", -1)], offset=5, limit=5)
+        expect(total).to.equal(17)
+        expect([item["val"] for item in items]).to.equal([34, 31, 28, 25, 22])
+        response = requests.get("http://sqlite.eve-mocker/api/testresource/",
+                                params={"where": '{"group": 1}',
+                                        "sort": "-val",
+                                        "max_results": 5, "page": 2})
+        out = response.json()
+        expect(out["_meta"]["total"]).to.equal(17)
+        expect([item["val"] for item in out["_items"]]).to.equal([34, 31, 28, 25, 22])
+
+        # Queries use the expression index
+        plan = storage.execute("EXPLAIN QUERY PLAN SELECT doc FROM \"{0}\" "
+                               "WHERE json_extract(doc, '$.\"val\"') = 1".format(
+                                   storage["testresource"].table))
+        expect(" ".join(row[-1] for row in plan)).to.contain("USING INDEX")
+
+        # Dropped resources are restored by rollback
+        savepoint = sqlite_mocker.savepoint()
+        response = requests.delete("http://sqlite.eve-mocker/api/testresource/")
+        expect(response.status_code).to.equal(200)
+        expect(sqlite_mocker.get_resource("testresource")).to.be.empty
+        sqlite_mocker.rollback(savepoint)
+        expect(sqlite_mocker.get_resource("testresource")).to.have.length_of(53)
+
+    def testCompactCollection(self):
+        """ Test compact resources answer like dict resources. """
+        test_items = [{"testpk": "pk{0}".format(i), "val": i, "score": i / 2.0,
+                       "flag": i % 2 == 0, "name": "item{0}".format(i % 7)}
+                      for i in range(30)]
+        test_items.append({"testpk": "other", "val": "notanumber"})
+        compact_mocker = EveMocker("http://compact.eve-mocker/api/",
+                                   default_pk="testpk",
+                                   storage=DictStorage(compact=["testresource"]))
+        for mocker in (self.eve_mocker, compact_mocker):
+            mocker.set_resource("testresource", test_items)
+        collection = compact_mocker.items["testresource"]
+        expect(collection).to.be.a(CompactCollection)
+        expect(collection.shapes).to.have.length_of(2)
+
+        # int column becomes a list column when a string is stored,
+        # new fields move the item to another shape
+        for base_url in (BASE_URL, "http://compact.eve-mocker/api/"):
+            response = requests.patch(urljoin(base_url, "testresource/pk3/"),
+                                      {"data": json.dumps({"val": "three",
+                                                           "extra": [1]})},
+                                      headers={"If-Match": "*"})
+            expect(response.status_code).to.equal(200)
+        for mocker in (self.eve_mocker, compact_mocker):
+            mocker.set_resource("testresource", [{"testpk": "pk4", "val": 4}])
+            del mocker.items["testresource"]["pk5"]
+            mocker.set_resource("testresource", [{"testpk": "pk30", "val": 30,
+                                                  "score": 1.5, "flag": True,
+                                                  "name": "new"}])
+        expect(collection["pk3"]["extra"]).to.equal([1])
+        expect(collection["pk30"]["flag"]).to.be(True)
+        expect(collection["pk30"]["score"]).to.equal(1.5)
+        expect(collection).to.have.length_of(31)
+
+        # Etags come from a global counter
+        strip = lambda item: dict((k, v) for k, v in item.items() if k != "etag")
+        sort_pk = lambda items: sorted(map(strip, items), key=lambda x: x["testpk"])
+        for q in ({"val": {"$gt": 10}}, {"flag": True, "name": "item3"},
+                  {"val": {"$in": [1, "three", 30]}}, {"extra": [1]},
+                  {"missing": {"$ne": 1}}):
+            expect(sort_pk(compact_mocker.find("testresource", q))).to.equal(
+                sort_pk(self.eve_mocker.find("testresource", q)))
+
+        for path in ("testresource/?sort=-val,testpk",
+                     'testresource/?where={"flag": false}&sort=score',
+                     "testresource/?max_results=5&page=3&sort=testpk",
+                     "testresource/pk30/"):
+            expected = requests.get(api_url(path)).json()
+            out = requests.get("http://compact.eve-mocker/api/" + path).json()
+            for response in (expected, out):
+                response.pop("_links", None)
+                if "_items" in response:
+                    response["_items"] = map(strip, response["_items"])
+            expect(strip(out)).to.equal(strip(expected))
+
+        # Materialized items are cached by etag, without keeping them
+        cache = compact_mocker.json_cache
+        cache.clear()
+        hits, misses = cache.hits, cache.misses
+        for i in range(3):
+            requests.get("http://compact.eve-mocker/api/testresource/pk30")
+        # Encoded twice per GET, its etag is a hash of the encoding
+        expect(cache.misses - misses).to.equal(1)
+        expect(cache.hits - hits).to.equal(5)
+        expect([entry[0] for entry in cache.data.values()]).to.equal([None])
+
+    def testSQLiteStorageFile(self):
+        """ Test reusing a SQLite storage file. """
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        mocker = EveMocker(BASE_URL, storage=SQLiteStorage(path))
+        mocker.load_resource("items", ({"_id": i, "val": i} for i in range(100)))
+        mocker.create_index("items", "val")
+
+        storage = SQLiteStorage(path)
+        expect(storage.keys()).to.equal(["items"])
+        expect(storage.indexed["items"]).to.equal(set(["val"]))
+        expect(storage["items"]).to.have.length_of(100)
+        expect(storage["items"][42]).to.equal({"_id": 42, "val": 42})
+
+    def testSnapshot(self):
+        """ Test saving and lazily loading a snapshot. """
+        fd, path = tempfile.mkstemp(suffix=".snapshot")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        test_items = [{"testpk": "pk{0}".format(i), "status": "even" if i % 2 else "odd"}
+                      for i in range(50)]
+        self.eve_mocker.set_resource("testresource", test_items)
+        self.eve_mocker.create_index("testresource", "status")
+        self.eve_mocker.pk_maps = {"other": "name"}
+        self.eve_mocker.set_resource("other", [{"name": "a", "val": 1}])
+        # Keep the change log (and its tombstones) from now on
+        expect(self.eve_mocker.changes("testresource")).to.have.length_of(50)
+        response = requests.delete(api_url("testresource/pk1/"),
+                                   headers={"If-Match": "*"})
+        expect(response.status_code).to.equal(200)
+        self.eve_mocker.save_snapshot(path)
+
+        url = lambda path: "http://snapshot.eve-mocker/api/" + path
+        mocker = EveMocker.from_snapshot("http://snapshot.eve-mocker/api/", path)
+        expect(mocker.pk_maps).to.equal({"other": "name"})
+        expect(mocker.default_pk).to.equal("testpk")
+        expect(mocker.snapshot.pending).to.equal(set(["testresource", "other"]))
+        expect("testresource" in mocker.items).to.be.false
+
+        response = requests.get(url("testresource/"))
+        sort_pk = lambda items: sorted(items, key=lambda x: x["testpk"])
+        expect(sort_pk(response.json()["_items"])).to.equal(
+            sort_pk(self.eve_mocker.get_resource("testresource")))
+        expect(mocker.snapshot.pending).to.equal(set(["other"]))
+        expect(mocker.indexes["testresource"]["status"]).to.be.a(HashIndex)
+        expect(mocker.find("testresource", {"status": "even"})).to.have.length_of(24)
+        expect([pk for pk, item in mocker.changes("testresource")
+                if item is None]).to.equal(["pk1"])
+
+        # New etags don't collide with the stored ones
+        response = requests.patch(url("testresource/pk2/"),
+                                  {"data": json.dumps({"status": "new"})},
+                                  headers={"If-Match": "*"})
+        etag = response.json()["data"]["etag"]
+        expect(mocker.find("testresource", {"status": "new"})).to.have.length_of(1)
+        expect(set(item.get("etag") for item in test_items)).to_not.contain(etag)
+
+        # Pending resources are copied as is
+        fd, other_path = tempfile.mkstemp(suffix=".snapshot")
+        os.close(fd)
+        self.addCleanup(os.remove, other_path)
+        mocker.save_snapshot(other_path)
+        mocker = EveMocker.from_snapshot("http://snapshot.eve-mocker/api/",
+                                         other_path, storage=SQLiteStorage())
+        expect(mocker.get_resource("other")).to.equal([{"name": "a", "val": 1}])
+        expect(mocker.snapshot.pending).to.equal(set(["testresource"]))
+        item, = mocker.find("testresource", {"testpk": "pk2"})
+        expect(item["etag"]).to.equal(etag)
+        expect(mocker.snapshot).to.be.none
+
+        mocker = EveMocker.from_snapshot("http://snapshot.eve-mocker/api/", path)
+        mocker.reset()
+        expect(mocker.get_resource("other")).to.be.empty
+        expect(EveMocker.from_snapshot).when.called_with(
+            BASE_URL, __file__).should.throw(ValueError)
+
+    def testSavepoint(self):
+        """ Test savepoint, rollback and reset. """
+        test_items = [{"testpk": "pk{0}".format(i), "val": i, "etag": str(i)}
+                      for i in range(10)]
+        self.eve_mocker.set_resource("testresource", test_items)
+        self.eve_mocker.create_index("testresource", "val", kind="sorted")
+        baseline = self.eve_mocker.savepoint()
+
+        etag = "1"
+        for i in range(3):
+            response = requests.patch(api_url("testresource/pk1/"),
+                                      {"data": json.dumps({"val": 100 + i})},
+                                      headers={"If-Match": etag})
+            etag = response.json()["data"]["etag"]
+        requests.delete(api_url("testresource/pk2/"), headers={"If-Match": "2"})
+        requests.post(api_url("testresource/"),
+                      {"item": json.dumps({"testpk": "pk10", "val": 10})})
+        requests.delete(api_url("other/"))
+        self.eve_mocker.set_resource("other", [{"testpk": "other"}])
+        requests.delete(api_url("testresource/"))
+        expect(self.eve_mocker.get_resource("testresource")).to.be.empty
+
+        self.eve_mocker.rollback(baseline)
+        response = requests.get(api_url("testresource/pk1/"))
+        expect(response.json()).to.equal({"testpk": "pk1", "val": 1,
+                                          "etag": "1"})
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(10)
+        expect(self.eve_mocker.get_resource("other")).to.be.empty
+        res = self.eve_mocker.find("testresource", {"val": {"$gte": 8}})
+        expect(sorted(i["val"] for i in res)).to.equal([8, 9])
+
+        # The savepoint can be used again
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk11"}])
+        self.eve_mocker.rollback(baseline)
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(10)
+
+        response = requests.get(api_url("testresource/"))
+        etag = response.headers["etag"]
+        self.eve_mocker.reset()
+        response = requests.get(api_url("testresource/"),
+                                headers={"If-None-Match": etag})
+        expect(response.status_code).to.equal(200)
+        expect(response.json()["_items"]).to.be.empty
+        expect(self.eve_mocker.find("testresource", {"val": 1})).to.be.empty
+        expect(self.eve_mocker.rollback).when.called_with(baseline)\
+            .should.throw(ValueError)
+
+        # Store-wide operations wait for the requests in progress
+        savepoints = []
+        with self.eve_mocker.locked("testresource"):
+            thread = threading.Thread(
+                target=lambda: savepoints.append(self.eve_mocker.savepoint()))
+            thread.start()
+            thread.join(0.1)
+            expect(savepoints).to.be.empty
+        thread.join(5)
+        expect(savepoints).to.have.length_of(1)
+
+    def testServer(self):
+        """ Test serving the mocker over a real socket. """
+        HTTPretty.disable()
+        eve_mocker = EveMocker("http://127.0.0.1/api/", default_pk="testpk")
+        eve_mocker.set_resource("testresource", [{"testpk": "pk1",
+                                                  "etag": "etag1"}])
+        server = EveMockerServer(eve_mocker, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = partial(urljoin, "http://127.0.0.1:{0}/api/".format(server.server_port))
+        try:
+            session = requests.Session()
+            response = session.get(url("testresource/pk1"))
+            expect(response.status_code).to.equal(200)
+            expect(response.json()).to.equal({"testpk": "pk1", "etag": "etag1"})
+
+            response = session.post(url("testresource"),
+                                    {"item": json.dumps({"testpk": "pk2"})})
+            expect(response.json()["item"]["status"]).to.equal("OK")
+
+            response = session.get(url('testresource?where={"testpk": "pk2"}'))
+            expect(response.json()["_items"]).to.have.length_of(1)
+
+            response = session.patch(url("testresource/pk1"),
+                                     {"data": json.dumps({"val": 1})})
+            expect(response.status_code).to.equal(403)
+
+            response = session.get(url("testresource/pk1/too/deep"))
+            expect(response.status_code).to.equal(404)
+
+            # Errors in the mocker are answered with a JSON 500
+            response = session.post(url("testresource"), {"item": "{notjson"})
+            expect(response.status_code).to.equal(500)
+            expect(response.json()).to.equal(
+                {"_status": "ERR",
+                 "_error": {"code": 500, "message": "Internal Server Error"}})
+
+            response = session.head(url("testresource/pk1"))
+            expect(response.headers["content-length"]).to.equal(
+                str(len(json.dumps({"testpk": "pk1", "etag": "etag1"}))))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testRWLock(self):
+        """ Test that readers share the lock, and writers are exclusive. """
+        lock = RWLock()
+        readers = []
+        all_in = threading.Event()
+
+        def read():
+            with lock.read():
+                readers.append(1)
+                if len(readers) == 4:
+                    all_in.set()
+                # Only returns once the 4 readers hold the lock together
+                all_in.wait(5)
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(all_in.is_set()).to.be.true
+
+        with lock.write():
+            with lock.read():
+                pass
+        with lock.read():
+            expect(lock.acquire_write).when.called_with().should.throw(RuntimeError)
+
+    def testConcurrentPatch(self):
+        """ Test that concurrent PATCH with If-Match don't lose updates. """
+        self.eve_mocker.set_resource("testresource", [{"testpk": "counter",
+                                                       "val": 0,
+                                                       "etag": "etag0"}])
+        path = "/api/testresource/counter/"
+        successes = []
+
+        def increment():
+            done = 0
+            while done < 50:
+                status, headers, body = self.eve_mocker.handle(
+                    ServerRequest("GET", path, {}))
+                item = json.loads(body)
+                data = json.dumps({"val": item["val"] + 1})
+                status, headers, body = self.eve_mocker.handle(
+                    ServerRequest("PATCH", path, {"If-Match": item["etag"]},
+                                  urlencode({"data": data})))
+                if status == 200:
+                    done += 1
+            successes.append(done)
+
+        threads = [threading.Thread(target=increment) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        item = self.eve_mocker.items["testresource"]["counter"]
+        expect(sum(successes)).to.equal(400)
+        expect(item["val"]).to.equal(400)
+
+    def testRouter(self):
+        """ Test many mockers and base urls, HEAD and OPTIONS. """
+        v1 = EveMocker("http://myapi.com/v1/")
+        v2 = EveMocker("http://myapi.com/v1/v2/")
+        root = EveMocker("http://otherapi.com/")
+        v1.set_resource("items", [{"_id": "v1"}])
+        v2.set_resource("items", [{"_id": "v2"}])
+        root.set_resource("items", [{"_id": "root"}])
+
+        for url, pk in (("http://myapi.com/v1/items/", "v1"),
+                        ("http://myapi.com/v1/v2/items/", "v2"),
+                        ("http://otherapi.com/items", "root")):
+            response = requests.get(url)
+            expect(response.json()["_items"]).to.equal([{"_id": pk}])
+            response = requests.get(url.rstrip("/") + "/" + pk)
+            expect(response.json()).to.equal({"_id": pk})
+
+        # A single URI is registered per host
+        patterns = [m.regex.pattern for m in HTTPretty._entries
+                    if "myapi" in m.regex.pattern]
+        expect(patterns).to.have.length_of(1)
+
+        response = requests.head("http://myapi.com/v1/items/v1")
+        expect(response.status_code).to.equal(200)
+        expect(response.content).to.be.empty
+        expect(response.headers).to.have.key("etag")
+
+        response = requests.options("http://myapi.com/v1/items")
+        expect(response.status_code).to.equal(200)
+        expect(response.headers["allow"]).to.equal("DELETE, GET, HEAD, POST, OPTIONS")
+
+        response = requests.put("http://myapi.com/v1/items/v1", {})
+        expect(response.status_code).to.equal(405)
+
+        response = requests.get("http://myapi.com/v1/items/v1/too/deep")
+        expect(response.status_code).to.equal(404)
+
+        # Mockers on other ports of the same host are kept apart
+        port5000 = EveMocker("http://ports.eve-mocker:5000/api/")
+        port6000 = EveMocker("http://ports.eve-mocker:6000/api/")
+        port80 = EveMocker("http://ports.eve-mocker:80/api/")
+        for mocker in (port5000, port6000, port80):
+            mocker.set_resource("items", [{"_id": mocker.base_url}])
+        expect(ROUTER.lookup("http://ports.eve-mocker:5000/api/items/")).to.be(port5000)
+        expect(ROUTER.lookup("http://ports.eve-mocker/api/items/")).to.be(port80)
+        session = requests.Session()
+        session.mount("http://", EveMockerAdapter())
+        for mocker in (port5000, port6000, port80):
+            response = session.get(mocker.base_url + "items/")
+            expect(response.json()["_items"]).to.equal([{"_id": mocker.base_url}])
+
+    def testBenchmark(self):
+        """ Test that every benchmark scenario runs and is JSON serializable. """
+        import bench_eve_mocker
+        HTTPretty.disable()
+        results = bench_eve_mocker.run_all(sizes=[20], transports=["direct"],
+                                           max_requests=3)
+        expect(results).to.have.length_of(len(bench_eve_mocker.SCENARIOS))
+        for result in results:
+            expect(result["statuses"].values()).to.equal([3])
+            expect(result["statuses"].keys()[0]).to.be.within([200, 201])
+        expect(json.loads(json.dumps(results))).to.have.length_of(len(results))
+
+    def testInstrumentation(self):
+        """ Test requests stats, the request log and the profile hook. """
+        eve_mocker = EveMocker(BASE_URL, default_pk="testpk",
+                               instrument=True, request_log_size=3)
+        eve_mocker.set_resource("testresource", [{"testpk": "pk1"}])
+
+        requests.get(api_url("testresource/"))
+        for i in range(3):
+            requests.get(api_url("testresource/pk1/"))
+        requests.get(api_url('testresource/pk2/?where={"a": 1}'))
+
+        stats = eve_mocker.stats()
+        expect(stats["total"]).to.equal(5)
+        expect(stats["methods"]).to.equal({"GET": 5})
+        items = stats["endpoints"]["GET /testresource/<id>"]
+        expect(items["count"]).to.equal(4)
+        expect(items["statuses"]).to.equal({200: 3, 404: 1})
+        expect(sum(items["latency"])).to.equal(4)
+        expect(stats["endpoints"]["GET /testresource"]["count"]).to.equal(1)
+
+        expect(eve_mocker.requests).to.have.length_of(3)
+        last = eve_mocker.requests[-1]
+        expect(last["path"]).to.equal("/api/testresource/pk2/")
+        expect(parse_qs(last["query"])).to.equal({"where": ['{"a": 1}']})
+        expect(last["status"]).to.equal(404)
+
+        profiles = []
+        eve_mocker.profile_hook = lambda entry, profile: profiles.append(profile)
+        requests.get(api_url("testresource/"))
+        expect(profiles).to.have.length_of(1)
+
+        eve_mocker.reset_stats()
+        expect(eve_mocker.stats()["total"]).to.equal(0)
+        expect(eve_mocker.requests).to.be.empty
+
+    def testAdapter(self):
+        """ Test the requests adapter, without HTTPretty. """
+        HTTPretty.disable()
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk1", "etag": "1"}])
+        session = requests.Session()
+        session.mount(BASE_URL, EveMockerAdapter(self.eve_mocker))
+
+        response = session.get(api_url("testresource/pk1"))
+        expect(response.status_code).to.equal(200)
+        expect(response.json()).to.equal({"testpk": "pk1", "etag": "1"})
+        expect(response.headers["ETag"]).to.equal('"1"')
+
+        response = session.patch(api_url("testresource/pk1"),
+                                 {"data": json.dumps({"a": 1})},
+                                 headers={"if-match": "1"})
+        expect(response.status_code).to.equal(200)
+        response = session.post(api_url("testresource/"),
+                                json=[{"testpk": "pk2"}, {"testpk": "pk3"}])
+        expect(response.status_code).to.equal(201)
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(3)
+
+        # Routed to the mounted mocker
+        other = EveMocker("http://adapter.eve-mocker/v1/")
+        other.set_resource("items", [{"_id": "a"}])
+        session.mount("http://", EveMockerAdapter())
+        response = session.get("http://adapter.eve-mocker/v1/items/a")
+        expect(response.json()).to.equal({"_id": "a"})
+        response = session.get("http://unknown.eve-mocker/v1/items/a")
+        expect(response.status_code).to.equal(404)
+
+        # Concurrent requests
+        errors = []
+
+        def worker(i):
+            try:
+                response = session.post(api_url("testresource/"),
+                                        json={"testpk": "thread{0}".format(i)})
+                expect(response.status_code).to.equal(201)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(errors).to.be.empty
+        expect(self.eve_mocker.get_resource("testresource")).to.have.length_of(23)
+
+    def testWSGIApp(self):
+        """ Test the WSGI application. """
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk1", "etag": "1"}])
+        app = WSGIApp(self.eve_mocker)
+
+        def call(method, path, query="", body="", **headers):
+            environ = {"REQUEST_METHOD": method, "PATH_INFO": path,
+                       "QUERY_STRING": query, "CONTENT_LENGTH": str(len(body)),
+                       "wsgi.input": StringIO(body)}
+            environ.update(("HTTP_" + k.upper(), v) for k, v in headers.items())
+            setup_testing_defaults(environ)
+            out = {}
+
+            def start_response(status, headers):
+                out["status"] = status
+                out["headers"] = dict(headers)
+            out["body"] = "".join(app(environ, start_response))
+            return out
+
+        out = call("GET", "/api/testresource/pk1/")
+        expect(out["status"]).to.equal("200 OK")
+        expect(json.loads(out["body"])).to.equal({"testpk": "pk1", "etag": "1"})
+        expect(out["headers"]["Content-Length"]).to.equal(str(len(out["body"])))
+
+        out = call("GET", "/api/testresource/pk1/", if_none_match='"1"')
+        expect(out["status"]).to.equal("304 Not Modified")
+
+        out = call("DELETE", "/api/testresource/pk1/", if_match="2")
+        expect(out["status"]).to.equal("412 Precondition Failed")
+
+        out = call("GET", "/api/testresource/", query='where={"testpk": "pk2"}')
+        expect(json.loads(out["body"])).to.equal({"_items": []})
+
+        # Routed by host
+        out = WSGIApp()({"REQUEST_METHOD": "GET", "PATH_INFO": "/api/testresource/",
+                         "HTTP_HOST": "localhost", "wsgi.input": StringIO("")},
+                        lambda status, headers: None)
+        expect(json.loads("".join(out))["_items"]).to.have.length_of(1)
+
+    def testStreaming(self):
+        """ Test streaming large list responses in chunks. """
+        HTTPretty.disable()
+        eve_mocker = EveMocker("http://127.0.0.1/api/", default_pk="testpk",
+                               stream=True)
+        items = [{"testpk": "pk{0}".format(i), "val": i} for i in range(2500)]
+        eve_mocker.set_resource("testresource", items)
+        expected = eve_mocker.encode_items("testresource",
+                                           eve_mocker.get_resource("testresource"))
+
+        status, headers, body = eve_mocker.handle(
+            ServerRequest("GET", "/api/testresource/", {}))
+        expect(status).to.equal(200)
+        chunks = list(body)
+        expect(chunks).to.have.length_of(5)
+        expect(json.loads("".join(chunks))).to.equal(json.loads(expected))
+
+        # Small and paginated responses are not streamed
+        status, headers, body = eve_mocker.handle(
+            ServerRequest("GET", "/api/testresource/?max_results=10", {}))
+        expect(json.loads(body)["_items"]).to.have.length_of(10)
+        status, headers, body = eve_mocker.handle(
+            ServerRequest("HEAD", "/api/testresource/", {}))
+        expect(body).to.equal("")
+
+        # Sent with chunked transfer encoding by the server
+        server = EveMockerServer(eve_mocker, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            response = requests.get("http://127.0.0.1:{0}/api/testresource/"
+                                    .format(server.server_port), stream=True)
+            expect(response.headers["transfer-encoding"]).to.equal("chunked")
+            expect(response.json()["_items"]).to.have.length_of(2500)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        app = WSGIApp(eve_mocker)
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/api/testresource/",
+                   "wsgi.input": StringIO("")}
+        setup_testing_defaults(environ)
+        out = {}
+        body = app(environ, lambda status, headers: out.update(headers))
+        expect(out).to_not.have.key("Content-Length")
+        expect(json.loads("".join(body))).to.equal(json.loads(expected))
+
+        session = requests.Session()
+        session.mount("http://127.0.0.1/api/", EveMockerAdapter(eve_mocker))
+        response = session.get("http://127.0.0.1/api/testresource/", stream=True)
+        expect(response.headers).to_not.have.key("content-length")
+        expect(json.loads("".join(response.iter_content(1000)))).to.equal(
+            json.loads(expected))
+
+    def testCompression(self):
+        """ Test gzip and deflate compressed responses. """
+        expect(parse_accept_encoding("gzip, deflate")).to.equal("gzip")
+        expect(parse_accept_encoding("gzip;q=0.5, deflate")).to.equal("deflate")
+        expect(parse_accept_encoding("deflate, gzip;q=0")).to.equal("deflate")
+        expect(parse_accept_encoding("*")).to.equal("gzip")
+        expect(parse_accept_encoding("identity")).to.be.none
+        expect(parse_accept_encoding("")).to.be.none
+
+        self.eve_mocker.compress = True
+        self.eve_mocker.set_resource("testresource", [
+            {"testpk": "pk{0}".format(i), "content": "content {0}".format(i)}
+            for i in range(100)])
+        response = requests.get(api_url("testresource/"))
+        expect(response.headers["content-encoding"]).to.equal("gzip")
+        expect(response.headers["vary"]).to.equal("Accept-Encoding")
+        expect(int(response.headers["content-length"])).to.be.lower_than(
+            len(response.content))
+        expect(response.json()["_items"]).to.have.length_of(100)
+
+        response = requests.get(api_url("testresource/"),
+                                headers={"Accept-Encoding": "deflate"})
+        expect(response.headers["content-encoding"]).to.equal("deflate")
+        expect(response.json()["_items"]).to.have.length_of(100)
+
+        response = requests.get(api_url("testresource/"),
+                                headers={"Accept-Encoding": "identity"})
+        expect(response.headers).to_not.have.key("content-encoding")
+        expect(response.json()["_items"]).to.have.length_of(100)
+
+        # Small bodies are sent as is
+        response = requests.get(api_url("testresource/pk1"))
+        expect(response.headers).to_not.have.key("content-encoding")
+        expect(response.json()["content"]).to.equal("content 1")
+
+        # Compressed streams, decoded by the adapter
+        HTTPretty.disable()
+        self.eve_mocker.stream = True
+        self.eve_mocker.load_resource("testresource", (
+            {"testpk": "new{0}".format(i)} for i in range(2000)))
+        session = requests.Session()
+        session.mount(BASE_URL, EveMockerAdapter(self.eve_mocker))
+        response = session.get(api_url("testresource/"))
+        expect(response.headers["content-encoding"]).to.equal("gzip")
+        expect(response.json()["_items"]).to.have.length_of(2100)
+
+    def testConditions(self):
+        """ Test simulated latency, bandwidth and errors. """
+        clock = VirtualClock()
+        eve_mocker = EveMocker("http://slow.eve-mocker/api/", default_pk="testpk",
+                               clock=clock, instrument=True)
+        eve_mocker.set_resource("testresource", [{"testpk": "pk1", "etag": "1"}])
+        eve_mocker.set_conditions(Conditions(latency=0.2, bandwidth=1000))
+        eve_mocker.set_conditions(Conditions(latency=uniform_latency(1, 2)),
+                                  resource="testresource", method="patch")
+
+        response = requests.get("http://slow.eve-mocker/api/testresource/pk1")
+        expect(response.status_code).to.equal(200)
+        expect(clock.now).to.equal(0.2 + len(response.content) / 1000.0)
+
+        clock.now = 0
+        response = requests.patch("http://slow.eve-mocker/api/testresource/pk1",
+                                  {"data": json.dumps({"a": 1})},
+                                  headers={"If-Match": "1"})
+        expect(response.status_code).to.equal(200)
+        expect(clock.now).to.be.within(1, 2)
+        stats = eve_mocker.stats()["endpoints"]["PATCH /testresource/<id>"]
+        expect(stats["time"]).to.equal(clock.now)
+
+        # Errors, the request is not handled
+        eve_mocker.set_conditions(Conditions(error_rate=1, error_statuses=(429,),
+                                             retry_after=5),
+                                  resource="testresource", method="PATCH")
+        etag = eve_mocker.items["testresource"]["pk1"]["etag"]
+        response = requests.patch("http://slow.eve-mocker/api/testresource/pk1",
+                                  {"data": json.dumps({"a": 2})},
+                                  headers={"If-Match": etag})
+        expect(response.status_code).to.equal(429)
+        expect(response.headers["retry-after"]).to.equal("5")
+        expect(response.json()["_error"]["code"]).to.equal(429)
+        expect(eve_mocker.items["testresource"]["pk1"]["a"]).to.equal(1)
+
+        eve_mocker.set_conditions(None, resource="testresource", method="PATCH")
+        expect(eve_mocker.get_conditions("testresource", "PATCH")).to.be(
+            eve_mocker.conditions[(None, None)])
+
+        # Seeded distributions are reproducible
+        samples = [[Conditions(latency=lognormal_latency(0.05, 1), seed=42).delay()
+                    for i in range(2)] for j in range(2)]
+        expect(samples[0]).to.equal(samples[1])
+        errors = Conditions(error_rate=0.5, seed=1)
+        expect(len(filter(None, [errors.error() for i in range(1000)]))).to.be.within(400, 600)
+
+        # Real sleeps can be cancelled
+        clock = Clock()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(clock.sleep(30)))
+        thread.start()
+        for i in range(500):
+            clock.cancel()
+            thread.join(0.01)
+            if not thread.is_alive():
+                break
+        expect(results).to.equal([False])
+        expect(clock.sleep(0.01)).to.be.true
+
+    def testChanges(self):
+        """ Test _created/_updated, If-Modified-Since and the change log. """
+        clock = VirtualClock(now=1790000000)
+        mocker = EveMocker("http://changes.eve-mocker/api/",
+                           default_pk="testpk", clock=clock, timestamps=True)
+        url = lambda path: "http://changes.eve-mocker/api/" + path
+        monday = "Mon, 21 Sep 2026 14:13:20 GMT"
+        mocker.set_resource("testresource",
+                            [{"testpk": "pk{0}".format(i), "val": i}
+                             for i in range(10)] +
+                            [{"testpk": "old", "_created": "Sat, 01 Aug 2026 10:00:00 GMT"}])
+        item = mocker.items["testresource"]["pk1"]
+        expect(item["_created"]).to.equal(monday)
+        expect(item["_updated"]).to.equal(monday)
+        expect(mocker.items["testresource"]["old"]["_updated"]).to.equal(
+            "Sat, 01 Aug 2026 10:00:00 GMT")
+
+        # Friday sorts before Monday as a string, not as a date
+        clock.advance(4 * 86400)
+        friday = "Fri, 25 Sep 2026 14:13:20 GMT"
+        response = requests.patch(url("testresource/pk3/"),
+                                  {"data": json.dumps({"val": 30,
+                                                       "_created": "nope"})},
+                                  headers={"If-Match": "*"})
+        expect(response.status_code).to.equal(200)
+        response = requests.post(url("testresource/"),
+                                 data=json.dumps({"testpk": "new"}),
+                                 headers={"Content-Type": "application/json"})
+        expect(response.status_code).to.equal(201)
+        expect(mocker.items["testresource"]["pk3"]["_created"]).to.equal(monday)
+        expect(mocker.items["testresource"]["pk3"]["_updated"]).to.equal(friday)
+        expect(mocker.items["testresource"]["new"]["_created"]).to.equal(friday)
+
+        pks = lambda items: sorted(item["testpk"] for item in items)
+        expect(pks(mocker.find("testresource",
+                               {"_updated": {"$gt": monday}}))).to.equal(["new", "pk3"])
+        expect(pks(mocker.find("testresource",
+                               {"_updated": {"$lt": monday}}))).to.equal(["old"])
+        expect(pks(mocker.find("testresource",
+                               {"_created": monday, "val": {"$gte": 8}}))).to.equal(["pk3", "pk8", "pk9"])
+        expect(mocker.changelog("testresource").lookup(
+            {"$gte": parse_date(friday)})).to.equal(set(["new", "pk3"]))
+        response = requests.get(url("testresource/"),
+                                params={"sort": "-_updated,testpk",
+                                        "max_results": 3})
+        expect([i["testpk"] for i in response.json()["_items"]]).to.equal(
+            ["new", "pk3", "pk0"])
+        response = requests.get(url("testresource/"),
+                                params={"where": '{"_updated": {"$gt": "garbage"}}'})
+        expect(response.status_code).to.equal(400)
+
+        # If-Modified-Since only returns the changed items
+        response = requests.get(url("testresource/"),
+                                headers={"If-Modified-Since": monday})
+        expect(response.status_code).to.equal(200)
+        expect(response.headers["Last-Modified"]).to.equal(friday)
+        expect(pks(response.json()["_items"])).to.equal(["new", "pk3"])
+        response = requests.get(url("testresource/"),
+                                headers={"If-Modified-Since": friday})
+        expect(response.status_code).to.equal(304)
+        response = requests.get(url("testresource/pk1/"),
+                                headers={"If-Modified-Since": monday})
+        expect(response.status_code).to.equal(304)
+        expect(response.headers["Last-Modified"]).to.equal(monday)
+        response = requests.get(url("testresource/pk3/"),
+                                headers={"If-Modified-Since": monday})
+        expect(response.status_code).to.equal(200)
+
+        # Deleted items are kept as tombstones
+        clock.advance(60)
+        response = requests.delete(url("testresource/pk3/"),
+                                   headers={"If-Match": "*"})
+        expect(response.status_code).to.equal(200)
+        changes = mocker.changes("testresource", monday)
+        expect([pk for pk, _ in changes]).to.equal(["new", "pk3"])
+        expect(changes[0][1]["testpk"]).to.equal("new")
+        expect(changes[1][1]).to.be.none
+        expect(mocker.changes("testresource")).to.have.length_of(12)
+        response = requests.get(url("testresource/"),
+                                headers={"If-Modified-Since": friday})
+        expect(response.status_code).to.equal(200)
+        expect(response.json()["_items"]).to.be.empty
+
+        # Stale entries are compacted
+        log = mocker.changelog("testresource")
+        for i in range(1200):
+            mocker.set_resource("testresource", [{"testpk": "pk1", "val": i}])
+        expect(len(log.times)).to.be.lower_than(1100)
+        expect(len(log)).to.equal(12)
+
+        # Without timestamps, the log is only built when it's needed
+        self.eve_mocker.set_resource("testresource", [{"testpk": "pk1"}])
+        response = requests.get(api_url("testresource/"))
+        expect(response.headers).to_not.have.key("last-modified")
+        expect(self.eve_mocker.changelogs).to.be.empty
+        response = requests.get(api_url("testresource/"), headers={
+            "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        expect(response.status_code).to.equal(304)
+        expect(self.eve_mocker.changelogs).to.have.key("testresource")
+
     def testSetResourceNoPk(self):
         """ Set a resource item without PK should raise an Exception. """
         # No pk for the item should raise an Exception
@@ -257,6 +1452,182 @@ class TestEveMocker(unittest.TestCase):
         res = query_data(test_data, {"testpk": {"$lt": 10}})
         expect(res).to.have.length_of(10)
 
+        for ops, count in (({"$gt": 10, "$lt": 15}, 4),
+                           ({"$gt": 10, "$lte": 15}, 5),
+                           ({"$gte": 10, "$lt": 15}, 5),
+                           ({"$lte": 15, "$gte": 10}, 6)):
+            res = query_data(test_data, {"testpk": ops})
+            expect(res).to.have.length_of(count)
+
+        # Unhashable values are never in a $in list
+        test_data = [{"testpk": [1]}, {"testpk": 1}]
+        expect(query_data(test_data, {"testpk": {"$in": [1, 2]}})).to.equal(
+            [{"testpk": 1}])
+        expect(query_data(test_data, {"testpk": {"$nin": [1, 2]}})).to.equal(
+            [{"testpk": [1]}])
+
+    def testQueryPlanCache(self):
+        """ Test that ?where queries are compiled once and cached. """
+        test_data = [{"testpk": i, "content": "content{0}".format(i % 3)}
+                     for i in range(50)]
+        where = '{"testpk": {"$gte": 10, "$lt": 40}, "content": "content1"}'
+
+        plan = parse_where(where)
+        expect(parse_where(where)).to.be(plan)
+        res = plan(test_data)
+        expect(res).to.equal(query_data(test_data, json.loads(where)))
+        expect([i["testpk"] for i in res]).to.equal(range(10, 40)[::3])
+
+        expect(parse_where).when.called_with("{notjson").should.throw(ValueError)
+        expect(parse_where).when.called_with("[1, 2]").should.throw(ValueError)
+
+    def testQueryOperators(self):
+        """ Test dot notation, $and, $or, $exists and $regex. """
+        test_items = [{"testpk": "pk{0}".format(i), "val": i,
+                       "owner": {"id": i % 4, "name": "Owner{0}".format(i % 3)},
+                       "tags": ["a", "b"] if i % 5 else []}
+                      for i in range(40)]
+        test_items.append({"testpk": "noowner", "val": 100, "name": "no owner"})
+        test_items.append({"testpk": "badowner", "owner": "nobody"})
+        storages = {"sqlite": SQLiteStorage(),
+                    "compact": DictStorage(compact=["testresource"])}
+        mockers = [self.eve_mocker]
+        for name, storage in storages.items():
+            mockers.append(EveMocker("http://{0}.eve-mocker/api/".format(name),
+                                     default_pk="testpk", storage=storage))
+        for mocker in mockers:
+            mocker.set_resource("testresource", test_items)
+            mocker.create_index("testresource", "owner.id")
+
+        pks = lambda items: sorted(item["testpk"] for item in items)
+        find = lambda q: pks(self.eve_mocker.find("testresource", q))
+        expect(find({"owner.id": 3})).to.have.length_of(10)
+        expect(find({"owner.id": {"$gte": 2}, "owner.name": "Owner0"})).to.equal(
+            pks(i for i in test_items if i.get("val") in range(3, 40, 12) +
+                range(6, 40, 12) and isinstance(i.get("owner"), dict)))
+        expect(find({"owner": {"id": 1, "name": "Owner1"}})).to.equal(
+            ["pk1", "pk13", "pk25", "pk37"])
+        expect(find({"tags.1": "b"})).to.have.length_of(32)
+        expect(find({"owner": {"$exists": False}})).to.equal(["noowner"])
+        expect(find({"owner.id": {"$exists": False}})).to.equal(
+            ["badowner", "noowner"])
+        expect(find({"$or": [{"val": {"$lt": 2}}, {"val": {"$gt": 38}}]})).to.equal(
+            ["noowner", "pk0", "pk1", "pk39"])
+        expect(find({"$and": [{"val": {"$gte": 10}}, {"val": {"$lt": 12}}]})).to.equal(
+            ["pk10", "pk11"])
+        expect(find({"owner.name": {"$regex": "^owner2$", "$options": "i"},
+                     "val": {"$lt": 10}})).to.equal(["pk2", "pk5", "pk8"])
+        expect(find({"name": {"$regex": "owner"}})).to.equal(["noowner"])
+
+        queries = ({"owner.id": 2},
+                   {"owner.id": {"$in": [0, 1]}, "val": {"$gt": 20}},
+                   {"owner.name": {"$regex": "1$"}},
+                   {"owner.name": {"$regex": "^OWNER", "$options": "i"}},
+                   {"owner.id": {"$exists": True}},
+                   {"owner.id": {"$exists": False}},
+                   {"$or": [{"owner.id": 0}, {"val": {"$gt": 35}}], "val": {"$lt": 38}},
+                   {"$and": [{"owner.id": 1}, {"$or": [{"val": 1}, {"val": 5}]}]},
+                   {"tags.0": "a"},
+                   {"owner": {"id": 1, "name": "Owner1"}})
+        strip = lambda item: dict((k, v) for k, v in item.items() if k != "etag")
+        for q in queries:
+            expected = map(strip, self.eve_mocker.find("testresource", q))
+            for mocker in mockers[1:]:
+                out = map(strip, mocker.find("testresource", q))
+                expect(sorted(out)).to.equal(sorted(expected))
+        expect(sql_where(parse_where('{"owner.id": {"$exists": true}}'))).to_not.be.none
+        expect(sql_where(parse_where('{"$or": [{"a": 1}, {"b": {"$regex": "x"}}]}'))).to_not.be.none
+
+        # Sort on an embedded field
+        response = requests.get(api_url("testresource/"),
+                                params={"where": '{"owner.id": 1}',
+                                        "sort": "-owner.name,val"})
+        expect([i["testpk"] for i in response.json()["_items"]]).to.equal(
+            ["pk5", "pk17", "pk29", "pk1", "pk13", "pk25", "pk37", "pk9",
+             "pk21", "pk33"])
+
+        for where in ('{"val": {"$foo": 1}}', '{"$or": {"val": 1}}',
+                      '{"val": {"$in": 1}}', '{"val": {"$regex": "("}}',
+                      '{"val": {"$regex": "a", "$options": "q"}}'):
+            expect(parse_where).when.called_with(where).should.throw(ValueError)
+            response = requests.get(api_url("testresource/"),
+                                    params={"where": where})
+            expect(response.status_code).to.equal(400)
+
+    def testLRUCache(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        expect(cache.get("a")).to.equal(1)
+        cache.set("c", 3)
+        expect("b" in cache).to.be.false
+        expect(cache.get("b")).to.be.none
+        expect(cache.info()).to.equal({"hits": 1, "misses": 1,
+                                       "size": 2, "maxsize": 2})
+
+    def testIndexes(self):
+        """ Test ?where queries answered through hash and sorted indexes. """
+        test_items = [{"testpk": i, "status": "even" if i % 2 else "odd"}
+                      for i in range(50)]
+        self.eve_mocker.set_resource("testresource", test_items)
+        self.eve_mocker.create_index("testresource", "status")
+        self.eve_mocker.create_index("testresource", "testpk", kind="sorted")
+
+        res = self.eve_mocker.find("testresource", {"status": "odd"})
+        expect(res).to.have.length_of(25)
+
+        res = self.eve_mocker.find("testresource",
+                                   {"status": {"$in": ["odd", "even"]}})
+        expect(res).to.have.length_of(50)
+
+        res = self.eve_mocker.find("testresource",
+                                   {"status": {"$nin": ["odd"]},
+                                    "testpk": {"$gte": 10, "$lt": 20}})
+        expect(sorted(i["testpk"] for i in res)).to.equal(range(11, 20, 2))
+        # $ne and $nin are left to the scan
+        index = self.eve_mocker.indexes["testresource"]["status"]
+        expect(index.lookup({"$ne": "odd"})).to.be.none
+        expect(index.lookup({"$nin": ["odd"], "$in": ["odd", "even"]})).to.have.length_of(50)
+
+        response = requests.get(api_url('testresource/?where={"testpk": {"$gt": 45}}'))
+        res = sorted(response.json()["_items"], key=lambda x: x["testpk"])
+        expect(res).to.equal(test_items[46:])
+
+        # Indexes must follow PATCH and DELETE
+        self.eve_mocker.set_resource("testresource",
+                                     [{"testpk": "pk100", "status": "new",
+                                       "etag": "etag100"}])
+        response = requests.patch(api_url("testresource/pk100/"),
+                                  {"data": json.dumps({"status": "old"})},
+                                  headers={"If-Match": "etag100"})
+        expect(response.status_code).to.equal(200)
+        expect(self.eve_mocker.find("testresource",
+                                    {"status": "new"})).to.be.empty
+        expect(self.eve_mocker.find("testresource",
+                                    {"status": "old"})).to.have.length_of(1)
+
+        etag = response.json()["data"]["etag"]
+        response = requests.delete(api_url("testresource/pk100/"),
+                                   headers={"If-Match": etag})
+        expect(response.status_code).to.equal(200)
+        expect(self.eve_mocker.find("testresource",
+                                    {"testpk": "pk100"})).to.be.empty
+
+        response = requests.delete(api_url("testresource/"))
+        expect(self.eve_mocker.find("testresource",
+                                    {"status": "odd"})).to.be.empty
+
+        # Batches are merged like values added one at a time
+        items = [(i, {"val": i % 7} if i % 5 else {}) for i in range(1000)]
+        for batch_size in (1, 10, 600):
+            index, merged = SortedIndex("val"), SortedIndex("val")
+            for i in range(0, len(items), batch_size):
+                for pk, item in items[i:i + batch_size]:
+                    index.add(pk, item)
+                merged.add_many(items[i:i + batch_size])
+            expect(merged.values).to.equal(index.values)
+            expect(merged.pks).to.equal(index.pks)
+
     def testContextManager(self):
         """ Test EveMocker within a context manager. """
         with EveMocker("http://myapi.com/api/"):